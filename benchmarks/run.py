@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Benchmark suite for miniscript.
+
+Times the parse, compile and run phases of the sample scripts, the challenge
+solutions and the synthetic workloads in `benchmarks/workloads`. Results are
+written as JSON and can be compared against a stored baseline:
+
+    python benchmarks/run.py -o baseline.json
+    python benchmarks/run.py --baseline baseline.json --threshold 0.2
+"""
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import platform
+import statistics
+import time
+
+import miniscript as ms
+
+PHASES = ('parse', 'compile', 'run')
+MAX_STEPS = 10000000
+
+
+def sources():
+    """Yields (name, source) for every benchmarked script."""
+    patterns = [('samples', 'samples/*.ms'), ('challenge', 'challenges/*/solution.ms'),
+                ('workload', 'benchmarks/workloads/*.ms')]
+    for kind, pattern in patterns:
+        for path in sorted(glob.glob(os.path.join(ROOT, pattern))):
+            if kind == 'challenge':
+                name = os.path.basename(os.path.dirname(path))
+            else:
+                name = os.path.splitext(os.path.basename(path))[0]
+            with open(path) as f:
+                yield f'{kind}/{name}', f.read()
+
+
+def run_phases(source):
+    """Runs all phases once and returns their durations in seconds."""
+    times = {}
+    start = time.perf_counter()
+    ast = ms.parse(source)
+    times['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    globalvars = ms.collect_locals(ast)
+    code = ms.compile(ast)
+    times['compile'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scope = ms.GlobalScope()
+    for var in globalvars:
+        scope.declare(var)
+    # challenge solutions read a secret `h` and write a public `l`
+    scope.declare('h', ms.TNumber(424242, {'high'}))
+    scope.declare('l', ms.TUndefined())
+    interpreter = ms.Interpreter(code, scope, ms.Monitor())
+    error = None
+    try:
+        interpreter.run(MAX_STEPS)
+    except ms.InterpreterError as e:
+        error = f'{type(e).__name__}: {e}'
+    times['run'] = time.perf_counter() - start
+    return times, error
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def summarize(values):
+    return {
+        'min': min(values),
+        'max': max(values),
+        'mean': statistics.mean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'samples': values,
+    }
+
+
+def benchmark(name, source, repeat, warmup):
+    samples = {phase: [] for phase in PHASES}
+    error = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(warmup + repeat):
+            times, error = run_phases(source)
+            if i >= warmup:
+                for phase in PHASES:
+                    samples[phase].append(times[phase])
+    result = {phase: summarize(samples[phase]) for phase in PHASES}
+    if error:
+        result['error'] = error
+    return result
+
+
+def compare(results, baseline, threshold, stat='p50'):
+    """Returns a list of (benchmark, phase, ratio) for every phase slower than
+    `1 + threshold` times the baseline."""
+    regressions = []
+    for name, phases in results.items():
+        for phase in PHASES:
+            try:
+                old = baseline[name][phase][stat]
+            except KeyError:
+                continue
+            new = phases[phase][stat]
+            if old > 0 and new / old > 1 + threshold:
+                regressions.append((name, phase, new / old))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='run the miniscript benchmarks')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='measured repetitions per benchmark')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured repetitions per benchmark')
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks containing this string')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='allowed relative slowdown of the median before failing (default 0.25)')
+    args = parser.parse_args()
+
+    results = {}
+    for name, source in sources():
+        if args.filter not in name:
+            continue
+        results[name] = benchmark(name, source, args.repeat, args.warmup)
+        print(f'{name:40} ' + ' '.join(f'{p} {results[name][p]["p50"] * 1000:9.3f}ms' for p in PHASES),
+              file=sys.stderr)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'timestamp': time.time(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, phase, ratio in regressions:
+            print(f'regression: {name} {phase} is {ratio:.2f}x the baseline', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -50,9 +50,10 @@ class AstRestrictor(ms.NodeVisitor):
             raise self.error(tree)
 
 
+challenge = Challenge(name='very basic challenge',
+                      challenge=[('h', 'l', lambda: ms.TNumber(random.randrange(1000000000), label={'high'}))],
+                      monitor=LightMonitor,
+                      restrictions=AstRestrictor().visit)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='very basic challenge',
-                  challenge=[('h', 'l', lambda: ms.TNumber(random.randrange(1000000000), label={'high'}))],
-                  monitor=LightMonitor,
-                  restrictions=AstRestrictor().visit))
+    default_main(challenge)
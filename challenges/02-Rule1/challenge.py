@@ -45,12 +45,13 @@ class AstRestrictor(ms.NodeVisitor):
             raise self.error(tree)
 
 
-class Level2Monitor(ms.ArithmeticOpRule, ms.BaseMonitor):
+class Level2Monitor(ms.ArithmeticOpRule, ms.IndexRule, ms.BaseMonitor):
     pass
 
+challenge = Challenge(name='very basic challenge',
+                      challenge=[('h', 'l', lambda: ms.TNumber(random.randrange(1000000000), label={'high'}))],
+                      monitor=Level2Monitor,
+                      restrictions=AstRestrictor().visit)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='very basic challenge',
-                  challenge=[('h', 'l', lambda: ms.TNumber(random.randrange(1000000000), label={'high'}))],
-                  monitor=Level2Monitor,
-                  restrictions=AstRestrictor().visit))
+    default_main(challenge)
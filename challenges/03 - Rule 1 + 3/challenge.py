@@ -4,12 +4,13 @@ import miniscript as ms
 import random
 from common import Challenge, default_main
 
-class Level3Monitor(ms.ArithmeticOpRule, ms.UnaryOperatorRule, ms.BaseMonitor):
+class Level3Monitor(ms.ArithmeticOpRule, ms.IndexRule, ms.UnaryOperatorRule, ms.BaseMonitor):
     pass
 
+challenge = Challenge(name='extract boolean',
+                      challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
+                      monitor=Level3Monitor,
+                      nruns=8)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='extract boolean',
-                  challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
-                  monitor=Level3Monitor,
-                  nruns=8))
+    default_main(challenge)
@@ -8,13 +8,14 @@ class NoIfNodeVisitor(ms.NodeVisitor):
     def visit_If(self, tree: ms.If):
         raise ms.IllegalStateError('If statements not allowed')
 
-class Level4Monitor(ms.ArithmeticOpRule, ms.UnaryOperatorRule, ms.LiteralRule, ms.AssignRule, ms.BaseMonitor):
+class Level4Monitor(ms.ArithmeticOpRule, ms.IndexRule, ms.UnaryOperatorRule, ms.LiteralRule, ms.AssignRule, ms.BaseMonitor):
     pass
 
+challenge = Challenge(name='extract boolean without using if',
+                      challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
+                      monitor=Level4Monitor,
+                      restrictions=NoIfNodeVisitor().visit,
+                      nruns=8)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='extract boolean without using if',
-                  challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
-                  monitor=Level4Monitor,
-                  restrictions=NoIfNodeVisitor().visit,
-                  nruns=8))
+    default_main(challenge)
@@ -6,19 +6,21 @@ import copy
 from common import Challenge, default_main
 
 
-class Level4Monitor(ms.ArithmeticOpRule, ms.UnaryOperatorRule, ms.LiteralRule, ms.AssignRule, ms.BaseMonitor):
+class Level4Monitor(ms.ArithmeticOpRule, ms.IndexRule, ms.UnaryOperatorRule, ms.LiteralRule, ms.AssignRule, ms.BaseMonitor):
     pass
 
 
 def setup(s: ms.Scope):
-    g = ms.GlobalScope()
-    s['print'] = g['print']
+    s['print'] = ms.builtin_scope['print']
+    s['push'] = ms.builtin_scope['push']
+    s['length'] = ms.builtin_scope['length']
 
 
+challenge = Challenge(name='extract boolean without using if',
+                      challenge=[('h', 'l', lambda: ms.TNumber(random.randint(1, 1000000007), label={'high'}))],
+                      monitor=Level4Monitor,
+                      setup=setup,
+                      nruns=8)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='extract boolean without using if',
-                  challenge=[('h', 'l', lambda: ms.TNumber(random.randint(1, 1000000007), label={'high'}))],
-                  monitor=Level4Monitor(),
-                  setup=setup,
-                  nruns=8))
+    default_main(challenge)
@@ -6,18 +6,20 @@ from common import Challenge, default_main
 
 
 def setup(s: ms.Scope):
-    g = ms.GlobalScope()
-    s['print'] = g['print']
-    s['labelPrint'] = g['labelPrint']
+    s['print'] = ms.builtin_scope['print']
+    s['push'] = ms.builtin_scope['push']
+    s['length'] = ms.builtin_scope['length']
+    s['labelPrint'] = ms.builtin_scope['labelPrint']
 
 #, ms.ReturnRule
-class ChallengeMonitor(ms.BlockAndLoopRule, ms.LiteralRule, ms.ArithmeticOpRule, ms.UnaryOperatorRule, ms.AssignRule, ms.BaseMonitor):
+class ChallengeMonitor(ms.BlockAndLoopRule, ms.LiteralRule, ms.ArithmeticOpRule, ms.IndexRule, ms.UnaryOperatorRule, ms.AssignRule, ms.BaseMonitor):
     pass
 
+challenge = Challenge(name='extract boolean',
+                      challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
+                      monitor=ChallengeMonitor,
+                      setup=setup,
+                      nruns=8)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='extract boolean',
-                  challenge=[('h', 'l', lambda: ms.TBoolean(random.choice((True, False)), label={'high'}))],
-                  monitor=ChallengeMonitor,
-                  setup=setup,
-                  nruns=8))
+    default_main(challenge)
@@ -6,17 +6,19 @@ from common import Challenge, default_main
 
 
 def setup(s: ms.Scope):
-    g = ms.GlobalScope()
-    s['print'] = g['print']
-    s['labelPrint'] = g['labelPrint']
+    s['print'] = ms.builtin_scope['print']
+    s['push'] = ms.builtin_scope['push']
+    s['length'] = ms.builtin_scope['length']
+    s['labelPrint'] = ms.builtin_scope['labelPrint']
 
 #, ms.ReturnRule
-class ChallengeMonitor(ms.BlockLoopReturnRule, ms.LiteralRule, ms.ArithmeticOpRule, ms.UnaryOperatorRule, ms.AssignRule, ms.BaseMonitor):
+class ChallengeMonitor(ms.BlockLoopReturnRule, ms.LiteralRule, ms.ArithmeticOpRule, ms.IndexRule, ms.UnaryOperatorRule, ms.AssignRule, ms.BaseMonitor):
     pass
 
+challenge = Challenge(name='final challenge',
+                      challenge=[('h', 'l', lambda: ms.TBoolean(random.randint(1, 1000000007), label={'high'}))],
+                      monitor=ChallengeMonitor,
+                      setup=setup)
+
 if __name__ == '__main__':
-    default_main(
-        Challenge(name='final challenge',
-                  challenge=[('h', 'l', lambda: ms.TBoolean(random.randint(1, 1000000007), label={'high'}))],
-                  monitor=ChallengeMonitor,
-                  setup=setup))
+    default_main(challenge)
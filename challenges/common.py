@@ -4,6 +4,41 @@ from typing import Optional, Callable, List, Tuple, Sequence
 import argparse
 
 
+class _SecretReader(ms.NodeVisitor):
+    """Finds instructions that might read one of `names`.
+    Calls are assumed to read them since the called function is not known statically.
+    """
+    def __init__(self, names):
+        self.names = set(names)
+
+    def __call__(self, instruction: ms.Code) -> bool:
+        try:
+            self.visit(instruction)
+        except StopIteration:
+            return True
+        return False
+
+    def visit_Name(self, tree: ms.Name):
+        if tree.name in self.names:
+            raise StopIteration()
+
+    def visit_Call(self, tree: ms.Call):
+        raise StopIteration()
+
+    def visit_FunctionDef(self, tree: ms.FunctionDef):
+        pass
+
+    def generic_visit(self, tree):
+        if isinstance(tree, list):
+            for e in tree:
+                self.visit(e)
+        else:
+            for f in tree._locals:
+                field = getattr(tree, f)
+                if isinstance(field, (ms.Code, ms.Stmt, list)):
+                    self.visit(field)
+
+
 class Challenge:
     def __init__(self,
                  name,
@@ -41,24 +76,55 @@ class Challenge:
             self._setup(s)
         return s
 
+    def compile(self, source: str) -> Optional[List[ms.Code]]:
+        """Parses `source` and checks the restrictions.
+        Returns the compiled code or None if forbidden syntax elements are used.
+        """
+        ast = ms.parse(source)
+        if self.restrictions and not self.restrictions(ast):
+            return None
+        return ms.compile(ast)
+
+    def run_once(self, code: Sequence[ms.Code], steps: Optional[int] = None) -> bool:
+        """Runs compiled code once against fresh secret values and checks the result.
+        :param steps: optional step budget for the interpreter
+        """
+        s = self.setup()
+        for h, l, g in self.challenge:
+            s.declare(l, ms.TUndefined())
+            s.declare(h, g())
+        interpreter = ms.Interpreter(code, s, self.monitor())
+        interpreter.run(steps)
+        return self.check(s)
+
+    def run_forked(self, code: Sequence[ms.Code], steps: Optional[int] = None) -> List[bool]:
+        """Runs compiled code `nruns` times and checks each result.
+        The part of the program before the secrets are first read is only run once,
+        the interpreter is then forked for every run.
+        """
+        s = self.setup()
+        for h, l, g in self.challenge:
+            s.declare(l, ms.TUndefined())
+            s.declare(h, ms.TUndefined())
+        interpreter = ms.Interpreter(code, s, self.monitor())
+        interpreter.run_until(_SecretReader(h for h, _, _ in self.challenge), steps)
+        results = []
+        for child in interpreter.fork(self.nruns):
+            for h, l, g in self.challenge:
+                child.scope.declare(h, g())
+            child.run(steps)
+            results.append(self.check(child.scope))
+        return results
+
     def run(self, source):
         passed = True
         try:
-            for i in range(self.nruns):
-                ast = ms.parse(source)
-                if not self.restrictions or self.restrictions(ast):
-                    code = ms.compile(ast)
-                    s = self.setup()
-                    for h, l, g in self.challenge:
-                        s.declare(l, ms.TUndefined())
-                        s.declare(h, g())
-                    interpreter = ms.Interpreter(code, s, self.monitor())
-                    interpreter.run()
-                    if not self.check(s):
-                        passed = False
-                else:
-                    print('you used forbidden syntax elements')
-                    passed = False
+            code = self.compile(source)
+            if code is None:
+                print('you used forbidden syntax elements')
+                passed = False
+            else:
+                passed = all(self.run_forked(code))
         except ms.InterpreterError as e:
             print(e)
             passed = False
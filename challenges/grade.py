@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""Bulk grading of many submissions against many challenges.
+
+Every `*.ms` file in the submission directory is parsed and compiled once per
+challenge. The individual (submission, challenge, run) jobs are then spread over
+a pool of worker processes which load the challenges once at startup.
+
+    python grade.py submissions/ -c 03 -c 05 -o report.json
+"""
+import os
+import sys
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+import argparse
+import concurrent.futures
+import contextlib
+import glob
+import importlib.util
+import io
+import json
+import signal
+import time
+from typing import Dict, List, Optional
+
+import miniscript as ms
+from miniscript.parser import CompileError
+from common import Challenge
+
+# challenges loaded in this process, by directory name
+_challenges: Dict[str, Challenge] = {}
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def find_challenges(selected: Optional[List[str]] = None) -> List[str]:
+    """Returns the challenge directory names, optionally filtered by name prefixes."""
+    names = sorted(os.path.basename(os.path.dirname(p)) for p in glob.glob(os.path.join(HERE, '*', 'challenge.py')))
+    if selected:
+        names = [n for n in names if any(n.startswith(s) for s in selected)]
+    return names
+
+
+def load_challenges(names: List[str]) -> Dict[str, Challenge]:
+    for name in names:
+        if name in _challenges:
+            continue
+        directory = os.path.join(HERE, name)
+        spec = importlib.util.spec_from_file_location(f'challenge_{len(_challenges)}',
+                                                      os.path.join(directory, 'challenge.py'))
+        module = importlib.util.module_from_spec(spec)
+        sys.path.insert(0, directory)
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            sys.path.remove(directory)
+        _challenges[name] = module.challenge
+    return _challenges
+
+
+def _on_timeout(signum, frame):
+    raise BudgetExceeded('time budget exceeded')
+
+
+def grade_job(challenge: str, code: List[ms.Code], steps: Optional[int], timeout: Optional[float]):
+    """Runs one graded run in a worker process and returns its result."""
+    start = time.perf_counter()
+    result = {'passed': False}
+    if timeout:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result['passed'] = bool(_challenges[challenge].run_once(code, steps))
+    except (ms.InterpreterError, BudgetExceeded) as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    except Exception as e:
+        result['error'] = f'crash: {type(e).__name__}: {e}'
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    result['time'] = time.perf_counter() - start
+    return result
+
+
+def compile_submission(source: str, challenges: Dict[str, Challenge]):
+    """Compiles a submission for every challenge.
+    Returns a mapping of challenge name to either the code or an error message.
+    """
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            ast = ms.parse(source)
+    except CompileError as e:
+        return {name: str(e) for name in challenges}
+    compiled = {}
+    for name, challenge in challenges.items():
+        try:
+            if challenge.restrictions and not challenge.restrictions(ast):
+                compiled[name] = 'you used forbidden syntax elements'
+            else:
+                compiled[name] = ms.compile(ast)
+        except ms.InterpreterError as e:
+            compiled[name] = str(e)
+    return compiled
+
+
+def grade(submissions: Dict[str, str],
+          names: List[str],
+          workers: Optional[int] = None,
+          steps: Optional[int] = None,
+          timeout: Optional[float] = None):
+    """Grades every submission against every named challenge.
+    :param submissions: mapping of submission name to source
+    :param names: challenge directory names
+    :param workers: size of the process pool, defaults to the number of cpus
+    :param steps: step budget per run
+    :param timeout: wall clock budget per run in seconds
+    """
+    challenges = {n: c for n, c in load_challenges(names).items() if n in names}
+    report: Dict[str, Dict[str, dict]] = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                initializer=load_challenges,
+                                                initargs=(names, )) as pool:
+        futures = {}
+        for submission, source in submissions.items():
+            report[submission] = {}
+            for name, code in compile_submission(source, challenges).items():
+                entry = report[submission][name] = {'passed': False, 'runs': []}
+                if isinstance(code, str):
+                    entry['error'] = code
+                    continue
+                for run in range(challenges[name].nruns):
+                    future = pool.submit(grade_job, name, code, steps, timeout)
+                    futures[future] = entry
+        for future in concurrent.futures.as_completed(futures):
+            futures[future]['runs'].append(future.result())
+    for results in report.values():
+        for entry in results.values():
+            entry['passed'] = bool(entry['runs']) and all(r['passed'] for r in entry['runs'])
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='grade a directory of submissions')
+    parser.add_argument('submissions', help='directory containing one .ms file per submission')
+    parser.add_argument('-c', '--challenge', action='append',
+                        help='challenge directory name or prefix. may be repeated. defaults to all challenges')
+    parser.add_argument('-o', '--output', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('-j', '--workers', type=int, help='number of worker processes')
+    parser.add_argument('--steps', type=int, default=1000000, help='step budget per run')
+    parser.add_argument('--timeout', type=float, default=10.0, help='time budget per run in seconds')
+    args = parser.parse_args()
+
+    submissions = {}
+    for path in sorted(glob.glob(os.path.join(args.submissions, '*.ms'))):
+        with open(path) as f:
+            submissions[os.path.basename(path)] = f.read()
+    names = find_challenges(args.challenge)
+
+    start = time.perf_counter()
+    report = grade(submissions, names, args.workers, args.steps, args.timeout)
+    report = {'challenges': names, 'elapsed': time.perf_counter() - start, 'submissions': report}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
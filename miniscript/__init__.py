@@ -2,3 +2,9 @@
 from .parser import *
 from .miniscript_ast import *
 from .interpreter import *
+from .labels import *
+from .output import *
+from .inputs import *
+from .jit import *
+from .events import *
+from .scheduler import *
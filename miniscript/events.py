@@ -0,0 +1,139 @@
+"""Execution events for debuggers, tracers and coverage tools, modeled on `sys.monitoring`.
+
+Listeners are registered on an `Events` object for one event type, either for every
+instruction or only for one instruction of the compiled code. Assigning the object to
+`Interpreter.events` makes `run` deliver the events, also from called functions:
+
+    events = Events()
+    events.register(Events.BRANCH, lambda interpreter, instruction, taken: print(instruction, taken))
+    interpreter.events = events
+    interpreter.run()
+
+An interpreter without listeners runs its usual loop, which never looks at events. While
+there are listeners, every step goes through `Events.run` and hot loops are not compiled.
+Listeners are called with the interpreter and the instruction followed by
+- INSTRUCTION: nothing, before the instruction is executed
+- BRANCH: whether the condition of a `ConditionalJump` was true
+- ASSIGN: the stored value
+- CALL: the function and the arguments, the location is the `Call` expression
+- RETURN: the function and its result, the location is the `Call` expression
+- FLOW_VIOLATION: the `FlowControlError`, before it propagates
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .miniscript_ast import *
+from .interpreter import (ExpressionEvaluator, FlowControlError, Interpreter, MaximumStepsReached, Type,
+                          _budget_message, _remaining)
+
+__all__ = ['Events']
+
+
+class Events:
+    INSTRUCTION = 'instruction'
+    BRANCH = 'branch'
+    ASSIGN = 'assign'
+    CALL = 'call'
+    RETURN = 'return'
+    FLOW_VIOLATION = 'flow_violation'
+    ALL = (INSTRUCTION, BRANCH, ASSIGN, CALL, RETURN, FLOW_VIOLATION)
+
+    def __init__(self):
+        self._listeners: Dict[str, List[Callable]] = {e: [] for e in self.ALL}
+        # listeners for single locations by id of the instruction, which is kept alive with them
+        self._at: Dict[str, Dict[int, Tuple[Stmt, List[Callable]]]] = {e: {} for e in self.ALL}
+
+    def register(self, event: str, callback: Callable, location: Optional[Stmt] = None):
+        """Calls `callback` for `event` at every instruction, or only at `location`, which is
+        an instruction of the compiled code such as `program.code[3]`, or a `Call` expression.
+        """
+        if event not in self._listeners:
+            raise ValueError(f'unknown event {event}')
+        if location is None:
+            self._listeners[event].append(callback)
+        else:
+            self._at[event].setdefault(id(location), (location, []))[1].append(callback)
+
+    def unregister(self, event: str, callback: Callable, location: Optional[Stmt] = None):
+        if location is None:
+            self._listeners[event].remove(callback)
+        else:
+            callbacks = self._at[event][id(location)][1]
+            callbacks.remove(callback)
+            if not callbacks:
+                del self._at[event][id(location)]
+
+    def active(self, event: str) -> bool:
+        return bool(self._listeners[event] or self._at[event])
+
+    def __bool__(self):
+        return any(map(self.active, self.ALL))
+
+    def fire(self, event: str, location: Stmt, *args):
+        for callback in self._listeners[event]:
+            callback(*args)
+        at = self._at[event].get(id(location))
+        if at is not None:
+            for callback in at[1]:
+                callback(*args)
+
+    def run(self, interpreter: Interpreter, steps: Optional[int] = None):
+        """Runs `interpreter` like `Interpreter.run` and delivers the events.
+        """
+        monitor = interpreter.monitor
+        outer = monitor.steps_left
+        budget = outer if steps is None else min(outer, steps)
+        monitor.steps_left = budget
+        code = interpreter.code
+        evaluator = interpreter.evaluator
+        # the evaluator passes the events on to called functions, so it is needed for any event
+        interpreter.evaluator = _EventEvaluator(interpreter, self)
+        instruction_events = self.active(Events.INSTRUCTION)
+        branch_events = self.active(Events.BRANCH)
+        assign_events = self.active(Events.ASSIGN)
+        try:
+            while True:
+                if monitor.steps_left <= 0:
+                    raise MaximumStepsReached(_budget_message(steps))
+                pc = interpreter.pc
+                if pc >= len(code):
+                    break
+                instruction = code[pc]
+                if instruction_events:
+                    self.fire(Events.INSTRUCTION, instruction, interpreter, instruction)
+                monitor.steps_left -= 1
+                try:
+                    if assign_events and isinstance(instruction, Assign):
+                        value = interpreter.assign(instruction)
+                        interpreter.pc += 1
+                        self.fire(Events.ASSIGN, instruction, interpreter, instruction, value)
+                    else:
+                        interpreter.step()
+                except FlowControlError as e:
+                    # errors from called functions were reported by their interpreter
+                    if not getattr(e, 'reported', False):
+                        e.reported = True
+                        self.fire(Events.FLOW_VIOLATION, instruction, interpreter, instruction, e)
+                    raise
+                if branch_events and isinstance(instruction, ConditionalJump):
+                    self.fire(Events.BRANCH, instruction, interpreter, instruction, interpreter.pc != pc + 1)
+        finally:
+            interpreter.evaluator = evaluator
+            monitor.steps_left = _remaining(outer, budget, monitor.steps_left)
+
+
+class _EventEvaluator(ExpressionEvaluator):
+    """Evaluator that reports calls and returns and passes the events on to called functions.
+    """
+    def __init__(self, interpreter: Interpreter, events: Events):
+        super().__init__(interpreter.scope, interpreter.monitor)
+        self.interpreter = interpreter
+        self.events = events
+
+    def visit_Call(self, tree: Call) -> Type:
+        func = self.visit(tree.func)
+        args = list(map(self.visit, tree.args))
+        self.monitor.handle_call(func, args)
+        self.events.fire(Events.CALL, tree, self.interpreter, tree, func, args)
+        result = func.call(args, self.monitor, self.events)
+        self.events.fire(Events.RETURN, tree, self.interpreter, tree, func, result)
+        return result
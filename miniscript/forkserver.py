@@ -0,0 +1,259 @@
+"""Pre-forking server for running scripts in isolated processes.
+
+The server process imports miniscript, builds the parser tables and warms up the
+interpreter once. It then forks a child for every request on a unix socket, so a
+request only pays for the fork instead of a fresh python process.
+
+Messages in both directions are JSON objects preceded by their length as a 4 byte
+big endian integer. A request looks like
+
+    {"source": "y = x * 2;", "bindings": {"x": {"value": 21, "label": ["alice"]}},
+     "budget": 100000, "timeout": 1.0}
+
+and the response contains the global variables, the printed output and an error
+message if the script failed. A scope larger than the response limit of the server is
+left out and reported as an error:
+
+    {"scope": {"y": {"type": "TNumber", "value": 42, "label": ["alice"]}},
+     "output": "", "error": null}
+"""
+import contextlib
+import gc
+import io
+import json
+import math
+import os
+import signal
+import socket
+import struct
+from typing import Any, Dict, Mapping, Optional
+
+from .interpreter import *
+
+__all__ = ['ForkServer', 'request', 'to_json', 'from_json']
+
+_HEADER = struct.Struct('>I')
+
+
+class TimeoutReached(InterpreterError):
+    pass
+
+
+class ResponseTooLarge(InterpreterError):
+    pass
+
+
+class _Limit:
+    """Bytes a response may still take, roughly as encoded by `json.dumps`.
+    """
+    # the keys and punctuation of a value
+    NODE = 40
+
+    def __init__(self, size: float):
+        self.left = size
+
+    def take(self, size: int):
+        self.left -= size
+        if self.left < 0:
+            raise ResponseTooLarge('the scope is too large to send')
+
+
+def to_json(value: Type, limit: Optional[_Limit] = None) -> Dict[str, Any]:
+    """Converts a value to a JSON compatible dict with its type, value and label.
+    Arrays that contain the same value twice convert it twice, so `limit` bounds the size
+    of the result, raising `ResponseTooLarge` when it is exceeded.
+    """
+    if limit is not None:
+        limit.take(_Limit.NODE + sum(map(len, value.label)))
+    if isinstance(value, TArray):
+        v: Any = [to_json(e, limit) for e in value]
+    elif isinstance(value, TObject):
+        v = {k: to_json(e, limit) for k, e in value.items()}
+    elif isinstance(value, TMap):
+        v = [[to_json(k, limit), to_json(e, limit)] for k, e in value.items()]
+    elif isinstance(value, TNumber) and math.isfinite(value.value):
+        v = value.value
+    elif isinstance(value, (TNull, TUndefined)):
+        v = None
+    else:
+        v = str(value)
+        if limit is not None:
+            limit.take(len(v))
+    return {'type': type(value).__name__, 'value': v, 'label': sorted(value.label)}
+
+
+def from_json(data: Mapping[str, Any]) -> Type:
+    """Creates a value from `{"value": ..., "label": [...]}`.
+    Numbers, booleans, strings, null, lists and objects are supported.
+    """
+    label = set(data.get('label', ()))
+    v = data.get('value')
+    if isinstance(v, bool):
+        return TBoolean(v, label)
+    elif isinstance(v, (int, float)):
+        return TNumber(v, label)
+    elif isinstance(v, str):
+        return TString(v, label)
+    elif isinstance(v, list):
+        return TArray([from_json(e if isinstance(e, dict) else {'value': e}) for e in v], label)
+    elif isinstance(v, dict):
+        return TObject({k: from_json(e if isinstance(e, dict) else {'value': e}) for k, e in v.items()}, label)
+    elif v is None:
+        return TNull(label)
+    raise ValueError(f'cannot convert {v!r}')
+
+
+def _send(conn: socket.socket, message: Mapping[str, Any]):
+    data = json.dumps(message).encode()
+    conn.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv_exactly(conn: socket.socket, n: int) -> bytes:
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('connection closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv(conn: socket.socket) -> Dict[str, Any]:
+    n, = _HEADER.unpack(_recv_exactly(conn, _HEADER.size))
+    return json.loads(_recv_exactly(conn, n))
+
+
+def _on_timeout(signum, frame):
+    raise TimeoutReached('time budget exceeded')
+
+
+class ForkServer:
+    """Forks a child per request on the unix socket at `path`.
+    :param budget: default step budget of a request
+    :param timeout: default time budget of a request in seconds
+    :param max_response: maximum size of the scope in a response in bytes
+    """
+    def __init__(self, path: str, budget: Optional[int] = 1000000, timeout: Optional[float] = 10.0,
+                 max_response: int = 10**7):
+        self.path = path
+        self.budget = budget
+        self.timeout = timeout
+        self.max_response = max_response
+
+    def preload(self):
+        """Warms up everything a child needs, so it is shared with the children after the fork.
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            Program.from_source('function f(x) { return x; } y = f(1) + "";').run(budget=100)
+        gc.collect()
+        # keep the preloaded objects out of future collections. otherwise the
+        # collector touches their pages in every child and they get copied
+        gc.freeze()
+
+    def serve_forever(self):
+        self.preload()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(128)
+        try:
+            while True:
+                conn, _ = sock.accept()
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        sock.close()
+                        self.handle(conn)
+                    except BaseException:
+                        status = 1
+                    finally:
+                        os._exit(status)
+                conn.close()
+                self._reap()
+        finally:
+            sock.close()
+
+    def _reap(self):
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+
+    def handle(self, conn: socket.socket):
+        """Runs the request on `conn` and sends the response. Called in the child.
+        """
+        req = _recv(conn)
+        _send(conn, self.execute(req))
+        conn.close()
+
+    def execute(self, req: Mapping[str, Any]) -> Dict[str, Any]:
+        budget = req.get('budget', self.budget)
+        timeout = req.get('timeout', self.timeout)
+        output = io.StringIO()
+        channel = Output(output)
+        response: Dict[str, Any] = {'scope': {}, 'output': '', 'error': None}
+        if timeout:
+            signal.signal(signal.SIGALRM, _on_timeout)
+            signal.setitimer(signal.ITIMER_REAL, timeout)
+        interpreter = None
+        try:
+            try:
+                with contextlib.redirect_stdout(output):
+                    bindings = {k: from_json(v) for k, v in req.get('bindings', {}).items()}
+                    interpreter = Program.from_source(req['source']).interpreter(bindings, output=channel)
+                    interpreter.run(budget)
+            except Exception as e:
+                # anything the script triggers, such as a RecursionError, is reported to the client
+                response['error'] = f'{type(e).__name__}: {e}'
+            if interpreter is not None:
+                # still under the timer, the size of the scope isn't bounded by the step budget
+                limit = _Limit(self.max_response)
+                response['scope'] = {
+                    k: to_json(v, limit) for k, v in interpreter.scope.names.items()
+                    if not isinstance(v, BuiltinFunction)
+                }
+        except Exception as e:
+            response['error'] = f'{type(e).__name__}: {e}'
+        finally:
+            channel.flush()
+            if timeout:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        response['output'] = output.getvalue()
+        return response
+
+
+def request(path: str,
+            source: str,
+            bindings: Optional[Mapping[str, Any]] = None,
+            budget: Optional[int] = None,
+            timeout: Optional[float] = None) -> Dict[str, Any]:
+    """Runs `source` on the fork server listening at `path` and returns the response.
+    :param bindings: input values in the format accepted by `from_json`
+    """
+    req: Dict[str, Any] = {'source': source, 'bindings': dict(bindings or {})}
+    if budget is not None:
+        req['budget'] = budget
+    if timeout is not None:
+        req['timeout'] = timeout
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.connect(path)
+        _send(conn, req)
+        return _recv(conn)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='miniscript fork server')
+    parser.add_argument('socket', help='path of the unix socket')
+    parser.add_argument('--run', metavar='FILE', help='send FILE to a running server instead of serving')
+    parser.add_argument('--budget', type=int, default=1000000, help='step budget per request')
+    parser.add_argument('--timeout', type=float, default=10.0, help='time budget per request in seconds')
+    args = parser.parse_args()
+    if args.run:
+        with open(args.run) as f:
+            print(json.dumps(request(args.socket, f.read(), budget=args.budget, timeout=args.timeout), indent=2))
+    else:
+        ForkServer(args.socket, args.budget, args.timeout).serve_forever()
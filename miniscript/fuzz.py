@@ -0,0 +1,326 @@
+"""Differential fuzzer for the monitor and the execution engines.
+
+`ProgramGenerator` writes random programs following the grammar of `MiniScriptParser`.
+Every program is compiled once and then run
+- by every engine in `ENGINES` under `Monitor`. The plain interpreter is the reference,
+  and the JIT, the event loop, resumable execution and a fork must end with the same
+  error, variables, labels and monitor counters.
+- without the rules, under `BaseMonitor`. Runs that the monitor accepts must compute
+  the same values without it.
+- twice with different values of the secret input `h`. If both runs finish, every
+  variable whose label doesn't contain `h` must have the same value in both
+  (termination insensitive noninterference).
+
+Runs that exhaust their step budget are not compared. Programs are fuzzed in worker
+processes forked from a parent that has built the parser tables and warmed up the
+interpreter, one process per core:
+
+    python -m miniscript.fuzz --seconds 60 [--workers N] [--seed S]
+"""
+import collections
+import copy
+import multiprocessing
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .parser import CompileError
+from .interpreter import *
+from .events import Events
+from .forkserver import to_json
+
+__all__ = ['ProgramGenerator', 'Finding', 'check_program', 'fuzz_program', 'fuzz']
+
+
+class ProgramGenerator:
+    """Random programs over the public inputs `a`, `b`, `c`, the secret input `h` and
+    the loop counters `i0`, `i1`, ..., see `inputs`.
+    Functions only call the functions defined before them and their loops count with local
+    variables, so every call terminates.
+    """
+    PUBLIC = ('a', 'b', 'c')
+    SECRET = 'h'
+    OPS = ('+', '-', '*', '/', '%', '<', '<=', '>', '>=', '==', '!=', '&&', '||')
+    STRINGS = ('""', '"s"', '"ab"')
+
+    def __init__(self, rng: random.Random, max_depth: int = 3, max_statements: int = 6):
+        self.rng = rng
+        self.max_depth = max_depth
+        self.max_statements = max_statements
+        self.functions: List[str] = []
+        self.names: Tuple[str, ...] = self.PUBLIC + (self.SECRET, )
+        self.counter = 'i'
+
+    @classmethod
+    def inputs(cls, secret: Type, depth: int = 3) -> Dict[str, Type]:
+        bindings: Dict[str, Type] = {'a': TNumber(2), 'b': TString('x'), 'c': TArray([TNumber(1), TNumber(2)])}
+        bindings.update({f'i{d}': TNumber(0) for d in range(depth + 1)})
+        bindings[cls.SECRET] = secret
+        return bindings
+
+    def program(self) -> str:
+        rng = self.rng
+        self.functions = []
+        lines = []
+        for i in range(rng.randint(0, 2)):
+            lines.append(self.function(f'f{i}'))
+            self.functions.append(f'f{i}')
+        lines += [self.statement(0) for _ in range(rng.randint(1, self.max_statements))]
+        return '\n'.join(lines)
+
+    def function(self, name: str) -> str:
+        names = self.names
+        self.names = names + ('x', )
+        self.counter = 'j'
+        locals_ = ' '.join(f'var j{d};' for d in range(1, self.max_depth + 1))
+        body = ' '.join(self.statement(1) for _ in range(self.rng.randint(0, 2)))
+        result = f'function {name}(x) {{ {locals_} {body} return {self.expr(1)}; }}'
+        self.names = names
+        self.counter = 'i'
+        return result
+
+    def statement(self, depth: int) -> str:
+        rng = self.rng
+        kind = rng.random() if depth < self.max_depth else 0
+        if kind < 0.45:
+            return f'{rng.choice(self.names)} = {self.expr(depth)};'
+        elif kind < 0.55:
+            return f'{rng.choice(self.names)}[{self.expr(depth + 1)}] = {self.expr(depth)};'
+        elif kind < 0.6 and self.functions:
+            return f'{rng.choice(self.functions)}({self.expr(depth)});'
+        elif kind < 0.8:
+            else_ = f' else {{ {self.block(depth + 1)} }}' if rng.random() < 0.5 else ''
+            return f'if ({self.expr(depth)}) {{ {self.block(depth + 1)} }}{else_}'
+        elif kind < 0.95 or self.counter != 'i':
+            i = f'{self.counter}{depth}'
+            return f'{i} = 0; while ({i} < {rng.randint(1, 20)}) {{ {self.block(depth + 1)} {i} = {i} + 1; }}'
+        return f'while ({self.expr(depth)}) {{ {self.block(depth + 1)} }}'
+
+    def block(self, depth: int) -> str:
+        return ' '.join(self.statement(depth) for _ in range(self.rng.randint(1, 3)))
+
+    def expr(self, depth: int) -> str:
+        rng = self.rng
+        kind = rng.random() if depth < self.max_depth else rng.random() * 0.5
+        if kind < 0.15:
+            return str(rng.randint(0, 9))
+        elif kind < 0.2:
+            return rng.choice(('true', 'false', 'null', 'undefined'))
+        elif kind < 0.25:
+            return rng.choice(self.STRINGS)
+        elif kind < 0.5:
+            return rng.choice(self.names)
+        elif kind < 0.75:
+            return f'({self.expr(depth + 1)} {rng.choice(self.OPS)} {self.expr(depth + 1)})'
+        elif kind < 0.8:
+            return f'{rng.choice("-!")}({self.expr(depth + 1)})'
+        elif kind < 0.85:
+            return f'[{", ".join(self.expr(depth + 1) for _ in range(rng.randint(0, 3)))}]'
+        elif kind < 0.9:
+            return f'{rng.choice(self.names)}[{self.expr(depth + 1)}]'
+        elif kind < 0.95 and self.functions:
+            return f'{rng.choice(self.functions)}({self.expr(depth + 1)})'
+        return f'{rng.choice(("length", "label"))}({self.expr(depth + 1)})'
+
+
+class Finding(NamedTuple):
+    # 'engine', 'monitor', 'interference', 'crash' or 'parse'
+    kind: str
+    seed: int
+    source: str
+    detail: str
+
+
+def _plain(interpreter: Interpreter) -> Interpreter:
+    interpreter.jit = False
+    return interpreter
+
+
+def _jit(interpreter: Interpreter) -> Interpreter:
+    # compile loops after a few iterations, the generated loops are short
+    interpreter.hot_loop = 2
+    return interpreter
+
+
+def _events(interpreter: Interpreter) -> Interpreter:
+    events = Events()
+    for event in Events.ALL:
+        events.register(event, lambda *args: None)
+    interpreter.events = events
+    return interpreter
+
+
+def _fork(interpreter: Interpreter) -> Interpreter:
+    return interpreter.fork()[0]
+
+
+def _run_resumable(interpreter: Interpreter, budget: int):
+    # resumable execution counts the steps of calls and returns differently, so give it some slack
+    if not interpreter.step_chunk(budget * 4):
+        raise MaximumStepsReached(f'reached maximum of {budget * 4} steps')
+
+
+# engines by name as the function preparing a fresh interpreter and the function running it.
+# the first one is the reference
+ENGINES: Dict[str, Tuple[Callable[[Interpreter], Interpreter], Callable[[Interpreter, int], Any]]] = {
+    'interpreter': (_plain, Interpreter.run),
+    'jit': (_jit, Interpreter.run),
+    'events': (_events, Interpreter.run),
+    'resumable': (_plain, _run_resumable),
+    'fork': (_fork, Interpreter.run),
+}
+
+# errors that are expected of generated programs, all others are reported as crashes
+EXPECTED_ERRORS = (InterpreterError, NotYetImplementedError, ArithmeticError, RecursionError)
+
+Outcome = Tuple[Optional[str], Dict[str, Any], Dict[str, int]]
+
+
+def _run(program: Program, engine: str, bindings: Dict[str, Type], monitor: BaseMonitor, budget: int) -> Outcome:
+    setup, run = ENGINES[engine]
+    interpreter = setup(program.interpreter(bindings, monitor))
+    error = None
+    try:
+        run(interpreter, budget)
+    except EXPECTED_ERRORS as e:
+        error = type(e).__name__
+    except Exception as e:
+        error = f'crash: {type(e).__name__}: {e}'
+    scope = {k: _dump(v) for k, v in interpreter.scope.names.items() if not isinstance(v, TFunction)}
+    return error, scope, interpreter.monitor.stats()
+
+
+def _dump(value: Type, depth: int = 6) -> Dict[str, Any]:
+    """`to_json` of `value` with arrays and objects cut off below `depth`, as they may
+    contain themselves or share elements exponentially often.
+    """
+    if isinstance(value, (TArray, TObject)):
+        if not depth:
+            return {'type': 'deep', 'value': None, 'label': []}
+        elements = value.items() if isinstance(value, TObject) else enumerate(value)
+        v: Any = {k: _dump(e, depth - 1) for k, e in elements}
+        if isinstance(value, TArray):
+            v = list(v.values())
+        return {'type': type(value).__name__, 'value': v, 'label': sorted(value.label)}
+    return to_json(value)
+
+
+def _values(scope: Dict[str, Any], secret: Optional[str] = None) -> Dict[str, Any]:
+    """Types and values of the variables in `scope` without labels.
+    Values, elements and fields labeled with `secret` are left out.
+    """
+    def strip(v):
+        if secret in v['label']:
+            return 'secret'
+        value = v['value']
+        if isinstance(value, list):
+            value = [strip(e) for e in value]
+        elif isinstance(value, dict):
+            value = {k: strip(e) for k, e in value.items()}
+        return v['type'], value
+
+    return {k: strip(v) for k, v in scope.items()}
+
+
+# pairs of values of the secret, all labeled with the secret
+SECRETS = [(TNumber(0), TNumber(7)), (TBoolean(True), TBoolean(False)), (TString(''), TString('s')),
+           (TNumber(1), TArray([TNumber(3)]))]
+
+
+def check_program(source: str, secrets: Tuple[Type, Type], seed: int = 0, budget: int = 2000,
+                  monitor: Callable[[], BaseMonitor] = Monitor) -> Tuple[int, List[Finding]]:
+    """Compiles `source` once and runs all checks on it, with the values in `secrets` for the
+    secret input. Returns the number of executions and the findings.
+    :param monitor: creates the monitor under test
+    """
+    try:
+        program = Program.from_source(source)
+    except CompileError as e:
+        return 0, [Finding('parse', seed, source, f'{type(e).__name__}: {e}')]
+    findings = []
+    secret = ProgramGenerator.SECRET
+    low, high = [copy.deepcopy(v) for v in secrets]
+    low.label = high.label = {secret}
+    inputs = ProgramGenerator.inputs(low)
+    reference = _run(program, 'interpreter', inputs, monitor(), budget)
+    if reference[0] == 'MaximumStepsReached':
+        # nothing to compare
+        return 1, findings
+    if reference[0] and reference[0].startswith('crash'):
+        # where the other engines stop after the crash isn't defined
+        return 1, [Finding('crash', seed, source, reference[0])]
+    outcomes = {engine: _run(program, engine, inputs, monitor(), budget) for engine in list(ENGINES)[1:]}
+    executions = len(outcomes) + 1
+    for name, outcome in outcomes.items():
+        if outcome != reference and outcome[0] != 'MaximumStepsReached':
+            findings.append(Finding('engine', seed, source, f'{name}: {outcome} != {reference}'))
+    if reference[0] is None:
+        unmonitored = _run(program, 'interpreter', inputs, BaseMonitor(), budget)
+        other = _run(program, 'interpreter', ProgramGenerator.inputs(high), monitor(), budget)
+        executions += 2
+        if unmonitored[0] is None and _values(unmonitored[1]) != _values(reference[1]):
+            findings.append(Finding('monitor', seed, source, f'{_values(reference[1])} != {_values(unmonitored[1])}'))
+        if other[0] is None and _values(reference[1], secret) != _values(other[1], secret):
+            findings.append(Finding('interference', seed, source,
+                                    f'h={low!r}: {_values(reference[1], secret)}, h={high!r}: {_values(other[1], secret)}'))
+    return executions, findings
+
+
+def fuzz_program(seed: int, budget: int = 2000) -> Tuple[int, List[Finding]]:
+    """Generates the program for `seed` and checks it, see `check_program`."""
+    rng = random.Random(seed)
+    source = ProgramGenerator(rng).program()
+    return check_program(source, rng.choice(SECRETS), seed, budget)
+
+
+def _work(args: Tuple[int, int, float, int]) -> Tuple[int, int, List[Finding]]:
+    start, step, deadline, budget = args
+    programs = executions = 0
+    findings = []
+    seed = start
+    while time.monotonic() < deadline:
+        n, f = fuzz_program(seed, budget)
+        programs += 1
+        executions += n
+        findings += f
+        seed += step
+    return programs, executions, findings
+
+
+def fuzz(seconds: float, workers: Optional[int] = None, seed: int = 0,
+         budget: int = 2000) -> Tuple[int, int, List[Finding]]:
+    """Fuzzes programs for `seconds` in `workers` processes, by default one per core.
+    Worker `i` checks the seeds `seed + i`, `seed + i + workers`, ...
+    Returns the number of programs, the number of executions and the findings.
+    """
+    workers = workers or os.cpu_count() or 1
+    # build the parser tables and compile the engines' code paths before forking
+    fuzz_program(seed, budget)
+    deadline = time.monotonic() + seconds
+    jobs = [(seed + i, workers, deadline, budget) for i in range(workers)]
+    if workers == 1:
+        results = [_work(jobs[0])]
+    else:
+        context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+        with context.Pool(workers) as pool:
+            results = pool.map(_work, jobs)
+    programs = sum(r[0] for r in results)
+    executions = sum(r[1] for r in results)
+    return programs, executions, [f for r in results for f in r[2]]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='differential fuzzer for miniscript')
+    parser.add_argument('--seconds', type=float, default=10, help='time to fuzz for')
+    parser.add_argument('--workers', type=int, help='number of processes, one per core by default')
+    parser.add_argument('--seed', type=int, default=0, help='first seed')
+    parser.add_argument('--budget', type=int, default=2000, help='step budget per run')
+    args = parser.parse_args()
+    programs, executions, findings = fuzz(args.seconds, args.workers, args.seed, args.budget)
+    for finding in findings:
+        print(f'{finding.kind} (seed {finding.seed}): {finding.detail}\n{finding.source}\n')
+    kinds = collections.Counter(f.kind for f in findings)
+    print(f'{programs} programs, {executions} executions, {executions / args.seconds:.0f} executions/s, '
+          f'{len(findings)} findings {dict(kinds)}')
@@ -0,0 +1,170 @@
+"""Input files that scripts read one item at a time.
+
+The host approves files under a name and assigns each a label. Scripts call
+`read(name)`, which returns the next line, record or chunk of the file labeled
+with the label of the source, or undefined at the end:
+
+    inputs = Inputs()
+    inputs.allow('log', '/var/log/app.log', label={'ops'})
+    inputs.allow('people', 'people.csv', label={'hr'}, kind='records')
+    Program.from_source('n = 0; l = read("log"); while (l != undefined) { n = n + 1; l = read("log"); }') \\
+        .run(inputs=inputs)
+
+Files are opened on the first read and read through a buffer or, with `use_mmap`, a
+read-only memory map, so only the current item is held in memory. Reading moves the
+position in the file, so the monitor only allows reads where the pc level flows to
+the label of the source (see `IndexRule.check_read`).
+"""
+import codecs
+import mmap
+from typing import Dict, Iterable, List, Optional, Union
+
+__all__ = ['Inputs', 'Source']
+
+Item = Union[str, List[str]]
+
+
+class Source:
+    """A file approved by the host.
+    :param label: label of everything read from the file
+    :param kind: what `read` returns: 'lines' without the line break, 'records' as the
+        list of the fields of a line split at `delimiter`, or 'chunks' of `chunk_size` bytes
+    :param use_mmap: read through a memory map instead of a buffered file
+    """
+    KINDS = ('lines', 'records', 'chunks')
+
+    def __init__(self, path: str, label: Iterable[str] = (), kind: str = 'lines', delimiter: str = ',',
+                 chunk_size: int = 1 << 16, encoding: str = 'utf-8', use_mmap: bool = False):
+        if kind not in self.KINDS:
+            raise ValueError(f'unknown kind of input {kind}')
+        self.path = path
+        self.label = set(label)
+        self.kind = kind
+        self.delimiter = delimiter
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+        self.use_mmap = use_mmap
+
+    def open(self, offset: int = 0) -> '_Reader':
+        f = open(self.path, 'rb')
+        if self.use_mmap:
+            try:
+                return _MappedReader(self, f, offset)
+            except ValueError:
+                # empty files can't be mapped
+                pass
+        return _Reader(self, f, offset)
+
+
+class _Reader:
+    """Position in a source read through a buffered file."""
+    def __init__(self, source: Source, f, offset: int):
+        self.source = source
+        self.decoder = codecs.getincrementaldecoder(source.encoding)('replace')
+        self.f = f
+        self.seek(offset)
+
+    def seek(self, offset: int):
+        self.f.seek(offset)
+
+    @property
+    def offset(self) -> int:
+        return self.f.tell()
+
+    def position(self) -> int:
+        """Offset of the next byte that wasn't returned yet."""
+        return self.offset - len(self.decoder.getstate()[0])
+
+    def line(self) -> bytes:
+        return self.f.readline()
+
+    def chunk(self) -> bytes:
+        return self.f.read(self.source.chunk_size)
+
+    def close(self):
+        self.f.close()
+
+
+class _MappedReader(_Reader):
+    def __init__(self, source: Source, f, offset: int):
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        super().__init__(source, f, offset)
+
+    def seek(self, offset: int):
+        self.pos = offset
+
+    @property
+    def offset(self) -> int:
+        return self.pos
+
+    def line(self) -> bytes:
+        end = self.map.find(b'\n', self.pos)
+        end = len(self.map) if end < 0 else end + 1
+        data = self.map[self.pos:end]
+        self.pos = end
+        return data
+
+    def chunk(self) -> bytes:
+        data = self.map[self.pos:self.pos + self.source.chunk_size]
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.map.close()
+        self.f.close()
+
+
+class Inputs:
+    """The sources a run may read, by name, and the current position in each of them.
+    Close it, or use it as a context manager, to close the files.
+    """
+    def __init__(self):
+        self.sources: Dict[str, Source] = {}
+        self._readers: Dict[str, _Reader] = {}
+
+    def allow(self, name: str, path: str, label: Iterable[str] = (), **options) -> Source:
+        """Approves the file at `path` under `name`, see `Source` for the options."""
+        source = self.sources[name] = Source(path, label, **options)
+        return source
+
+    def read(self, name: str) -> Optional[Item]:
+        """Returns the next item of the source `name` or None at its end.
+        Raises KeyError for names that weren't allowed.
+        """
+        reader = self._readers.get(name)
+        if reader is None:
+            reader = self._readers[name] = self.sources[name].open()
+        source = reader.source
+        if source.kind == 'chunks':
+            # the decoder keeps a character split between two chunks for the next one
+            text = ''
+            while not text:
+                data = reader.chunk()
+                text = reader.decoder.decode(data, final=not data)
+                if not data:
+                    break
+            return text or None
+        data = reader.line()
+        if not data:
+            return None
+        line = data.decode(source.encoding, 'replace').rstrip('\r\n')
+        return line.split(source.delimiter) if source.kind == 'records' else line
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
+
+    def __deepcopy__(self, memo):
+        # forks of an interpreter continue reading from the same positions independently
+        copy = Inputs()
+        copy.sources = dict(self.sources)
+        copy._readers = {name: r.source.open(r.position()) for name, r in self._readers.items()}
+        return copy
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
@@ -1,9 +1,19 @@
 from .miniscript_ast import *
 from .parser import parse
+from .labels import principals, mask_vector
+from .output import Output
+from .inputs import Inputs
 
+import array
 import math
 import copy
-from typing import Optional, MutableMapping as Mapping, Sequence, TypeVar, List, Callable
+import hashlib
+import inspect
+import io
+import pickle
+import struct
+import zlib
+from typing import Optional, MutableMapping as Mapping, Sequence, TypeVar, List, Callable, Iterable, Dict, Tuple, Union, Set
 import itertools
 
 T = TypeVar('T')
@@ -33,6 +43,14 @@ class MaximumStepsReached(InterpreterError):
     pass
 
 
+class SnapshotError(InterpreterError):
+    pass
+
+
+class InputError(InterpreterError):
+    pass
+
+
 class ReturnStatement(InterpreterError):
     def __init__(self, value: 'Type', r: Return):
         super().__init__(f'unexpected return {r}')
@@ -49,9 +67,26 @@ class Type:
     def number(self) -> 'TNumber':
         return TNumber(float('nan'))
 
-    def call(self, args: List['Type']) -> 'Type':
+    def call(self, args: List['Type'], monitor: Optional['BaseMonitor'] = None,
+             events: Optional['Events'] = None) -> 'Type':
         raise UnsupportedOperationError('not a function')
 
+    def call_iter(self, args: List['Type'], monitor: 'BaseMonitor'):
+        """Generator version of `call` used for resumable execution.
+        Yields None after every executed step and awaitables that have to be awaited
+        by the driver, which sends their result back. Returns the result of the call.
+        """
+        return self.call(args, monitor)
+        yield
+
+    def reference(self, label) -> 'Type':
+        """This value with `label`, see `_Container` for arrays, objects and dicts.
+        Other values are immutable, so a copy does.
+        """
+        value = copy.copy(self)
+        value.label = label
+        return value
+
     @property
     def label(self):
         return getattr(self, '_label', set())
@@ -87,7 +122,7 @@ class TNull(Type):
         return TString('null')
 
     def number(self):
-        return Number(0)
+        return TNumber(0)
 
     def __eq__(self, other):
         return type(self) == type(other)
@@ -100,7 +135,7 @@ class TFunction(Type):
     def string(self):
         return TString(self.name or '<anonymous>')
 
-    def call(self, args: List[Type]):
+    def call(self, args: List[Type], monitor: Optional['BaseMonitor'] = None, events: Optional['Events'] = None):
         raise NotYetImplementedError()
 
     def __repr__(self):
@@ -144,15 +179,54 @@ class TBoolean(TNumber):
 
 
 class TString(Type):
+    """String value.
+    Concatenation appends the right operand to a list of pieces that is shared with the
+    left operand, so building a string in a loop takes linear time. The pieces are only
+    joined when `value` is needed.
+    """
     def __init__(self, value: str, label=set()):
-        self.value = value
+        self._pieces = [value]
+        self._n = 1
+        self._value = value
         self.label = label
 
+    @property
+    def value(self) -> str:
+        if self._value is None:
+            self._value = ''.join(itertools.islice(self._pieces, self._n))
+        return self._value
+
+    def concat(self, other: 'TString', label=set()) -> 'TString':
+        """`self + other` with the given label.
+        """
+        piece = other.value
+        pieces, n = self._pieces, self._n
+        if len(pieces) == n:
+            pieces.append(piece)
+        else:
+            # another string built on the same pieces has been appended to already
+            pieces = pieces[:n] + [piece]
+        s = object.__new__(TString)
+        s._pieces, s._n, s._value, s.label = pieces, n + 1, None, label
+        return s
+
+    def __copy__(self):
+        s = object.__new__(TString)
+        s.__dict__.update(self.__dict__)
+        return s
+
+    def __deepcopy__(self, memo):
+        # strings are immutable, so copies can share their pieces
+        return self.__copy__()
+
+    def __reduce__(self):
+        return TString, (self.value, self.label)
+
     def number(self):
         try:
-            return Number(int(self.value))
-        except ValueError as e:
-            return super(self).number()
+            return TNumber(int(self.value))
+        except ValueError:
+            return super().number()
 
     def string(self):
         return self
@@ -165,60 +239,611 @@ class TString(Type):
         return f'{type(self).__name__}({self.value}, {self.label})'
 
 
-class TArray(Type):
-    def __init__(self, values: Sequence[Type], label=set()):
-        self.values = values
+class _Container(Type):
+    """Base of the mutable values: arrays, objects and dicts.
+    They are references, assigning one binds the same container. A reference with a higher
+    label shares the `__dict__` with the contents, only the label is kept per reference.
+    """
+    __slots__ = ('label', )
+
+    def reference(self, label) -> '_Container':
+        cell = self.__dict__
+        if '_cell_label' not in cell:
+            cell['_cell_label'] = self.label
+        ref = object.__new__(type(self))
+        ref.__dict__ = cell
+        ref.label = label
+        return ref
+
+    @property
+    def cell_label(self):
+        """Label of the container itself. It is the label of every reference that wasn't raised.
+        """
+        return self.__dict__.get('_cell_label', self.label)
+
+    def string(self) -> TString:
+        return TString(_nested_string(self))
+
+    def string_parts(self) -> List[Union[str, Type]]:
+        """The text of the container as strings and the elements that are converted in their place.
+        """
+        raise NotImplementedError()
+
+    def __getstate__(self):
+        # the contents are pickled once for all references to them
+        return self.__dict__, self.label
+
+    def __setstate__(self, state):
+        self.__dict__, self.label = state
+
+
+class TArray(_Container):
+    """Array of values.
+    Arrays of only integers or only floats are packed into a typed buffer with the labels
+    of the elements kept separately: one label shared by all elements, or a vector with the
+    label of each element as a bitmask (see `labels.py`). They are converted to a list of
+    boxed values when anything else is stored or `values` is accessed.
+    """
+    def __init__(self, values: Sequence[Type] = (), label=set()):
         self.label = label
+        self._items = array.array('q')
+        # label of every element, unless the elements have different labels and their
+        # masks are stored in `_masks`
+        self._element_labels = set()
+        self._masks = None
+        self.extend(values)
+
+    @property
+    def packed(self) -> bool:
+        return not isinstance(self._items, list)
+
+    @property
+    def values(self) -> List[Type]:
+        """The elements as a list of boxed values. Unpacks the array.
+        """
+        if self.packed:
+            self._items = list(self)
+            self._element_labels = self._masks = None
+        return self._items
+
+    @values.setter
+    def values(self, values: Sequence[Type]):
+        self._items = list(values)
+        self._element_labels = self._masks = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return True
+
+    def __iter__(self):
+        if not self.packed:
+            return iter(self._items)
+        elif self._masks is not None:
+            return map(TNumber, self._items, map(principals.label, self._masks))
+        return (TNumber(v, self._element_labels) for v in self._items)
+
+    @classmethod
+    def _from_buffer(cls, items: array.array, element_labels, masks=None, label=set()) -> 'TArray':
+        a = object.__new__(cls)
+        a.label, a._items, a._element_labels, a._masks = label, items, element_labels, masks
+        return a
+
+    def element_labels(self) -> List[set]:
+        """Labels whose union is the union of the labels of the elements.
+        """
+        if self.packed:
+            if self._masks is not None:
+                return [principals.label(principals.join(self._masks))]
+            return [self._element_labels] if self._items else []
+        # labels are shared between many elements, it's enough to look at each set once
+        return list({id(v.label): v.label for v in self._items}.values())
+
+    def numbers(self) -> Sequence:
+        """The elements converted to python numbers.
+        """
+        if self.packed:
+            return self._items
+        return [v.number().value for v in self._items]
+
+    def slice(self, start: int, end: int, label=set()) -> 'TArray':
+        if not self.packed:
+            return TArray(self._items[start:end], label)
+        masks = self._masks[start:end] if self._masks is not None else None
+        return TArray._from_buffer(self._items[start:end], self._element_labels, masks, label)
+
+    def _typecode(self, value: Type) -> Optional[str]:
+        if type(value) is TNumber:
+            v = value.value
+            if type(v) is float:
+                return 'd'
+            elif type(v) is int and -2**63 <= v < 2**63:
+                return 'q'
+        return None
+
+    def _pack(self, i: int, value: Type) -> bool:
+        """Stores `value` at `i` (or appends it when `i` is the length) if it fits the buffer.
+        """
+        typecode = self._typecode(value)
+        if typecode is None:
+            return False
+        n = len(self._items)
+        if typecode != self._items.typecode:
+            if n:
+                return False
+            self._items = array.array(typecode)
+        if self._masks is None and self._element_labels != value.label:
+            if n == 0 or n == 1 and i == 0:
+                self._element_labels = value.label
+            else:
+                self._masks = mask_vector([principals.mask(self._element_labels)]) * n
+                self._element_labels = None
+        if i == n:
+            self._items.append(value.value)
+        else:
+            self._items[i] = value.value
+        if self._masks is not None:
+            self._set_mask(i, value.label)
+        return True
+
+    def _set_mask(self, i: int, label):
+        m = principals.mask(label)
+        try:
+            if i == len(self._masks):
+                self._masks.append(m)
+            else:
+                self._masks[i] = m
+        except OverflowError:
+            # more than 64 principals
+            self._masks = list(self._masks)
+            self._set_mask(i, label)
+
+    def append(self, value: Type):
+        if not self.packed or not self._pack(len(self._items), value):
+            self.values.append(value)
+
+    def extend(self, values: Iterable[Type]):
+        for v in values:
+            self.append(v)
 
     def number(self) -> TNumber:
-        if len(self.values) == 1:
-            return self.values[0].number()
+        if len(self) == 1:
+            return self.get(TNumber(0)).number()
         else:
             return super().number()
 
-    def string(self) -> TString:
-        if not self.values: return TString('')
-        elif len(self.values) == 1: return self.values[0].string()
+    def string_parts(self) -> List[Union[str, Type]]:
+        if not len(self): return []
+        elif len(self) == 1: return [self.get(TNumber(0))]
+        elif self.packed and self._items.typecode == 'q':
+            return [f'[{", ".join(map(str, self._items))}]']
+        parts = ['[']
+        for v in self:
+            parts += (v, ', ')
+        parts[-1] = ']'
+        return parts
+
+    def __eq__(self, other):
+        if not isinstance(other, TArray):
+            return False
+        elif self.packed and other.packed:
+            return self._items == other._items
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __copy__(self):
+        # arrays are mutable, a copy must not share the elements
+        a = object.__new__(TArray)
+        a.label = self.label
+        a._items = self._items[:]
+        a._element_labels = self._element_labels
+        a._masks = self._masks[:] if self._masks is not None else None
+        return a
+
+    def __getstate__(self):
+        # bits are only valid in this process, the table comes along to translate them
+        return self.__dict__, self.label, principals
+
+    def __setstate__(self, state):
+        cell, self.label, table = state
+        self.__dict__ = cell
+        if self._masks is not None:
+            table.translate(cell)
+
+    def get(self, key: Type) -> Type:
+        i = _array_index(key)
+        if i is None or i >= len(self._items):
+            return TUndefined()
+        elif not self.packed:
+            return self._items[i]
+        if self._masks is not None:
+            return TNumber(self._items[i], principals.label(self._masks[i]))
+        return TNumber(self._items[i], self._element_labels)
+
+    def set(self, key: Type, value: Type):
+        i = _array_index(key)
+        if i is None:
+            raise UnsupportedOperationError(f'invalid array index {key}')
+        if i > len(self._items):
+            self.extend(TUndefined() for _ in range(i - len(self._items)))
+        if not self.packed or not self._pack(i, value):
+            if i == len(self.values):
+                self.values.append(value)
+            else:
+                self.values[i] = value
+
+    def __repr__(self):
+        return f'{type(self).__name__}({repr(list(self))}, {self.label})'
+
+
+class Shape:
+    """Layout of the fields of objects.
+    Objects that got the same fields in the same order share one shape, which maps field
+    names to slots. Shapes are immutable, adding a field moves an object to the next shape.
+    """
+    def __init__(self, fields: Tuple[str, ...] = ()):
+        self.fields = fields
+        self.index = {f: i for i, f in enumerate(fields)}
+        self._transitions: Dict[str, Shape] = {}
+
+    def add(self, name: str) -> 'Shape':
+        shape = self._transitions.get(name)
+        if shape is None:
+            shape = self._transitions.setdefault(name, Shape(self.fields + (name, )))
+        return shape
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return _shape, (self.fields, )
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.fields})'
+
+
+_EMPTY_SHAPE = Shape()
+
+
+def _shape(fields: Tuple[str, ...]) -> Shape:
+    shape = _EMPTY_SHAPE
+    for f in fields:
+        shape = shape.add(f)
+    return shape
+
+
+class TObject(_Container):
+    """Record with named fields.
+    Every field value keeps its own label, the label of the object covers which fields exist.
+    Field access from an `Attribute` node caches `(shape, slot, next shape)` on the node,
+    so repeated access to objects of the same shape skips the lookup of the name.
+    """
+    def __init__(self, fields: Optional[Mapping[str, Type]] = None, label=set()):
+        self.label = label
+        self.shape = _EMPTY_SHAPE
+        self.slots: List[Type] = []
+        for name, value in (fields or {}).items():
+            self.set_attr(name, value)
+
+    def get_attr(self, name: str, site: Optional[Attribute] = None) -> Type:
+        cache = site.cache if site is not None else None
+        if cache is not None and cache[0] is self.shape and cache[2] is None:
+            return self.slots[cache[1]]
+        i = self.shape.index.get(name)
+        if i is None:
+            return TUndefined()
+        if site is not None:
+            site.cache = (self.shape, i, None)
+        return self.slots[i]
+
+    def set_attr(self, name: str, value: Type, site: Optional[Attribute] = None):
+        cache = site.cache if site is not None else None
+        if cache is not None and cache[0] is self.shape:
+            _, i, next_shape = cache
+        else:
+            i = self.shape.index.get(name)
+            next_shape = None
+            if i is None:
+                i, next_shape = len(self.slots), self.shape.add(name)
+            if site is not None:
+                site.cache = (self.shape, i, next_shape)
+        if next_shape is None:
+            self.slots[i] = value
         else:
-            return TString(f'[{", ".join(map(str, self.values))}]')
+            self.shape = next_shape
+            self.slots.append(value)
+
+    def items(self):
+        return zip(self.shape.fields, self.slots)
+
+    def string_parts(self) -> List[Union[str, Type]]:
+        parts = ['{']
+        for k, v in self.items():
+            parts += (f'{k}: ', v, ', ')
+        parts[-1:] = ['}'] if len(parts) > 1 else ['{}']
+        return parts
 
     def __eq__(self, other):
-        return self.values == other.values
+        if not isinstance(other, TObject):
+            return False
+        return dict(self.items()) == dict(other.items())
+
+    def __copy__(self):
+        o = object.__new__(TObject)
+        o.label, o.shape, o.slots = self.label, self.shape, list(self.slots)
+        return o
 
     def __repr__(self):
-        return f'{type(self).__name__}({repr(self.values)}, {self.label})'
+        return f'{type(self).__name__}({dict(self.items())}, {self.label})'
+
+
+class TMap(_Container):
+    """Hash map from primitive values to values.
+    Keys are compared by type and value. The label of the map covers which keys exist,
+    the labels of the stored keys and values are kept.
+    """
+    def __init__(self, entries: Iterable[Tuple[Type, Type]] = (), label=set()):
+        self.label = label
+        self.entries: Dict[tuple, Tuple[Type, Type]] = {}
+        for k, v in entries:
+            self.set(k, v)
+
+    @staticmethod
+    def hash_key(key: Type) -> tuple:
+        if isinstance(key, (TArray, TObject, TMap, TFunction)):
+            raise UnsupportedOperationError(f'{type(key).__name__} cannot be used as a key')
+        return type(key), getattr(key, 'value', None)
+
+    def get(self, key: Type) -> Type:
+        entry = self.entries.get(self.hash_key(key))
+        return TUndefined() if entry is None else entry[1]
+
+    def has(self, key: Type) -> bool:
+        return self.hash_key(key) in self.entries
+
+    def set(self, key: Type, value: Type):
+        self.entries[self.hash_key(key)] = (key, value)
+
+    def delete(self, key: Type) -> bool:
+        return self.entries.pop(self.hash_key(key), None) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __bool__(self):
+        return True
+
+    def items(self):
+        return self.entries.values()
+
+    def string_parts(self) -> List[Union[str, Type]]:
+        parts = ['{']
+        for k, v in self.items():
+            parts += (f'{k}: ', v, ', ')
+        parts[-1:] = ['}'] if len(parts) > 1 else ['{}']
+        return parts
+
+    def __eq__(self, other):
+        if not isinstance(other, TMap):
+            return False
+        return {h: v for h, (k, v) in self.entries.items()} == {h: v for h, (k, v) in other.entries.items()}
+
+    def __copy__(self):
+        m = object.__new__(TMap)
+        m.label, m.entries = self.label, dict(self.entries)
+        return m
+
+    def __repr__(self):
+        return f'{type(self).__name__}({list(self.items())}, {self.label})'
+
+
+def _relabel(element: Type, label) -> Type:
+    """`element` with `label`, which has to include the label of `element`."""
+    if not label <= element.label:
+        # the element is still stored elsewhere, so don't change its label in place
+        element = element.reference(label)
+    return element
+
+
+def _nested_string(value: _Container) -> str:
+    """Text of `value`. Nested containers are converted without recursion, so deep nesting
+    doesn't exhaust the python stack, and a container within itself converts to an empty string.
+    """
+    pieces, active, stack = [], set(), [value]
+    while stack:
+        v = stack.pop()
+        if type(v) is str:
+            pieces.append(v)
+        elif type(v) is int:
+            # all parts of the container with this cell are done
+            active.discard(v)
+        elif not isinstance(v, _Container):
+            pieces.append(v.string().value)
+        elif id(v.__dict__) not in active:
+            active.add(id(v.__dict__))
+            stack.append(id(v.__dict__))
+            stack += reversed(v.string_parts())
+    return ''.join(pieces)
+
+
+def _contents_label(value: Type):
+    """Label of `value` including everything reachable from it. Conversions and comparisons
+    of containers read all their contents.
+    """
+    if not isinstance(value, _Container):
+        return value.label
+    labels, seen, stack = [], set(), [value]
+    while stack:
+        v = stack.pop()
+        labels.append(v.label)
+        if not isinstance(v, _Container) or id(v.__dict__) in seen:
+            continue
+        seen.add(id(v.__dict__))
+        if isinstance(v, TArray):
+            if v.packed:
+                labels += v.element_labels()
+            else:
+                stack += v.values
+        elif isinstance(v, TObject):
+            stack += v.slots
+        else:
+            for key, element in v.items():
+                stack += (key, element)
+    return set().union(*labels)
+
+
+def _array_index(key: Type) -> Optional[int]:
+    """The list index for `key` or None if `key` is not a valid array index."""
+    if type(key) is TNumber and math.isfinite(key.value) and key.value >= 0 and key.value == int(key.value):
+        return int(key.value)
+    return None
 
 
 class BaseMonitor:
+    # overhead counters reported by `stats`
+    COUNTERS = ('unions', 'new_labels', 'subset_checks', 'deepcopies', 'block_entries', 'block_exits',
+                'loop_fixed_points', 'max_pc_levels', 'max_loop_head', 'max_return_address', 'max_label_size')
+    # channel for `print` and `labelPrint`, None prints directly
+    output: Optional[Output] = None
+    # files that `read` may read
+    inputs: Optional[Inputs] = None
+    # steps left of the budget of the running program, see `Interpreter.run`
+    steps_left: float = math.inf
+
     def __init__(self):
         self.pc_levels = [set()]  # type: List[Set(String)]
         self.return_address = []
         self.loop_head = []
+        # pc levels at the end of a loop body by call depth, the next loop condition at that
+        # depth continues the same loop
+        self.loop_continues = {}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.counters['max_pc_levels'] = 1
+
+    def reset(self):
+        """Restores the initial state, so the monitor can be reused for another run.
+        Monitors that keep additional state have to extend this.
+        """
+        BaseMonitor.__init__(self)
+        self.output = None
+        self.inputs = None
+        self.steps_left = math.inf
 
     @property
     def current_pc_level(self):
         return self.pc_levels[-1]
 
+    def stats(self):
+        """Returns a snapshot of the overhead counters of this monitor.
+        """
+        return dict(self.counters)
+
+    def join(self, *labels):
+        """Union of all `labels`.
+        Rules should use this instead of `set.union` so that the work shows up in `stats`.
+        If one of the labels contains all others it is returned itself, so joins that don't
+        add anything, e.g. with the unchanged labels of a loop, allocate nothing.
+        `new_labels` counts the joins that had to build a new set.
+        """
+        c = self.counters
+        c['unions'] += len(labels) - 1
+        res = labels[0]
+        for label in labels[1:]:
+            if label is res or not label or label <= res:
+                continue
+            if res <= label:
+                res = label
+            else:
+                res = res | label
+                c['new_labels'] += 1
+        if len(res) > c['max_label_size']:
+            c['max_label_size'] = len(res)
+        return res
+
+    def flows_to(self, source, target):
+        """Whether information labeled `source` may flow to `target`.
+        """
+        self.counters['subset_checks'] += 1
+        return source.issubset(target)
+
+    def track_depth(self):
+        """Updates the high-water marks of the monitor stacks. Call after pushing to them.
+        """
+        c = self.counters
+        if len(self.pc_levels) > c['max_pc_levels']:
+            c['max_pc_levels'] = len(self.pc_levels)
+        if len(self.loop_head) > c['max_loop_head']:
+            c['max_loop_head'] = len(self.loop_head)
+        if len(self.return_address) > c['max_return_address']:
+            c['max_return_address'] = len(self.return_address)
+
     def handle_BinOp(self, left_res: Type, right_res: Type):
         return set()
 
     def handle_UnaryOp(self, res: Type):
         return set()
 
+    def handle_Index(self, container: Type, key: Type, element: Type):
+        """Returns the label of `container[key]`, where `element` is the stored value.
+        """
+        return element.label
+
+    def handle_Attribute(self, obj: Type, element: Type):
+        """Returns the label of a field of `obj`, where `element` is the stored value.
+        """
+        return element.label
+
     def handle_literal(self, res: Type):
         return res
 
     def handle_end_block(self, loop: bool = False):
-        pass
+        self.counters['block_exits'] += 1
 
     def handle_enter_block(self, res, loop: bool = False, returns = False):
+        self.counters['block_entries'] += 1
+
+    def check_assign(self, target: Name, scope):
+        """Called before the value of an assignment to `target` is evaluated.
+        """
         pass
 
+    def label_assign(self, result: Type):
+        """Returns the value that is actually stored by an assignment.
+        """
+        return result
+
+    def check_member_assign(self, container: Type, key_label):
+        """Called before an element of an array or a field of an object is written or added.
+        :param key_label: union of the labels of the indices that selected the element
+        """
+        pass
+
+    def label_member_assign(self, result: Type, key_label):
+        """Returns the value that is actually stored in an array element or a field.
+        """
+        return result
+
+    def check_read(self, source_label, name_label):
+        """Called before the next item of an input source labeled `source_label` is read.
+        :param name_label: label of the name that selected the source
+        """
+        pass
+
+    def label_read(self, source_label, name_label):
+        """Returns the label of an item read from an input source.
+        """
+        return self.join(source_label, name_label)
+
     def handle_secure_assign(self, a: Assign, scope, evaluator):
-        return evaluator.visit(a.value)
+        self.check_assign(a.target, scope)
+        return self.label_assign(evaluator.visit(a.value))
 
     def handle_call(self, func: TFunction, args: List[Type]):
         self.return_address.append(len(self.pc_levels))
+        self.track_depth()
 
     def handle_return(self, val: Type):
         a = self.return_address.pop()
@@ -234,22 +859,33 @@ class FlowControlError(InterpreterError):
 
 class BlockRule:
     def handle_enter_block(self, res: Type, loop: bool = False, returns = False):
-        self.pc_levels.append(self.current_pc_level.union(res.label))
+        self.counters['block_entries'] += 1
+        self.pc_levels.append(self.join(self.current_pc_level, res.label))
+        self.track_depth()
 
     def handle_end_block(self, loop: bool = False):
+        self.counters['block_exits'] += 1
         self.pc_levels.pop()
 
 
 class BlockAndLoopRule:
     def handle_enter_block(self, res: Type, loop: bool = False, returns = False):
-        if not loop or not self.loop_head or self.loop_head[-1] < len(self.pc_levels):
-            self.pc_levels.append(self.current_pc_level.union(res.label))
+        self.counters['block_entries'] += 1
+        if not loop or self.loop_continues.pop(len(self.return_address), None) != len(self.pc_levels):
+            self.pc_levels.append(self.join(self.current_pc_level, res.label))
             self.loop_head.append(len(self.pc_levels))
+            self.track_depth()
+        elif self.flows_to(res.label, self.current_pc_level):
+            # the pc level of the loop reached its fixed point and stays as it is
+            self.counters['loop_fixed_points'] += 1
         else:
-            self.pc_levels[-1] = self.current_pc_level.union(res.label)
+            self.pc_levels[-1] = self.join(self.current_pc_level, res.label)
 
     def handle_end_block(self, loop: bool = False):
-        if not loop:
+        self.counters['block_exits'] += 1
+        if loop:
+            self.loop_continues[len(self.return_address)] = len(self.pc_levels)
+        else:
             self.pc_levels.pop()
             if self.loop_head and self.loop_head[-1] > len(self.pc_levels):
                 self.loop_head.pop()
@@ -263,79 +899,228 @@ class LiteralRule:
 
 class ArithmeticOpRule:
     def handle_BinOp(self, left_res: Type, right_res: Type):
-        return self.current_pc_level.union(left_res.label.union(right_res.label))
+        return self.join(self.current_pc_level, _contents_label(left_res), _contents_label(right_res))
 
 
 class UnaryOperatorRule:
     def handle_UnaryOp(self, res: Type):
-        return self.current_pc_level.union(res.label)
+        return self.join(self.current_pc_level, _contents_label(res))
 
 
 class AssignRule:
-    def handle_secure_assign(self, a: Assign, scope, evaluator):
+    def check_assign(self, target: Name, scope):
         if self.current_pc_level != set():
             # Can't define a new variable in a secure block
-            if a.target.name not in scope:
+            if target.name not in scope:
                 raise FlowControlError(
                     f'cannot create variable within branch with security level {self.current_pc_level}')
 
             # Can't redefine a variable with too low security
-            elif not self.current_pc_level.issubset(scope[a.target.name].label):
+            elif not self.flows_to(self.current_pc_level, scope[target.name].label):
                 raise FlowControlError(
-                    f'cannot modify variable with label {scope[a.target.name].label} within branch with security level {self.current_pc_level}'
+                    f'cannot modify variable with label {scope[target.name].label} within branch with security level {self.current_pc_level}'
                 )
-        result = evaluator.visit(a.value)
 
+    def label_assign(self, result: Type):
         # When assigning a value raise it to at least the security level of the current scope
         # However, simply reading the value from another variable does not mean
-        # that that variable's label needs to go up. So, make a copy.
-        # We want these to be primitives copied, not references.
-        result = copy.deepcopy(result)
-        result.label = result.label.union(self.current_pc_level)
-        return result
+        # that that variable's label needs to go up. So, bind a reference with the raised
+        # label, which shares the contents of arrays, objects and dicts.
+        self.counters['deepcopies'] += 1
+        return _relabel(result, self.join(result.label, self.current_pc_level))
+
+
+class IndexRule:
+    def handle_Index(self, container: Type, key: Type, element: Type):
+        return self.join(element.label, container.label, key.label)
+
+    def handle_Attribute(self, obj: Type, element: Type):
+        return self.join(element.label, obj.label)
+
+    def check_member_assign(self, container: Type, key_label):
+        # which element changes and the length of the array or the fields of the object
+        # must not depend on anything more secret than the container itself
+        level = self.join(self.current_pc_level, key_label)
+        if not self.flows_to(level, container.label):
+            raise FlowControlError(
+                f'cannot modify {type(container).__name__} with label {container.label} with security level {level}')
+        # a reference with a raised label may point to a container that is less secret. which
+        # one it points to must not show in the contents
+        cell_label = container.cell_label
+        if cell_label is not container.label and not self.flows_to(container.label, cell_label):
+            raise FlowControlError(
+                f'cannot modify {type(container).__name__} with label {cell_label} through a reference '
+                f'with label {container.label}')
+
+    def label_member_assign(self, result: Type, key_label):
+        self.counters['deepcopies'] += 1
+        return _relabel(result, self.join(result.label, self.current_pc_level, key_label))
+
+    def check_read(self, source_label, name_label):
+        # reading moves the position in the source, which later reads observe. like an
+        # element of an array, it must not change in a context more secret than the source
+        level = self.join(self.current_pc_level, name_label)
+        if not self.flows_to(level, source_label):
+            raise FlowControlError(f'cannot read input with label {source_label} with security level {level}')
+
+    def label_read(self, source_label, name_label):
+        return self.join(source_label, self.current_pc_level, name_label)
 
 
 class ReturnRule:
     def handle_return(self, value: Type):
         a = self.return_address[-1]
-        if not self.current_pc_level.issubset(self.pc_levels[a - 1]):
+        if not self.flows_to(self.current_pc_level, self.pc_levels[a - 1]):
             raise FlowControlError('return statment in illegal context')
         BaseMonitor.handle_return(self, value)
 
 
 class BlockLoopReturnRule(BlockAndLoopRule, ReturnRule):
     def handle_enter_block(self, cond: Type, loop: bool = False, returns = False):
-        if returns and not self.current_pc_level.issubset(self.pc_levels[self.return_address[-1] - 1]):
+        if returns and not self.flows_to(self.current_pc_level, self.pc_levels[self.return_address[-1] - 1]):
             raise FlowControlError('return statement in branch with high condition')
         else:
             return super().handle_enter_block(cond, loop, returns)
 
 
 
-class Monitor(BlockLoopReturnRule, LiteralRule, ArithmeticOpRule, UnaryOperatorRule, AssignRule, ReturnRule, BaseMonitor):
+class Monitor(BlockLoopReturnRule, LiteralRule, ArithmeticOpRule, UnaryOperatorRule, IndexRule, AssignRule, ReturnRule,
+              BaseMonitor):
     pass
 
 
 class BuiltinFunction(TFunction):
+    """Function implemented in python.
+    `f` may also be a coroutine function. Such builtins can only be called during
+    resumable execution (see `Interpreter.run_iter`), where the driver awaits them.
+    Builtins that call functions of the script are generator functions: they yield
+    `(function, args)` for every call and are sent the result. In resumable execution the
+    called functions run step by step like any other call.
+    """
     def __init__(self, f: Callable[[List[Type]], Type], name: str = '', pass_monitor: bool = False):
-        super().__init__()
+        super().__init__(name or getattr(f, '__name__', ''))
         self.f = f
         self.pass_monitor = pass_monitor
+        self.is_async = inspect.iscoroutinefunction(f)
+        self.calls_back = inspect.isgeneratorfunction(f)
 
     def string(self):
         return TString('[native code]')
 
-    def call(self, args: List[Type], monitor: Monitor):
+    def invoke(self, args: List[Type], monitor: Monitor):
         if not self.pass_monitor:
-            r = self.f(*args)
+            return self.f(*args)
         else:
-            r = self.f(monitor, *args)
-        retval = r if r is not None else Undefined()
+            return self.f(monitor, *args)
+
+    def finish(self, r, monitor: Monitor):
+        retval = r if r is not None else TUndefined()
         monitor.handle_return(retval)
         return retval
 
+    def call(self, args: List[Type], monitor: Monitor, events: Optional['Events'] = None):
+        if self.is_async:
+            raise UnsupportedOperationError('async builtins can only be called in resumable execution')
+        r = self.invoke(args, monitor)
+        if self.calls_back:
+            r = _run_callbacks(r, monitor, events)
+        return self.finish(r, monitor)
+
+    def call_iter(self, args: List[Type], monitor: Monitor):
+        if self.calls_back:
+            r = yield from _iter_callbacks(self.invoke(args, monitor), monitor)
+        elif self.is_async:
+            r = yield self.invoke(args, monitor)
+        else:
+            return self.call(args, monitor)
+        return self.finish(r, monitor)
+
+
+# converts arguments of native functions to python values
+_CONVERSIONS: Dict[str, Callable[[Type], object]] = {
+    'number': lambda v: v.number().value,
+    'string': lambda v: v.string().value,
+    'boolean': lambda v: not is_falsy(v),
+    'value': lambda v: v,
+}
 
-import traceback, sys
+
+class NativeFunction(BuiltinFunction):
+    """Builtin that works on python values and leaves labels to the interpreter.
+    The arguments are converted according to `params` ('number', 'string', 'boolean' or
+    'value' to pass the value itself), the result is converted with `from_python`.
+    The result is labeled according to `label`:
+
+    * 'join': union of the labels of all arguments and the pc level
+    * 'pc': only the pc level, for results that don't depend on secret arguments
+    * a function `(monitor, args) -> label`
+
+    Passing an array for a 'number', 'string' or 'boolean' parameter calls the function
+    once per element and returns an array of the results. All results then get the label
+    computed from the arrays and the labels of all their elements.
+    """
+    def __init__(self, f: Callable, params: Sequence[str] = (), label='join', name: str = ''):
+        super().__init__(f, name)
+        for p in params:
+            if p not in _CONVERSIONS:
+                raise ValueError(f'unknown parameter type {p}')
+        self.params = tuple(params)
+        self.label_policy = label
+
+    def output_label(self, args: List[Type], monitor: Monitor):
+        if callable(self.label_policy):
+            return self.label_policy(monitor, args)
+        elif self.label_policy == 'pc':
+            return monitor.current_pc_level
+        return monitor.join(monitor.current_pc_level, *(a.label for a in args))
+
+    def invoke(self, args: List[Type], monitor: Monitor):
+        args = list(args) + [TUndefined()] * (len(self.params) - len(args))
+        params = self.params + ('value', ) * (len(args) - len(self.params))
+        label = self.output_label(args, monitor)
+        batched = [p != 'value' and isinstance(a, TArray) for p, a in zip(params, args)]
+        if not any(batched):
+            return from_python(self.f(*(_CONVERSIONS[p](a) for p, a in zip(params, args))), label)
+        columns = []
+        for p, a, b in zip(params, args, batched):
+            if not b:
+                columns.append(itertools.repeat(_CONVERSIONS[p](a)))
+            elif p == 'number':
+                columns.append(a.numbers())
+            else:
+                columns.append(map(_CONVERSIONS[p], a))
+        arrays = [a for a, b in zip(args, batched) if b]
+        label = monitor.join(label, *itertools.chain.from_iterable(a.element_labels() for a in arrays))
+        n = min(map(len, arrays))
+        return TArray([from_python(r, label) for r in itertools.islice(map(self.f, *columns), n)], label)
+
+    def __reduce_ex__(self, protocol):
+        if GlobalScope.natives.get(self.name) is self:
+            # the decorated function is not reachable by name, so look it up in the registry
+            return _registered_native, (self.name, )
+        return super().__reduce_ex__(protocol)
+
+
+def _registered_native(name: str) -> NativeFunction:
+    return GlobalScope.natives[name]
+
+
+def from_python(value, label=set()) -> Type:
+    """Converts the result of a native function to a value with (at least) `label`.
+    """
+    if isinstance(value, Type):
+        return _relabel(value, value.label.union(label))
+    elif value is None:
+        return TUndefined(label)
+    elif isinstance(value, bool):
+        return TBoolean(value, label)
+    elif isinstance(value, (int, float)):
+        return TNumber(value, label)
+    elif isinstance(value, str):
+        return TString(value, label)
+    elif isinstance(value, (list, tuple)):
+        return TArray([from_python(v, label) for v in value], label)
+    raise UnsupportedOperationError(f'cannot convert {type(value).__name__} to a value')
 
 
 class UserFunction(TFunction):
@@ -346,7 +1131,9 @@ class UserFunction(TFunction):
         self.argnames = argnames
         self.parent_scope = parent_scope
 
-    def call(self, args, monitor: Monitor):
+    def prepare(self, args, monitor: Monitor) -> 'Interpreter':
+        """Creates the interpreter for the function body with the arguments bound.
+        """
         scope = Scope(self.parent_scope)
         for l in self.localvars:
             scope.declare(l, label = monitor.current_pc_level)
@@ -354,12 +1141,30 @@ class UserFunction(TFunction):
             scope.declare(name, val, label = monitor.current_pc_level)
         for name in self.argnames[len(args):]:
             scope.declare(name, label = monitor.current_pc_level)
+        return Interpreter(self.code, scope, monitor)
+
+    def call(self, args, monitor: Monitor, events: Optional['Events'] = None):
         try:
-            interpreter = Interpreter(self.code, scope, monitor)
+            interpreter = self.prepare(args, monitor)
+            interpreter.events = events
             interpreter.run()
         except ReturnStatement as r:
             return r.value
-        return interpreter.run()
+        return self.implicit_return(monitor)
+
+    def call_iter(self, args, monitor: Monitor):
+        try:
+            interpreter = self.prepare(args, monitor)
+            yield from interpreter.run_iter()
+        except ReturnStatement as r:
+            return r.value
+        return self.implicit_return(monitor)
+
+    def implicit_return(self, monitor: Monitor):
+        # falling off the end of the body returns undefined
+        value = monitor.handle_literal(TUndefined())
+        monitor.handle_return(value)
+        return value
 
     def string(self):
         return TString('function () { /* code */ }')
@@ -369,6 +1174,9 @@ class Scope:
     """Scope for name resolution.
     If a name is not boud within a scope the lookup is delegated to the parent scope.
     """
+    # set when `names` is shared with a fork and has to be copied before it is modified
+    _shared = False
+
     def __init__(self, parent: Optional['Scope'] = None, names: Optional[Mapping[str, Type]] = None):
         self.parent = parent
         self.names: Mapping[str, Type] = names or dict()
@@ -381,6 +1189,8 @@ class Scope:
 
     def __setitem__(self, key: str, val: Type, local: bool = False):
         if local or key in self.names or not self.parent:
+            if self._shared:
+                self._unshare()
             self.names[key] = val
         else:
             self.parent[key] = val
@@ -388,10 +1198,41 @@ class Scope:
     def __contains__(self, key):
         return key in self.names or (self.parent and key in self.parent)
 
-    def declare(self, name: str, value: Type = TUndefined(), label = set()):
-        value.label = value.label.union(label)
+    def declare(self, name: str, value: Optional[Type] = None, label = set()):
+        if value is None:
+            value = TUndefined(label)
+        elif not label <= value.label:
+            # values may be shared with other variables, don't raise their label
+            value = value.reference(value.label.union(label))
+        if self._shared:
+            self._unshare()
         self.names[name] = value
 
+    def _unshare(self):
+        self.names = dict(self.names)
+        self._shared = False
+
+    def fork(self, memo: dict) -> 'Scope':
+        """Copy-on-write copy of this scope and its parents.
+        The copies share their bindings with the original until either side assigns
+        a variable. Arrays, objects and dicts are copied since they are mutable, and user functions are
+        copied so their closures refer to the forked scopes.
+        :param memo: maps ids of already forked scopes and values to their forks
+        """
+        if id(self) in memo:
+            return memo[id(self)]
+        child = copy.copy(self)
+        memo[id(self)] = child
+        self._shared = child._shared = True
+        if self.parent:
+            child.parent = self.parent.fork(memo)
+        for name, value in self.names.items():
+            if isinstance(value, _MUTABLE):
+                if child._shared:
+                    child._unshare()
+                child.names[name] = _fork_value(value, memo)
+        return child
+
     def fresh_var(self):
         if not self.parent:
             self._vars += 1
@@ -403,22 +1244,339 @@ class Scope:
         return f'{type(self).__name__}({repr(self.parent)}, {self.names})'
 
 
+# values that are copied by `Scope.fork` instead of being shared
+_MUTABLE = (TArray, TObject, TMap, UserFunction)
+
+
+def _fork_value(value: Type, memo: dict) -> Type:
+    if not isinstance(value, _MUTABLE):
+        return value
+    if isinstance(value, UserFunction):
+        if id(value) not in memo:
+            f = memo[id(value)] = copy.copy(value)
+            f.parent_scope = value.parent_scope.fork(memo)
+        return memo[id(value)]
+    # keep aliasing intact: references to the same contents share the forked contents
+    fork = memo.get(id(value.__dict__))
+    if fork is None:
+        fork = memo[id(value.__dict__)] = copy.copy(value)
+        fork.label = value.cell_label
+        if isinstance(value, TObject):
+            fork.slots = [_fork_value(v, memo) for v in value.slots]
+        elif isinstance(value, TMap):
+            fork.entries = {h: (k, _fork_value(v, memo)) for h, (k, v) in value.entries.items()}
+        elif not fork.packed:
+            fork.values = [_fork_value(v, memo) for v in fork.values]
+    return fork if fork.label is value.label else fork.reference(value.label)
+
+
+# builtins are module level functions so that scopes referencing them can be pickled
+def _label(val: Type = TUndefined(), *args: Sequence[Type]):
+    val = copy.deepcopy(val)
+    val.label = val.label.union(map(str, args))
+    return val
+
+
+def _emit(m, args: Sequence[object], label: Iterable[Set[str]]):
+    output = m.output
+    if output is None:
+        print(*args)
+    else:
+        output.emit(' '.join(map(str, args)), set().union(*label), m.current_pc_level)
+
+
+def _print(m, *args):
+    _emit(m, args, (v.label for v in args))
+
+
+def _print_label(m, *args):
+    _emit(m, [m.current_pc_level, *map(lambda v: v.lbl_str(), args)], (v.label for v in args))
+
+
+def _read(m, name: Type = TUndefined()):
+    key = name.string().value
+    inputs = m.inputs
+    if inputs is None or key not in inputs.sources:
+        raise InputError(f'no input named {key}')
+    source_label = inputs.sources[key].label
+    m.check_read(source_label, name.label)
+    label = m.label_read(source_label, name.label)
+    item = inputs.read(key)
+    if item is None:
+        return TUndefined(label)
+    elif isinstance(item, list):
+        return TArray([TString(field, label) for field in item], label)
+    return TString(item, label)
+
+
+def _push(m, target: Type = TUndefined(), *values: Type):
+    if not isinstance(target, TArray):
+        raise UnsupportedOperationError(f'cannot push to {target}')
+    m.check_member_assign(target, set())
+    target.extend(m.label_member_assign(v, set()) for v in values)
+    return TNumber(len(target), target.label)
+
+
+def _object():
+    return TObject()
+
+
+def _dict():
+    return TMap()
+
+
+def _as_map(target: Type) -> TMap:
+    if not isinstance(target, TMap):
+        raise UnsupportedOperationError(f'{target} is not a dict')
+    return target
+
+
+# a lookup is labeled like reading an array element: with the labels of the map
+# (which covers which keys exist), the key and the value
+def _get(m, target: Type = TUndefined(), key: Type = TUndefined()):
+    element = _as_map(target).get(key)
+    return _relabel(element, m.handle_Index(target, key, element))
+
+
+def _has(m, target: Type = TUndefined(), key: Type = TUndefined()):
+    present = _as_map(target).has(key)
+    return TBoolean(present, m.handle_Index(target, key, TUndefined()))
+
+
+def _set(m, target: Type = TUndefined(), key: Type = TUndefined(), value: Type = TUndefined()):
+    m.check_member_assign(_as_map(target), key.label)
+    target.set(key, m.label_member_assign(value, key.label))
+    return TUndefined()
+
+
+def _delete(m, target: Type = TUndefined(), key: Type = TUndefined()):
+    m.check_member_assign(_as_map(target), key.label)
+    return TBoolean(target.delete(key), m.handle_Index(target, key, TUndefined()))
+
+
+# array builtins. they compute the label of their result with a single join over the
+# array, the labels of all elements and the pc level, which is the same label an
+# interpreted loop over the elements ends up with.
+
+def _as_array(value: Type) -> TArray:
+    if not isinstance(value, TArray):
+        raise UnsupportedOperationError(f'{value} is not an array')
+    return value
+
+
+def _aggregate_label(m, *arrays: TArray):
+    return m.join(m.current_pc_level, *(a.label for a in arrays),
+                  *itertools.chain.from_iterable(a.element_labels() for a in arrays))
+
+
+def _sum(m, a: Type = TUndefined()):
+    return TNumber(sum(_as_array(a).numbers()), _aggregate_label(m, a))
+
+
+def _min(m, a: Type = TUndefined()):
+    return TNumber(min(_as_array(a).numbers(), default=float('inf')), _aggregate_label(m, a))
+
+
+def _max(m, a: Type = TUndefined()):
+    return TNumber(max(_as_array(a).numbers(), default=-float('inf')), _aggregate_label(m, a))
+
+
+def _sort(m, a: Type = TUndefined()):
+    """Sorted copy of `a`. Numbers are compared numerically, otherwise elements are
+    compared as strings. The position of every element depends on all other elements,
+    so the label of the result covers all of them.
+    """
+    label = _aggregate_label(m, _as_array(a))
+    if a.packed and a._masks is None:
+        return TArray._from_buffer(array.array(a._items.typecode, sorted(a._items)), a._element_labels, None, label)
+    elements = list(a)
+    if all(isinstance(v, TNumber) for v in elements):
+        elements.sort(key=lambda v: v.value)
+    else:
+        elements.sort(key=lambda v: v.string().value)
+    return TArray(elements, label)
+
+
+def _slice(m, a: Type = TUndefined(), start: Type = TNumber(0), end: Type = TUndefined()):
+    n = len(_as_array(a))
+    i = int(start.number().value) if isinstance(start, TNumber) else 0
+    j = int(end.number().value) if isinstance(end, TNumber) else n
+    return a.slice(i, j, m.join(m.current_pc_level, a.label, start.label, end.label))
+
+
+def _concat(m, *arrays: Type):
+    label = m.join(m.current_pc_level, *(_as_array(a).label for a in arrays))
+    result = TArray((), label)
+    for a in arrays:
+        result.extend(a)
+    return result
+
+
+def _run_callbacks(calls, m, events: Optional['Events'] = None) -> Type:
+    """Runs the generator of a builtin that calls functions of the script, see `BuiltinFunction`.
+    """
+    try:
+        request = next(calls)
+        while True:
+            f, args = request
+            m.handle_call(f, args)
+            request = calls.send(f.call(args, m, events))
+    except StopIteration as e:
+        return e.value
+
+
+def _iter_callbacks(calls, m):
+    """`_run_callbacks` for resumable execution."""
+    try:
+        request = next(calls)
+        while True:
+            f, args = request
+            m.handle_call(f, args)
+            request = calls.send((yield from f.call_iter(args, m)))
+    except StopIteration as e:
+        return e.value
+
+
+def _elements(m, a: TArray):
+    """The elements as they would be read by `a[i]`."""
+    for v in a:
+        yield _relabel(v, m.join(v.label, a.label))
+
+
+def _map(m, a: Type = TUndefined(), f: Type = TUndefined()):
+    results = []
+    for v in _elements(m, _as_array(a)):
+        results.append((yield f, [v]))
+    return TArray(results, m.join(m.current_pc_level, a.label))
+
+
+def _filter(m, a: Type = TUndefined(), f: Type = TUndefined()):
+    kept, labels = [], [m.current_pc_level, a.label]
+    for v in _elements(m, _as_array(a)):
+        r = yield f, [v]
+        labels.append(r.label)
+        if not is_falsy(r):
+            kept.append(v)
+    # which elements are kept depends on every result of f
+    return TArray(kept, m.join(*labels))
+
+
+def _reduce(m, a: Type = TUndefined(), f: Type = TUndefined(), initial: Type = TUndefined()):
+    acc = initial
+    for v in _elements(m, _as_array(a)):
+        acc = yield f, [acc, v]
+    return _relabel(acc, m.join(acc.label, m.current_pc_level, a.label))
+
+
+def _length(value: Type = TUndefined()):
+    if isinstance(value, (TArray, TMap)):
+        return TNumber(len(value), value.label)
+    elif isinstance(value, TString):
+        return TNumber(len(value.value), value.label)
+    return TUndefined(value.label)
+
+
+class BuiltinScope(Scope):
+    """Read-only scope with the builtin functions, shared by every global scope of the process.
+    Natives registered with `GlobalScope.register` are looked up in `natives` and take
+    precedence over builtins of the same name.
+    """
+    def __init__(self, names: Mapping[str, Type], natives: Mapping[str, BuiltinFunction]):
+        super().__init__(None, dict(names))
+        self.natives = natives
+
+    def __getitem__(self, key: str):
+        value = self.natives.get(key)
+        if value is None:
+            value = self.names.get(key)
+            if value is None:
+                raise RefError(f'name {key} is not defined')
+        return value
+
+    def __setitem__(self, key: str, val: Type, local: bool = False):
+        raise IllegalStateError(f'cannot assign to builtin {key}')
+
+    def __contains__(self, key):
+        return key in self.natives or key in self.names
+
+    def declare(self, name: str, value: Optional[Type] = None, label=set()):
+        raise IllegalStateError(f'cannot declare {name} in the builtin scope')
+
+    def fork(self, memo: dict) -> 'Scope':
+        return self
+
+    def fresh_var(self):
+        raise IllegalStateError('the builtin scope has no variables')
+
+    def __reduce__(self):
+        # pickled and copied by reference
+        return 'builtin_scope'
+
+    def __repr__(self):
+        return f'{type(self).__name__}()'
+
+
 class GlobalScope(Scope):
+    """Global variables of a single run on top of the shared `builtin_scope`.
+    Assignments always bind in this scope, so assigning to the name of a builtin
+    shadows it for this run only.
+    """
+    # native functions visible in every global scope, see `native`
+    natives: Dict[str, BuiltinFunction] = {}
+
     def __init__(self):
-        super().__init__(None)
-        self.declare('print', BuiltinFunction(print))
+        super().__init__(builtin_scope)
+
+    def __setitem__(self, key: str, val: Type, local: bool = False):
+        if self._shared:
+            self._unshare()
+        self.names[key] = val
 
-        def label(val=Undefined(), *args: Sequence[Type]):
-            val = copy.deepcopy(val)
-            val.label = val.label.union(map(str, args))
-            return val
+    def fresh_var(self):
+        self._vars += 1
+        return self._vars
+
+    @classmethod
+    def register(cls, f: BuiltinFunction) -> BuiltinFunction:
+        """Makes `f` available under its name in all global scopes.
+        """
+        cls.natives[f.name] = f
+        return f
 
-        self.declare('label', BuiltinFunction(label))
 
-        def print_label(m, *args):
-            print(m.current_pc_level, *map(lambda v: v.lbl_str(), args))
+builtin_scope = BuiltinScope(
+    {
+        'print': BuiltinFunction(_print, 'print', pass_monitor=True),
+        'label': BuiltinFunction(_label, 'label'),
+        'labelPrint': BuiltinFunction(_print_label, 'labelPrint', pass_monitor=True),
+        'read': BuiltinFunction(_read, 'read', pass_monitor=True),
+        'length': BuiltinFunction(_length, 'length'),
+        'object': BuiltinFunction(_object, 'object'),
+        'dict': BuiltinFunction(_dict, 'dict'),
+        **{
+            name: BuiltinFunction(f, name, pass_monitor=True)
+            for name, f in [('push', _push), ('get', _get), ('set', _set), ('has', _has), ('delete', _delete),
+                            ('sum', _sum), ('min', _min), ('max', _max), ('sort', _sort), ('slice', _slice),
+                            ('concat', _concat), ('map', _map), ('filter', _filter), ('reduce', _reduce)]
+        },
+    }, GlobalScope.natives)
+
+
+def native(params: Sequence[str] = (), label='join', name: Optional[str] = None, register: bool = True):
+    """Decorator that turns a python function into a `NativeFunction`, by default
+    registered in `GlobalScope`:
+
+        @native(params=('number', 'number'))
+        def hypot(x, y):
+            return math.hypot(x, y)
+    """
+    def decorate(f: Callable) -> NativeFunction:
+        nf = NativeFunction(f, params, label, name or f.__name__)
+        if register:
+            GlobalScope.register(nf)
+        return nf
 
-        self.declare('labelPrint', BuiltinFunction(print_label, pass_monitor=True))
+    return decorate
 
 
 class _LocalVarCollector(NodeVisitor):
@@ -438,6 +1596,18 @@ class _LocalVarCollector(NodeVisitor):
         return self.locals
 
 
+class _CallFinder(NodeVisitor):
+    def __init__(self):
+        self.found = False
+
+    def visit_Call(self, tree: Call):
+        self.found = True
+
+    def visit(self, tree: Ast) -> bool:
+        super().visit(tree)
+        return self.found
+
+
 def collect_locals(ast: Ast) -> List[str]:
     collector = _LocalVarCollector()
     return collector.visit(ast)
@@ -461,31 +1631,26 @@ class ExpressionEvaluator(NodeVisitor):
         self.scope = scope
 
     def visit_BinOp(self, tree: BinOp) -> Type:
-        op, left, right = tree.op, tree.left, tree.right
-        left_val = self.visit(left)
+        op = tree.op
+        left_val = self.visit(tree.left)
         if op in ['&&', '||']:
             # short circuitevaluation
-            if op == '&&':
-                if is_falsy(left_val):
-                    return left_val
-                else:
-                    self.monitor.handle_enter_block(left_val)
-                    right_val = self.visit(right)
-                    self.monitor.handle_end_block()
-                    res_label = self.monitor.handle_BinOp(left_val, right_val)
-                    right_val.label = res_label
-                    return right_val
-            elif op == '||':
-                if is_falsy(left_val):
-                    self.monitor.handle_enter_block(left_val)
-                    right_val = self.visit(right)
-                    self.monitor.handle_end_block()
-                    res_label = self.monitor.handle_BinOp(left_val, right_val)
-                    right_val.label = res_label
-                    return right_val
-                else:
-                    return left_val
-        right_val = self.visit(right)
+            if is_falsy(left_val) == (op == '&&'):
+                return left_val
+            self.monitor.handle_enter_block(left_val)
+            right_val = self.visit(tree.right)
+            self.monitor.handle_end_block()
+            return self.logical_op(left_val, right_val)
+        return self.binary_op(op, left_val, self.visit(tree.right))
+
+    def logical_op(self, left_val: Type, right_val: Type) -> Type:
+        """Result of `&&` or `||` when the right hand side was evaluated.
+        """
+        res_label = self.monitor.handle_BinOp(left_val, right_val)
+        # the value may be stored in a variable, so don't change its label in place
+        return right_val.reference(res_label)
+
+    def binary_op(self, op: str, left_val: Type, right_val: Type) -> Type:
         res_label = self.monitor.handle_BinOp(left_val, right_val)
         if op == '+':
             # both are number: addition
@@ -494,7 +1659,7 @@ class ExpressionEvaluator(NodeVisitor):
                 return TNumber(left_val.value + right_val.value, res_label)
             # otherwise: string concatenation
             else:
-                return TString(left_val.string().value + right_val.string().value, res_label)
+                return left_val.string().concat(right_val.string(), res_label)
         elif op == '-':
             return TNumber(left_val.number().value - right_val.number().value, res_label)
         elif op == '*':
@@ -530,8 +1695,9 @@ class ExpressionEvaluator(NodeVisitor):
         raise UnsupportedOperationError(f'unknown operator "{op}"')
 
     def visit_UnaryOp(self, tree: UnaryOp) -> Type:
-        op = tree.op
-        res = self.visit(tree.expr)
+        return self.unary_op(tree.op, self.visit(tree.expr))
+
+    def unary_op(self, op: str, res: Type) -> Type:
         res_label = self.monitor.handle_UnaryOp(res)
         if op == '-':
             return TNumber(-res.number().value, res_label)
@@ -561,6 +1727,54 @@ class ExpressionEvaluator(NodeVisitor):
     def visit_Name(self, tree: Name) -> Type:
         return self.scope[tree.name]
 
+    def visit_Index(self, tree: Index) -> Type:
+        return self.index(self.visit(tree.target), self.visit(tree.index))
+
+    def index(self, container: Type, key: Type) -> Type:
+        element = container.get(key) if isinstance(container, TArray) else TUndefined()
+        return _relabel(element, self.monitor.handle_Index(container, key, element))
+
+    def visit_Attribute(self, tree: Attribute) -> Type:
+        return self.attribute(self.visit(tree.value), tree)
+
+    def attribute(self, obj: Type, tree: Attribute) -> Type:
+        element = obj.get_attr(tree.attr, tree) if isinstance(obj, TObject) else TUndefined()
+        return _relabel(element, self.monitor.handle_Attribute(obj, element))
+
+    def member_target(self, tree: Union[Index, Attribute]):
+        """Resolves the target of an assignment to an array element or object field without
+        copying anything. Returns the container, the key (a value for arrays, a name for
+        objects) and the union of the labels of all keys on the way.
+        """
+        inner = tree.target if isinstance(tree, Index) else tree.value
+        if isinstance(inner, (Index, Attribute)):
+            outer, outer_key, key_label = self.member_target(inner)
+            container = self.member(outer, outer_key)
+        else:
+            container, key_label = self.visit(inner), set()
+        key = self.visit(tree.index) if isinstance(tree, Index) else tree.attr
+        return self.check_member_target(container, key, key_label)
+
+    def member(self, container: Type, key) -> Type:
+        if isinstance(key, str):
+            return container.get_attr(key)
+        return container.get(key)
+
+    def check_member_target(self, container: Type, key, key_label):
+        if isinstance(key, str):
+            if not isinstance(container, TObject):
+                raise UnsupportedOperationError(f'cannot assign to a field of {container}')
+            return container, key, key_label
+        if not isinstance(container, TArray):
+            raise UnsupportedOperationError(f'cannot assign to an element of {container}')
+        return container, key, key_label.union(key.label)
+
+    def store_member(self, tree: Union[Index, Attribute], container: Type, key, value: Type):
+        if isinstance(key, str):
+            container.set_attr(key, value, tree)
+        else:
+            container.set(key, value)
+
     def visit_Call(self, tree: Call) -> Type:
         func = self.visit(tree.func)
         args = list(map(self.visit, tree.args))
@@ -579,75 +1793,194 @@ class ExpressionEvaluator(NodeVisitor):
     def generic_visit(self, tree: Ast) -> Type:
         raise UnsupportedOperationError(f'unexpected {tree}')
 
+    # Resumable evaluation. The iter_ methods are generators that follow the
+    # protocol of `Type.call_iter`. Nodes without an iter_ method cannot contain
+    # calls and are evaluated with the regular visitor.
+
+    def iter_visit(self, tree: Ast):
+        method = getattr(self, 'iter_' + type(tree).__name__, None)
+        if method is None:
+            return self.visit(tree)
+        return (yield from method(tree))
+
+    def iter_BinOp(self, tree: BinOp):
+        op = tree.op
+        left_val = yield from self.iter_visit(tree.left)
+        if op in ['&&', '||']:
+            if is_falsy(left_val) == (op == '&&'):
+                return left_val
+            self.monitor.handle_enter_block(left_val)
+            right_val = yield from self.iter_visit(tree.right)
+            self.monitor.handle_end_block()
+            return self.logical_op(left_val, right_val)
+        right_val = yield from self.iter_visit(tree.right)
+        return self.binary_op(op, left_val, right_val)
+
+    def iter_UnaryOp(self, tree: UnaryOp):
+        res = yield from self.iter_visit(tree.expr)
+        return self.unary_op(tree.op, res)
+
+    def iter_Array(self, tree: Array):
+        values = []
+        for e in tree.values:
+            values.append((yield from self.iter_visit(e)))
+        return self.monitor.handle_literal(TArray(values))
+
+    def iter_Index(self, tree: Index):
+        container = yield from self.iter_visit(tree.target)
+        key = yield from self.iter_visit(tree.index)
+        return self.index(container, key)
+
+    def iter_Attribute(self, tree: Attribute):
+        obj = yield from self.iter_visit(tree.value)
+        return self.attribute(obj, tree)
+
+    def iter_member_target(self, tree: Union[Index, Attribute]):
+        inner = tree.target if isinstance(tree, Index) else tree.value
+        if isinstance(inner, (Index, Attribute)):
+            outer, outer_key, key_label = yield from self.iter_member_target(inner)
+            container = self.member(outer, outer_key)
+        else:
+            container, key_label = (yield from self.iter_visit(inner)), set()
+        if isinstance(tree, Index):
+            key = yield from self.iter_visit(tree.index)
+        else:
+            key = tree.attr
+        return self.check_member_target(container, key, key_label)
+
+    def iter_Call(self, tree: Call):
+        func = yield from self.iter_visit(tree.func)
+        args = []
+        for a in tree.args:
+            args.append((yield from self.iter_visit(a)))
+        self.monitor.handle_call(func, args)
+        return (yield from func.call_iter(args, self.monitor))
+
 
 def flatten(l):
-    i = 0
-    while i < len(l):
-        while isinstance(l[i], list):
-            if not l[i]:
-                del l[i]
+    """Splices nested lists into `l` in place and returns it."""
+    flat = []
+    stack = [iter(l)]
+    while stack:
+        for e in stack[-1]:
+            if isinstance(e, list):
+                stack.append(iter(e))
                 break
-            else:
-                l[i:i + 1] = l[i]
-        i += 1
+            flat.append(e)
+        else:
+            stack.pop()
+    l[:] = flat
     return l
 
 
 def compile(code: Ast):
-    compiler = _CodeCompiler()
-    return flatten(compiler.visit(code))
+    return _CodeCompiler().compile(code)
 
 
 class _CodeCompiler(NodeVisitor):
+    """Emits the code for statements into a single list in one pass.
+    Nested blocks are handled with an explicit stack of pending statements and
+    continuations, which patch jump offsets once the length of a block is known.
+    `returns` tracks for every open block whether it contains a return.
+    """
+    def __init__(self):
+        self.code: List[Code] = []
+        self.returns: List[bool] = [False]
+        self.pending: List[Union[Ast, Callable[[], None]]] = []
+
+    def compile(self, tree: Ast) -> List[Code]:
+        self.pending.append(tree)
+        while self.pending:
+            task = self.pending.pop()
+            if callable(task):
+                task()
+            else:
+                self.visit(task)
+        return self.code
+
+    def close_block(self) -> bool:
+        returns = self.returns.pop()
+        self.returns[-1] = self.returns[-1] or returns
+        return returns
+
     def visit_If(self, tree: If):
-        then = self.visit(tree.then)
-        flatten(then)
-        els = self.visit(tree.els) if tree.els else []
-        flatten(els)
         # jump when condition is true -> else block comes first
-        els_offset = len(els) + 2
-        els.append(Jump(len(then) + 1))
-        returns = False
-        for c in itertools.chain(then, els):
-            if isinstance(c, Return) or isinstance(c, ConditionalJump) and c.may_return:
-                returns = True
-                break
-        code: List[Code] = [ConditionalJump(tree.cond, els_offset, may_return = returns)]
-        code.append(els)
-        code.append(then)
-        code.append(EndBlock())
-        return code
+        code = self.code
+        start = len(code)
+        cond = ConditionalJump(tree.cond, 0)
+        code.append(cond)
+        self.returns.append(False)
+
+        def after_else():
+            skip = Jump(0)
+            code.append(skip)
+            then_start = len(code)
+            cond.offset = then_start - start
+
+            def after_then():
+                skip.offset = len(code) - then_start + 1
+                code.append(EndBlock())
+                cond.may_return = self.close_block()
+
+            self.pending.append(after_then)
+            self.pending.append(tree.then)
+
+        self.pending.append(after_else)
+        if tree.els:
+            self.pending.append(tree.els)
 
     def visit_While(self, tree: While):
-        body_code = self.visit(tree.body)
-        body_code.append(EndBlock(True))
-        flatten(body_code)
-        returns = False
-        for c in body_code:
-            if isinstance(c, Return) or isinstance(c, ConditionalJump) and c.may_return:
-                returns = True
-                break
+        code = self.code
         # jump to conditional in the end
-        body_len = len(body_code) + 1
-        # jump back all the way
-        while_offset = -len(body_code)
-        loop_head = [ConditionalJump(tree.cond, while_offset, is_loop=True, may_return=returns), EndBlock()]
-        while_code = [Jump(body_len)] + body_code + loop_head
-        return while_code
+        head = Jump(0)
+        code.append(head)
+        body_start = len(code)
+        self.returns.append(False)
+
+        def after_body():
+            code.append(EndBlock(True))
+            body_len = len(code) - body_start
+            head.offset = body_len + 1
+            # jump back all the way
+            code.append(ConditionalJump(tree.cond, -body_len, is_loop=True, may_return=self.close_block()))
+            code.append(EndBlock())
+
+        self.pending.append(after_body)
+        self.pending.append(tree.body)
 
     #TODO: collect locals, etc.
     #def visit_FunctionDef
 
     def generic_visit(self, tree: Ast):
         if isinstance(tree, list):
-            return list(map(self.visit, tree))
+            self.pending.extend(reversed(tree))
         elif isinstance(tree, Code):
-            return [tree]
+            if isinstance(tree, Return):
+                self.returns[-1] = True
+            self.code.append(tree)
         else:
             raise UnsupportedOperationError(f'{type(tree).__name__} is not supported')
 
 
+def _budget_message(steps: Optional[int]) -> str:
+    if steps is None:
+        return 'reached the step budget of the calling program'
+    return f'reached maximum of {steps} steps'
+
+
+def _remaining(outer: float, budget: float, left: float) -> float:
+    """Steps left of the budget `outer` of the caller after a run with `budget` ended with `left`."""
+    return outer if outer == math.inf else outer - (budget - left)
+
+
 class Interpreter:
+    # listeners for execution events, see `events.Events`
+    events = None
+    # whether `run` compiles hot loops, see `jit.LoopTrace`
+    jit = True
+    # number of evaluations of a loop condition after which the loop is traced
+    hot_loop = 50
+
     def __init__(self, code: Sequence[Code], scope: Scope, monitor: Optional[Monitor] = None):
         self.code = code
         self.scope = scope
@@ -655,6 +1988,28 @@ class Interpreter:
         self.monitor = monitor or Monitor()
         self.evaluator = ExpressionEvaluator(self.scope, self.monitor)
         self.return_value = None
+        self._iter = None
+        # loop condition executions and traces of hot loops by pc
+        self._loops: Dict[int, int] = {}
+        # whether the target or value of an assignment contains calls, by id of the value
+        self._calls: Dict[int, bool] = {}
+        self._traces = {}
+
+    def reset(self, scope: Scope, monitor: Optional[BaseMonitor] = None):
+        """Prepares the interpreter for a new run of its code in `scope`.
+        The current monitor is reset and reused unless `monitor` is given.
+        """
+        if monitor is None:
+            self.monitor.reset()
+        else:
+            self.monitor = monitor
+        self.scope = scope
+        self.evaluator.scope = scope
+        self.evaluator.monitor = self.monitor
+        self.pc = 0
+        self.return_value = None
+        self._iter = None
+        self.events = None
 
     def step(self):
         if 0 <= self.pc < len(self.code):
@@ -665,16 +2020,162 @@ class Interpreter:
             raise IllegalStateError(f'illegal pc {self.pc}')
 
     def run(self, steps=None):
-        if steps is None:
-            while (self.pc < len(self.code)):
-                self.step()
-        else:
-            for i in range(steps):
+        if self.events:
+            return self.events.run(self, steps)
+        monitor = self.monitor
+        outer = monitor.steps_left
+        budget = outer if steps is None else min(outer, steps)
+        # the remaining steps are kept on the monitor, so called functions count against them
+        monitor.steps_left = budget
+        traces = self._traces if self.jit else None
+        try:
+            while True:
+                if monitor.steps_left <= 0:
+                    raise MaximumStepsReached(_budget_message(steps))
                 if self.pc >= len(self.code):
                     break
+                if traces and self.pc in traces:
+                    n = traces[self.pc].enter(self, monitor.steps_left)
+                    if n:
+                        monitor.steps_left -= n
+                        continue
+                monitor.steps_left -= 1
                 self.step()
+        finally:
+            monitor.steps_left = _remaining(outer, budget, monitor.steps_left)
+
+    def run_iter(self):
+        """Resumable execution.
+        Generator that executes one step per iteration, including the steps of nested
+        function calls, and yields None after each. Calls to async builtins yield the
+        awaitable instead; the driver has to await it and send the result back.
+        """
+        while self.pc < len(self.code):
+            instruction = self.code[self.pc]
+            method = getattr(self, 'iter_' + type(instruction).__name__, None)
+            if method is not None:
+                self.pc += (yield from method(instruction)) or 1
+            elif isinstance(instruction, Expr):
+                yield from self.evaluator.iter_visit(instruction)
+                self.pc += 1
             else:
+                self.step()
+            yield
+
+    def step_chunk(self, n: int) -> bool:
+        """Executes at most `n` steps of resumable execution.
+        Returns whether the program has finished.
+        """
+        if self._iter is None:
+            self._iter = self.run_iter()
+        for i in range(n):
+            try:
+                awaitable = next(self._iter)
+            except StopIteration:
+                break
+            if awaitable is not None:
+                if hasattr(awaitable, 'close'):
+                    awaitable.close()
+                raise UnsupportedOperationError('async builtins need an asyncio scheduler')
+        return self.pc >= len(self.code)
+
+    # snapshot format: magic, format version, sha256 of the code, zlib compressed pickle
+    SNAPSHOT_MAGIC = b'MSSN'
+    SNAPSHOT_VERSION = 2
+    _snapshot_header = struct.Struct('>4sH32s')
+
+    def code_digest(self) -> bytes:
+        if getattr(self, '_code_digest', None) is None:
+            self._code_digest = hashlib.sha256(pickle.dumps(list(self.code), protocol=4)).digest()
+        return self._code_digest
+
+    def snapshot(self) -> bytes:
+        """Serializes the execution state.
+        The state consists of the pc, the scope chain including closures of user functions
+        and the monitor with its pc levels and loop heads. The code itself is only referenced
+        by its digest; pass it to `restore`.
+        Snapshots can only be taken between steps of the top level program, i.e. while
+        `monitor.return_address` is empty. The frames of a call in progress are python frames,
+        they aren't part of the state and taking a snapshot raises a `SnapshotError`.
+        """
+        if self.monitor.return_address:
+            raise SnapshotError('cannot take a snapshot inside a function call, '
+                                'only between steps of the top level program')
+        code = self.code
+
+        class _Pickler(pickle.Pickler):
+            def persistent_id(self, obj):
+                if obj is code:
+                    return 'code'
+                # the output channel and the input files belong to the host, the restored
+                # monitor prints directly and has no inputs
+                return 'host' if isinstance(obj, (Output, Inputs)) else None
+
+        buf = io.BytesIO()
+        _Pickler(buf, protocol=pickle.HIGHEST_PROTOCOL).dump(
+            (self.pc, self.scope, self.monitor, self.return_value))
+        header = self._snapshot_header.pack(self.SNAPSHOT_MAGIC, self.SNAPSHOT_VERSION, self.code_digest())
+        return header + zlib.compress(buf.getvalue(), 1)
+
+    @classmethod
+    def restore(cls, data: bytes, code: Sequence[Code]) -> 'Interpreter':
+        """Creates an interpreter from a snapshot taken of an interpreter running `code`.
+        Only restore trusted snapshots, they are unpickled.
+        """
+        header = cls._snapshot_header
+        if len(data) < header.size:
+            raise SnapshotError('truncated snapshot')
+        magic, version, digest = header.unpack_from(data)
+        if magic != cls.SNAPSHOT_MAGIC:
+            raise SnapshotError('not a snapshot')
+        if version != cls.SNAPSHOT_VERSION:
+            raise SnapshotError(f'unsupported snapshot version {version}')
+        interpreter = cls(code, Scope())
+        if interpreter.code_digest() != digest:
+            raise SnapshotError('snapshot was taken with different code')
+
+        class _Unpickler(pickle.Unpickler):
+            def persistent_load(self, pid):
+                if pid == 'code':
+                    return code
+                if pid == 'host':
+                    return None
+                raise pickle.UnpicklingError(f'unknown persistent id {pid}')
+
+        state = _Unpickler(io.BytesIO(zlib.decompress(data[header.size:]))).load()
+        interpreter.pc, interpreter.scope, interpreter.monitor, interpreter.return_value = state
+        interpreter.evaluator = ExpressionEvaluator(interpreter.scope, interpreter.monitor)
+        return interpreter
+
+    def fork(self, n: int = 1) -> List['Interpreter']:
+        """Creates `n` interpreters that continue from the current state.
+        Scopes are shared copy-on-write and values are shared between the forks, so forking
+        is cheap and the forks can be run independently of each other and of this interpreter.
+        Can only be called between steps of the top level program.
+        """
+        if self.monitor.return_address:
+            raise IllegalStateError('cannot fork inside a function call')
+        children = []
+        for i in range(n):
+            child = copy.copy(self)
+            child.scope = self.scope.fork({})
+            child.monitor = copy.deepcopy(self.monitor)
+            child.evaluator = ExpressionEvaluator(child.scope, child.monitor)
+            child._iter = None
+            children.append(child)
+        return children
+
+    def run_until(self, predicate: Callable[[Code], bool], steps: Optional[int] = None) -> bool:
+        """Runs until `predicate` is true for the next instruction or the program ends.
+        Returns whether the program has finished.
+        """
+        for i in itertools.count():
+            if self.pc >= len(self.code) or predicate(self.code[self.pc]):
+                break
+            if steps is not None and i >= steps:
                 raise MaximumStepsReached(f'reached maximum of {steps} steps')
+            self.step()
+        return self.pc >= len(self.code)
 
     def evaluate(self, expr):
         return self.evaluator.visit(expr)
@@ -683,6 +2184,13 @@ class Interpreter:
         return g.offset
 
     def run_ConditionalJump(self, j: ConditionalJump):
+        if j.is_loop and self.jit:
+            n = self._loops[self.pc] = self._loops.get(self.pc, 0) + 1
+            if n == self.hot_loop:
+                from .jit import LoopTrace
+                trace = LoopTrace.create(self.code, self.pc)
+                if trace is not None:
+                    self._traces[self.pc] = trace
         result = self.evaluate(j.expr)
         self.monitor.handle_enter_block(result, j.is_loop, j.may_return)
         if is_falsy(result):
@@ -691,12 +2199,21 @@ class Interpreter:
             return j.offset
 
     def run_Assign(self, a: Assign):
-        result = self.monitor.handle_secure_assign(a, self.scope, self.evaluator)
-        # todo: proper target lookup for assign (e.g. array indeices, etc)
-        if isinstance(a.target, Name):
-            self.scope[a.target.name] = result
+        self.assign(a)
+
+    def assign(self, a: Assign) -> Type:
+        """Executes an assignment and returns the stored value.
+        """
+        if isinstance(a.target, (Index, Attribute)):
+            container, key, key_label = self.evaluator.member_target(a.target)
+            self.monitor.check_member_assign(container, key_label)
+            value = self.monitor.label_member_assign(self.evaluate(a.value), key_label)
+            self.evaluator.store_member(a.target, container, key, value)
+        elif isinstance(a.target, Name):
+            value = self.scope[a.target.name] = self.monitor.handle_secure_assign(a, self.scope, self.evaluator)
         else:
-            raise NotYetImplementedError(f'currently only assignment to name is supported')
+            raise NotYetImplementedError(f'currently only assignment to names, array elements and fields is supported')
+        return value
 
     def run_Return(self, r: Return):
         value = self.evaluate(r.expr)
@@ -710,6 +2227,43 @@ class Interpreter:
         if v.value:
             self.run_Assign(Assign(v.name, v.value))
 
+    def iter_ConditionalJump(self, j: ConditionalJump):
+        result = yield from self.evaluator.iter_visit(j.expr)
+        self.monitor.handle_enter_block(result, j.is_loop, j.may_return)
+        if is_falsy(result):
+            return 1
+        else:
+            return j.offset
+
+    def iter_Assign(self, a: Assign):
+        calls = self._calls.get(id(a.value))
+        if calls is None:
+            calls = self._calls[id(a.value)] = _CallFinder().visit([a.target, a.value])
+        if not calls:
+            # nothing to step through, so it runs exactly like in `run`
+            self.run_Assign(a)
+        elif isinstance(a.target, (Index, Attribute)):
+            container, key, key_label = yield from self.evaluator.iter_member_target(a.target)
+            self.monitor.check_member_assign(container, key_label)
+            result = yield from self.evaluator.iter_visit(a.value)
+            self.evaluator.store_member(a.target, container, key, self.monitor.label_member_assign(result, key_label))
+        elif isinstance(a.target, Name):
+            # like `handle_secure_assign` with the value evaluated step by step
+            self.monitor.check_assign(a.target, self.scope)
+            result = yield from self.evaluator.iter_visit(a.value)
+            self.scope[a.target.name] = self.monitor.label_assign(result)
+        else:
+            raise NotYetImplementedError(f'currently only assignment to names, array elements and fields is supported')
+
+    def iter_Return(self, r: Return):
+        value = yield from self.evaluator.iter_visit(r.expr)
+        self.monitor.handle_return(value)
+        raise ReturnStatement(value, r)
+
+    def iter_VarDecl(self, v: VarDecl):
+        if v.value:
+            yield from self.iter_Assign(Assign(v.name, v.value))
+
     def generic_run(self, instruction):
         if isinstance(instruction, Expr):
             self.evaluate(instruction)
@@ -717,12 +2271,90 @@ class Interpreter:
             raise UnsupportedOperationError(f'{instruction} not supported')
 
 
+class Program:
+    """A compiled program that can be run many times with different inputs.
+    The code and the list of global variables are never modified by a run,
+    so `run` may be called repeatedly and from several threads at once.
+    Interpreters of finished runs are kept in a small pool and reused by later runs.
+    """
+    # maximum number of idle interpreters kept for reuse
+    POOL_SIZE = 8
+
+    def __init__(self, code: Sequence[Code], globalvars: Sequence[str] = ()):
+        self.code = tuple(code)
+        self.globalvars = tuple(globalvars)
+        self._pool: List[Interpreter] = []
+
+    @classmethod
+    def from_source(cls, source: str) -> 'Program':
+        ast = parse(source)
+        return cls(compile(ast), collect_locals(ast))
+
+    def scope(self, bindings: Optional[Mapping[str, Type]] = None) -> GlobalScope:
+        """Creates a fresh global scope with the program's globals and `bindings` declared.
+        :param bindings: input values by name. They are copied, so the same values can be passed
+            to several runs. Their labels are kept.
+        """
+        scope = GlobalScope()
+        for var in self.globalvars:
+            scope.declare(var)
+        if bindings:
+            for name, value in bindings.items():
+                scope.declare(name, copy.deepcopy(value))
+        return scope
+
+    def interpreter(self, bindings: Optional[Mapping[str, Type]] = None,
+                    monitor: Optional[BaseMonitor] = None,
+                    output: Optional[Output] = None,
+                    inputs: Optional[Inputs] = None) -> Interpreter:
+        """Creates an interpreter with a fresh global scope, see `scope`.
+        A pooled interpreter is reset and returned if there is one.
+        :param output: channel for the printed output, see `output.Output`
+        :param inputs: files the script may read, see `inputs.Inputs`
+        """
+        scope = self.scope(bindings)
+        try:
+            interpreter = self._pool.pop()
+        except IndexError:
+            interpreter = Interpreter(self.code, scope, monitor or Monitor())
+        else:
+            interpreter.reset(scope, monitor)
+        if output is not None:
+            interpreter.monitor.output = output
+        if inputs is not None:
+            interpreter.monitor.inputs = inputs
+        return interpreter
+
+    def release(self, interpreter: Interpreter):
+        """Hands an interpreter created by `interpreter` back for reuse.
+        Neither the interpreter nor its monitor may be used by the caller afterwards,
+        the scope of the finished run is not touched.
+        """
+        if len(self._pool) < self.POOL_SIZE:
+            self._pool.append(interpreter)
+
+    def run(self, bindings: Optional[Mapping[str, Type]] = None,
+            monitor: Optional[BaseMonitor] = None,
+            budget: Optional[int] = None,
+            output: Optional[Output] = None,
+            inputs: Optional[Inputs] = None) -> Scope:
+        """Runs the program and returns the resulting global scope.
+        :param budget: maximum number of steps, raises `MaximumStepsReached` when exceeded
+        :param output: channel for the printed output, flushed when the run ends
+        :param inputs: files the script may read, they stay open for the caller
+        """
+        interpreter = self.interpreter(bindings, monitor, output, inputs)
+        scope = interpreter.scope
+        try:
+            interpreter.run(budget)
+        finally:
+            if output is not None:
+                output.flush()
+            # a monitor passed by the caller is theirs to inspect, keep it out of the pool
+            if monitor is None:
+                self.release(interpreter)
+        return scope
+
+
 def make_interpreter(source: str):
-    ast = parse(source)
-    globalvars = collect_locals(ast)
-    code = compile(ast)
-    scope = GlobalScope()
-    monitor = Monitor()
-    for var in globalvars:
-        scope.declare(var)
-    return Interpreter(code, scope, monitor)
+    return Program.from_source(source).interpreter()
@@ -0,0 +1,244 @@
+"""Tracing compiler for hot loops.
+
+`Interpreter.run` counts how often the condition of every loop is evaluated. Once a loop
+is hot and its body is a straight line of assignments of number and boolean expressions
+to variables, iterations are recorded in the interpreter. The recording yields the types
+of the variables and the monitor counters of one iteration. The loop is then compiled to
+a python function specialized for these types, which runs whole iterations on unboxed
+values.
+
+Every entry into a compiled loop is guarded. The variables must still have the recorded
+types, neither they nor the pc level may carry a label, and the monitor must only combine
+the rules of this package. Under these conditions every label the rules compute stays
+empty, so the compiled code doesn't need to track them. Failing guards and iterations
+that raise leave execution to the interpreter, which then repeats the iteration.
+"""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .miniscript_ast import *
+from .interpreter import (ArithmeticOpRule, AssignRule, BaseMonitor, BlockAndLoopRule, BlockLoopReturnRule, BlockRule,
+                          ExpressionEvaluator, IndexRule, Interpreter, LiteralRule, Monitor, RefError, ReturnRule,
+                          TBoolean, TNumber, UnaryOperatorRule)
+
+__all__ = ['LoopTrace']
+
+# rules whose labels stay empty while all inputs and the pc level are unlabeled
+_STOCK_RULES = {
+    BaseMonitor, BlockRule, BlockAndLoopRule, BlockLoopReturnRule, LiteralRule, ArithmeticOpRule, UnaryOperatorRule,
+    IndexRule, AssignRule, ReturnRule, Monitor, object
+}
+# class attributes of a monitor that only combines rules
+_PLAIN_ATTRIBUTES = {'__module__', '__qualname__', '__doc__', '__firstlineno__', '__static_attributes__'}
+_supported_monitors: Dict[type, bool] = {}
+
+_ARITHMETIC = {'+', '-', '*', '/', '%'}
+_COMPARISONS = {'<', '<=', '>', '>=', '==', '!='}
+_TYPES = {TNumber: 'number', TBoolean: 'boolean'}
+
+
+def _supported_monitor(monitor: BaseMonitor) -> bool:
+    cls = type(monitor)
+    supported = _supported_monitors.get(cls)
+    if supported is None:
+        supported = _supported_monitors[cls] = all(c in _STOCK_RULES or not set(vars(c)) - _PLAIN_ATTRIBUTES
+                                                   for c in cls.__mro__)
+    return supported
+
+
+def _supported_interpreter(interpreter: Interpreter) -> bool:
+    cls = type(interpreter)
+    return (type(interpreter.evaluator) is ExpressionEvaluator and cls.step is Interpreter.step
+            and cls.run_ConditionalJump is Interpreter.run_ConditionalJump and cls.run_Assign is Interpreter.run_Assign
+            and cls.assign is Interpreter.assign and cls.run_EndBlock is Interpreter.run_EndBlock
+            and cls.run_VarDecl is Interpreter.run_VarDecl)
+
+
+def _traceable(tree: Expr) -> bool:
+    if isinstance(tree, (Number, Boolean, Name)):
+        return True
+    elif isinstance(tree, BinOp):
+        return tree.op in _ARITHMETIC | _COMPARISONS and _traceable(tree.left) and _traceable(tree.right)
+    elif isinstance(tree, UnaryOp):
+        return tree.op in ('-', '!') and _traceable(tree.expr)
+    return False
+
+
+def _names(tree: Expr, names: set):
+    if isinstance(tree, Name):
+        names.add(tree.name)
+    elif isinstance(tree, BinOp):
+        _names(tree.left, names)
+        _names(tree.right, names)
+    elif isinstance(tree, UnaryOp):
+        _names(tree.expr, names)
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Emitter:
+    """Translates expressions to python source for the given variable types.
+    `env` maps variable names to their python name and type.
+    """
+    def __init__(self, env: Dict[str, Tuple[str, str]]):
+        self.env = env
+        self.constants: List[object] = []
+
+    def expr(self, tree: Expr) -> Tuple[str, str]:
+        if isinstance(tree, (Number, Boolean)):
+            self.constants.append(tree.value)
+            return f'c{len(self.constants) - 1}', 'number' if isinstance(tree, Number) else 'boolean'
+        elif isinstance(tree, Name):
+            return self.env[tree.name]
+        elif isinstance(tree, UnaryOp):
+            e, _ = self.expr(tree.expr)
+            # `!` is true for falsy operands, which are 0 and false
+            return (f'(-{e})', 'number') if tree.op == '-' else (f'({e} == 0)', 'boolean')
+        left, left_type = self.expr(tree.left)
+        right, right_type = self.expr(tree.right)
+        if tree.op in ('==', '!=') and left_type != right_type:
+            # values of different types never compare equal
+            raise _Unsupported()
+        return f'({left} {tree.op} {right})', 'number' if tree.op in _ARITHMETIC else 'boolean'
+
+
+class LoopTrace:
+    """A loop whose condition is the `ConditionalJump` at `head`.
+    `enter` records and then runs compiled iterations, one function per combination
+    of variable types.
+    """
+    # maximum number of iterations per call of a compiled loop. the values are only written
+    # back to the scope when it returns, so this bounds the progress lost to e.g. a timeout
+    chunk = 1 << 16
+
+    def __init__(self, head: int, start: int, cond: Expr, body: List[Code]):
+        self.head = head
+        self.start = start
+        self.cond = cond
+        self.body = body
+        # condition, statements and the closing EndBlock
+        self.steps = len(body) + 2
+        names = set()
+        _names(cond, names)
+        for s in body:
+            if isinstance(s, Assign):
+                names.add(s.target.name)
+                _names(s.value, names)
+        self.names = sorted(names)
+        self.written = sorted({s.target.name for s in body if isinstance(s, Assign)})
+        # counter changes per iteration by monitor class, and candidates awaiting confirmation
+        self.deltas: Dict[type, Dict[str, int]] = {}
+        self._recorded: Dict[type, Dict[str, int]] = {}
+        self.compiled: Dict[Tuple[type, ...], Optional[Callable]] = {}
+        self.sources: Dict[Tuple[type, ...], str] = {}
+
+    @classmethod
+    def create(cls, code: Sequence[Code], head: int) -> Optional['LoopTrace']:
+        """Returns the trace for the loop at `head` or None if its body isn't supported."""
+        j = code[head]
+        start = head + j.offset
+        if j.may_return or not 0 <= start < head or code[head - 1] != EndBlock(True) or not _traceable(j.expr):
+            return None
+        body = list(code[start:head - 1])
+        for s in body:
+            if isinstance(s, Assign):
+                if not isinstance(s.target, Name) or not _traceable(s.value):
+                    return None
+            elif not (isinstance(s, VarDecl) and s.value is None):
+                return None
+        return cls(head, start, j.expr, body)
+
+    def enter(self, interpreter: Interpreter, budget: float) -> int:
+        """Runs iterations of the loop while the guards hold. `interpreter.pc` has to be at
+        the loop condition. Returns the number of steps executed, 0 if nothing was run.
+        """
+        monitor = interpreter.monitor
+        if budget < self.steps or monitor.current_pc_level or not _supported_monitor(monitor) \
+                or not _supported_interpreter(interpreter):
+            return 0
+        if isinstance(monitor, BlockAndLoopRule) \
+                and monitor.loop_continues.get(len(monitor.return_address)) != len(monitor.pc_levels):
+            # the first evaluation of the condition enters the loop, which is left to the interpreter
+            return 0
+        scope = interpreter.scope
+        values = []
+        for name in self.names:
+            try:
+                value = scope[name]
+            except RefError:
+                return 0
+            if type(value) not in _TYPES or value.label:
+                return 0
+            values.append(value)
+        delta = self.deltas.get(type(monitor))
+        if delta is None:
+            return self.record(interpreter)
+        signature = tuple(type(v) for v in values)
+        try:
+            f = self.compiled[signature]
+        except KeyError:
+            f = self.compiled[signature] = self.compile(signature)
+        if f is None:
+            return 0
+        n = self.chunk if budget == float('inf') else min(self.chunk, int(budget // self.steps))
+        k, *results = f(*[v.value for v in values], n)
+        if k:
+            types = dict(zip(self.names, signature))
+            for name, value in zip(self.names, results):
+                if name in self.written:
+                    scope[name] = types[name](value, set())
+            counters = monitor.counters
+            for key, d in delta.items():
+                counters[key] += k * d
+        return k * self.steps
+
+    def record(self, interpreter: Interpreter) -> int:
+        """Runs one iteration in the interpreter and keeps the changes of the monitor counters.
+        They are trusted once two iterations in a row agree.
+        """
+        monitor = interpreter.monitor
+        before = dict(monitor.counters)
+        interpreter.step()
+        if interpreter.pc != self.start:
+            # the loop ended
+            return 1
+        while interpreter.pc != self.head:
+            interpreter.step()
+        cls = type(monitor)
+        delta = {k: v - before[k] for k, v in monitor.counters.items() if not k.startswith('max_')}
+        if self._recorded.get(cls) == delta:
+            self.deltas[cls] = delta
+        self._recorded[cls] = delta
+        return self.steps
+
+    def compile(self, signature: Tuple[type, ...]) -> Optional[Callable]:
+        """Generates the function running iterations for variables of the types in `signature`.
+        It takes the unboxed values and the maximum number of iterations and returns the number of
+        completed iterations followed by the new values. Returns None if the types don't check,
+        e.g. when a variable would change its type.
+        """
+        params = {name: f'v{i}' for i, name in enumerate(self.names)}
+        emitter = _Emitter({name: (params[name], _TYPES[t]) for name, t in zip(self.names, signature)})
+        try:
+            cond, cond_type = emitter.expr(self.cond)
+            lines = [f'if not {cond}: break' if cond_type == 'boolean' else f'if {cond} == 0: break']
+            # statements assign to temporaries, so an iteration that raises leaves the variables untouched
+            for i, s in enumerate(self.body):
+                if isinstance(s, Assign):
+                    value, value_type = emitter.expr(s.value)
+                    if value_type != emitter.env[s.target.name][1]:
+                        raise _Unsupported()
+                    lines.append(f't{i} = {value}')
+                    emitter.env[s.target.name] = (f't{i}', value_type)
+        except _Unsupported:
+            return None
+        lines += [f'{params[name]} = {emitter.env[name][0]}' for name in self.written] + ['k += 1']
+        constants = ''.join(f', c{i}=c{i}' for i in range(len(emitter.constants)))
+        source = '\n'.join([f'def trace({"".join(p + ", " for p in params.values())}n{constants}):', '    k = 0',
+                            '    try:', '        while k < n:'] + ['            ' + l for l in lines] +
+                           ['    except ArithmeticError:', '        pass', f'    return k, {", ".join(params.values())}'])
+        namespace = {f'c{i}': c for i, c in enumerate(emitter.constants)}
+        exec(source, namespace)
+        self.sources[signature] = source
+        return namespace['trace']
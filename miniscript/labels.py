@@ -0,0 +1,111 @@
+"""Labels encoded as bitmasks over a table of interned principals.
+
+Packed arrays whose elements have different labels store one integer mask per element
+instead of a reference to a set. Every principal (the strings a label consists of) gets
+a bit in a process wide table. Joining the labels of many elements is then a bitwise or
+over the distinct masks, which is decoded into a set once.
+"""
+import array
+import functools
+import operator
+import threading
+from typing import Dict, Iterable, List, Sequence, Set
+
+__all__ = ['PrincipalTable', 'principals', 'mask_vector']
+
+
+class PrincipalTable:
+    """Assigns a bit to every principal and converts between labels and masks.
+    Decoded labels are cached and shared, so they must not be modified in place
+    (which no label is). The caches are emptied when they reach `cache_size` entries.
+    """
+    cache_size = 1 << 16
+
+    def __init__(self):
+        self.bits: Dict[str, int] = {}
+        self.principals: List[str] = []
+        self._labels: Dict[int, Set[str]] = {0: set()}
+        self._masks: Dict[frozenset, int] = {frozenset(): 0}
+        self._lock = threading.Lock()
+
+    def _bit(self, principal: str) -> int:
+        bit = self.bits.get(principal)
+        if bit is None:
+            with self._lock:
+                bit = self.bits.get(principal)
+                if bit is None:
+                    bit = self.bits[principal] = len(self.principals)
+                    self.principals.append(principal)
+        return bit
+
+    def mask(self, label: Iterable[str]) -> int:
+        key = frozenset(label)
+        m = self._masks.get(key)
+        if m is None:
+            m = 0
+            for p in key:
+                m |= 1 << self._bit(p)
+            if len(self._masks) >= self.cache_size:
+                self._masks.clear()
+            self._masks[key] = m
+        return m
+
+    def label(self, mask: int) -> Set[str]:
+        label = self._labels.get(mask)
+        if label is None:
+            if len(self._labels) >= self.cache_size:
+                self._labels.clear()
+            label = self._labels.setdefault(
+                mask, {p for i, p in enumerate(self.principals) if mask >> i & 1})
+        return label
+
+    def join(self, masks: Iterable[int]) -> int:
+        """Bitwise or of `masks`, each distinct mask is only looked at once."""
+        result = 0
+        for m in set(masks):
+            result |= m
+        return result
+
+
+    def translate(self, cell: dict):
+        """Converts the masks of an unpickled array from the bits of this table to the bits
+        of `principals`. Arrays sharing their contents share the masks, which are only converted once.
+        """
+        if self is principals or id(cell) in self._translated:
+            return
+        self._translated.add(id(cell))
+        if self._translation is None:
+            # the bit in `principals` of every bit of this table, or nothing to do
+            bits = [principals.mask((p, )) for p in self.principals]
+            self._translation = bits if any(b != 1 << i for i, b in enumerate(bits)) else ()
+        bits = self._translation
+        if bits:
+            cell['_masks'] = mask_vector([
+                functools.reduce(operator.or_, (b for i, b in enumerate(bits) if m >> i & 1), 0) for m in cell['_masks']
+            ])
+
+    def __reduce__(self):
+        # masks are pickled with the principals they refer to, see `TArray.__getstate__`
+        return _table, (tuple(self.principals), )
+
+
+def _table(names: Sequence[str]) -> PrincipalTable:
+    table = PrincipalTable()
+    table.principals = list(names)
+    table.bits = {p: i for i, p in enumerate(names)}
+    table._translated = set()
+    table._translation = None
+    return table
+
+
+principals = PrincipalTable()
+
+
+def mask_vector(masks: Sequence[int]):
+    """Compact storage for `masks`: an unsigned 64 bit array while all masks fit,
+    a list of ints once more than 64 principals are in use.
+    """
+    try:
+        return array.array('Q', masks)
+    except OverflowError:
+        return list(masks)
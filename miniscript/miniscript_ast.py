@@ -1,4 +1,4 @@
-from typing import Optional, Sequence, Callable, TypeVar, Union, List
+from typing import Optional, Sequence, Callable, TypeVar, Union, List, Dict
 T = TypeVar('T')
 
 __all__ = [
@@ -12,27 +12,59 @@ __all__ = [
 class NodeVisitor:
     """Visitor class for ast nodes.
     Subclasses should implement visit_<Name> for any ast nodes they are interested in.
-    The fallback `generic_visit` traverses the whole tree and recursively 
+    The fallback `generic_visit` traverses the whole tree with an explicit stack, so
+    deeply nested trees don't run into the recursion limit.
+    The method for a node type is looked up once per visitor class and cached, so
+    `visit_<Name>` methods have to be defined on the class and not on an instance.
     """
+    _dispatch: Dict[type, Callable] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._dispatch = {}
+
+    @classmethod
+    def _method(cls, node_type: type) -> Callable:
+        method = getattr(cls, 'visit_' + node_type.__name__, cls.generic_visit)
+        cls._dispatch[node_type] = method
+        return method
+
     def visit(self, tree: 'Ast'):
         """Calls the appropriate `visit_<Name>` method for `tree`.
         If no suitable visitor method is found this calls `generic_visit`
         """
-        # inspired by cpython ast.py
-        method = 'visit_' + type(tree).__name__
-        visitor = getattr(self, method, self.generic_visit)
-        return visitor(tree)
+        try:
+            method = self._dispatch[type(tree)]
+        except KeyError:
+            method = self._method(type(tree))
+        return method(self, tree)
 
     def generic_visit(self, tree: 'Ast'):
         """Generic visitor method.
+        Visits the elements of lists and all fields of nodes that are nodes or lists
+        in source order. Children without a `visit_<Name>` method are expanded in
+        place instead of recursing.
         """
-        if isinstance(tree, list):
-            for e in tree:
-                self.visit(e)
-        else:
-            for field in map(lambda f: getattr(tree, f), tree._locals):
-                if isinstance(field, Stmt):
-                    self.visit(field)
+        dispatch = self._dispatch
+        generic = NodeVisitor.generic_visit
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if node is not tree:
+                try:
+                    method = dispatch[type(node)]
+                except KeyError:
+                    method = self._method(type(node))
+                if method is not generic:
+                    method(self, node)
+                    continue
+            if isinstance(node, list):
+                stack.extend(reversed(node))
+            else:
+                for f in reversed(node._locals):
+                    field = getattr(node, f)
+                    if isinstance(field, (Structured, list)):
+                        stack.append(field)
         return tree
 
 
@@ -235,6 +267,13 @@ class Attribute(Expr):
     def __init__(self, value: Expr, attr: str):
         self.value = value
         self.attr = attr
+        # inline cache of the interpreter, see `TObject`
+        self.cache = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['cache'] = None
+        return state
 
     # def __repr__(self):
     #     return f'{type(self).__name__}({repr(self.value)}, {repr(self.attr)})'
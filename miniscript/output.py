@@ -0,0 +1,83 @@
+"""Buffered output channels for `print` and `labelPrint`.
+
+Without a channel the builtins write every call to `sys.stdout` right away. When the
+monitor of a run has an `Output` (see `Program.run`), every call instead becomes a
+`Record` of the printed text, the label of the printed values and the pc level of the
+call. Records are written to a stream in batches, kept in memory for the embedder, or
+handed out by a generator while the script runs. Records the reader isn't cleared for
+are dropped or redacted before they are stored.
+"""
+from typing import IO, Iterator, List, NamedTuple, Optional, Set
+
+__all__ = ['Output', 'Record']
+
+
+class Record(NamedTuple):
+    text: str
+    label: Set[str]
+    pc_level: Set[str]
+
+
+class Output:
+    """Output channel of a run.
+    :param stream: file the records are written to, None keeps them in `records`
+    :param buffer_size: number of records collected before they are written to the stream,
+        1 writes every record at once
+    :param clearance: label of the reader. records whose label or pc level don't flow to it
+        are dropped, None lets everything through
+    :param redact: text that replaces records above the clearance instead of dropping them
+    """
+    def __init__(self, stream: Optional[IO[str]] = None, buffer_size: int = 1024,
+                 clearance: Optional[Set[str]] = None, redact: Optional[str] = None):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.clearance = clearance
+        self.redact = redact
+        self.records: List[Record] = []
+        # number of records dropped because of the clearance
+        self.dropped = 0
+
+    def emit(self, text: str, label: Set[str], pc_level: Set[str]):
+        clearance = self.clearance
+        if clearance is not None and not (label <= clearance and pc_level <= clearance):
+            if self.redact is None:
+                self.dropped += 1
+                return
+            text = self.redact
+        self.records.append(Record(text, label, pc_level))
+        if self.stream is not None and len(self.records) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffered records to the stream in a single write.
+        Does nothing when the records are captured.
+        """
+        if self.stream is not None and self.records:
+            records, self.records = self.records, []
+            self.stream.write(''.join(r.text + '\n' for r in records))
+            self.stream.flush()
+
+    def getvalue(self) -> str:
+        """The captured output as it would have been printed."""
+        return ''.join(r.text + '\n' for r in self.records)
+
+    def follow(self, interpreter, steps: int = 1000) -> Iterator[Record]:
+        """Runs `interpreter` with this channel in chunks of `steps` steps and yields the
+        records printed by each chunk, so the caller can consume them while the script runs.
+        """
+        interpreter.monitor.output = self
+        done = False
+        while not done:
+            done = interpreter.step_chunk(steps)
+            records, self.records = self.records, []
+            yield from records
+
+    def __deepcopy__(self, memo):
+        # forks of an interpreter print to the same channel
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
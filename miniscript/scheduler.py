@@ -0,0 +1,63 @@
+import asyncio
+from typing import Iterable, List, Optional
+
+from .interpreter import Interpreter, MaximumStepsReached, Scope, _budget_message, _remaining
+
+__all__ = ['Scheduler']
+
+
+class Scheduler:
+    """Runs many interpreters cooperatively on one asyncio event loop.
+    Every interpreter executes at most `chunk` steps before it yields to the event loop,
+    so interpreters sharing a loop make progress in round robin order. Async builtins
+    are awaited without blocking the other interpreters.
+    """
+    def __init__(self, chunk: int = 100):
+        self.chunk = chunk
+
+    async def run(self, interpreter: Interpreter, budget: Optional[int] = None) -> Scope:
+        """Runs `interpreter` to completion and returns its scope.
+        :param budget: maximum number of steps including steps of called functions.
+            `MaximumStepsReached` is raised when the script needs more.
+        Cancelling the task running this coroutine stops the script at its next step.
+        """
+        monitor = interpreter.monitor
+        outer = monitor.steps_left
+        limit = outer if budget is None else min(outer, budget)
+        # like `Interpreter.run`, nested runs that don't go step by step count against the budget
+        monitor.steps_left = limit
+        it = interpreter.run_iter()
+        try:
+            while True:
+                for i in range(self.chunk):
+                    item = next(it)
+                    while item is not None:
+                        try:
+                            result = await item
+                        except Exception as e:
+                            item = it.throw(e)
+                        else:
+                            item = it.send(result)
+                    monitor.steps_left -= 1
+                    if monitor.steps_left <= 0:
+                        if interpreter.pc >= len(interpreter.code):
+                            return interpreter.scope
+                        raise MaximumStepsReached(_budget_message(budget))
+                await asyncio.sleep(0)
+        except StopIteration:
+            return interpreter.scope
+        finally:
+            it.close()
+            monitor.steps_left = _remaining(outer, limit, monitor.steps_left)
+
+    def submit(self, interpreter: Interpreter, budget: Optional[int] = None) -> 'asyncio.Task':
+        """Schedules `interpreter` on the running event loop and returns its task.
+        """
+        return asyncio.ensure_future(self.run(interpreter, budget))
+
+    async def run_all(self, interpreters: Iterable[Interpreter], budget: Optional[int] = None) -> List:
+        """Runs all interpreters concurrently.
+        Returns their scopes, or the exception for scripts that failed.
+        """
+        tasks = [self.submit(i, budget) for i in interpreters]
+        return await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
-import sys
+import argparse
 
 from miniscript import *
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a miniscript program')
+    parser.add_argument('file', nargs='?', help='source file. reads from stdin if omitted')
+    parser.add_argument('--stats', action='store_true', help='print monitor overhead counters')
+    args = parser.parse_args()
     code = ''
     # todo: replace this with statement evaluator when its ready
-    if len(sys.argv) > 1:
-        with open(sys.argv[1]) as f:
+    if args.file:
+        with open(args.file) as f:
             lines = f.readlines()
     else:
         lines = []
@@ -28,3 +32,6 @@ if __name__ == '__main__':
     except InterpreterError as err:
         print(err)
     print(interpreter.scope)
+    if args.stats:
+        for name, value in interpreter.monitor.stats().items():
+            print(f'{name}: {value}')
@@ -0,0 +1,69 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+import context
+from miniscript.forkserver import ForkServer, request
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('forkserver') / 'ms.sock')
+    process = multiprocessing.get_context('fork').Process(target=ForkServer(path, budget=10000).serve_forever,
+                                                          daemon=True)
+    process.start()
+    for i in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.05)
+    yield path
+    process.terminate()
+    process.join()
+
+
+class TestForkServer:
+    def test_run(self, server):
+        r = request(server, 'y = x * 2; print(y);', {'x': {'value': 21, 'label': ['alice']}})
+        assert r['error'] is None
+        assert r['scope']['y'] == {'type': 'TNumber', 'value': 42, 'label': ['alice']}
+        assert r['scope']['x']['label'] == ['alice']
+        assert 'print' not in r['scope']
+        assert r['output'] == '42\n'
+
+    def test_isolation(self, server):
+        r1 = request(server, 'a = [1, "x", true];')
+        r2 = request(server, 'b = 1;')
+        assert r1['scope']['a']['value'][1] == {'type': 'TString', 'value': 'x', 'label': []}
+        assert 'a' not in r2['scope']
+
+    def test_errors(self, server):
+        assert request(server, 'while (true) { x = 1; }')['error'].startswith('MaximumStepsReached')
+        r = request(server, 'while (true) { x = 1; }', budget=10**9, timeout=0.2)
+        assert r['error'].startswith('TimeoutReached')
+        assert r['scope']['x']['value'] == 1
+        assert request(server, 'x = ;')['error'].startswith('CompileError')
+        r = request(server, 'x = 0; if (h) { x = 1; }', {'h': {'value': True, 'label': ['high']}})
+        assert r['error'].startswith('FlowControlError')
+
+    def test_called_functions(self, server):
+        r = request(server, 'function f() { while (true) { x = 1; } } f();')
+        assert r['error'].startswith('MaximumStepsReached')
+        r = request(server, 'function f(n) { return f(n + 1); } f(0);', budget=10**9)
+        assert r['error'].split(':')[0] in ('RecursionError', 'MaximumStepsReached')
+
+    def test_large_scope(self, server):
+        source = 'x = [1]; i = 0; while (i < 20) { x = [x, x]; i = i + 1; }'
+        r = request(server, source)
+        assert r['error'].startswith('ResponseTooLarge')
+        assert r['scope'] == {}
+        # the conversion counts against the time budget
+        start = time.monotonic()
+        r = request(server, source, timeout=0.2)
+        assert time.monotonic() - start < 1
+        assert r['error'].startswith('TimeoutReached')
+        r = request(server, 'm = dict(); set(m, "k", [1, 2]);')
+        assert r['scope']['m']['value'] == [[{'type': 'TString', 'value': 'k', 'label': []},
+                                             {'type': 'TArray', 'value': [{'type': 'TNumber', 'value': 1, 'label': []},
+                                                                          {'type': 'TNumber', 'value': 2, 'label': []}],
+                                              'label': []}]]
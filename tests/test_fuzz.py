@@ -0,0 +1,56 @@
+import random
+
+import pytest
+import context
+from miniscript import *
+from miniscript.fuzz import ProgramGenerator, check_program, fuzz, fuzz_program
+
+
+class TestFuzz:
+    def test_programs_parse(self):
+        for seed in range(50):
+            parse(ProgramGenerator(random.Random(seed)).program())
+
+    def test_engines_agree(self):
+        for seed in range(40):
+            executions, findings = fuzz_program(seed)
+            assert not [f for f in findings if f.kind in ('engine', 'parse')]
+
+    @pytest.mark.parametrize('seed', [209, 347, 2277])
+    def test_resumable_assignments(self, seed):
+        # assignments with calls were checked after the call in resumable execution
+        _, findings = fuzz_program(seed)
+        assert not [f for f in findings if f.kind == 'engine']
+
+    @pytest.mark.parametrize('seed', [20, 416])
+    def test_nested_loops(self, seed):
+        # loops in functions called from a loop body were taken for the enclosing loop
+        _, findings = fuzz_program(seed)
+        assert not [f for f in findings if f.kind == 'crash']
+
+    def test_converted_elements(self):
+        # converting an array to a string dropped the labels of the elements
+        _, findings = fuzz_program(1943)
+        assert not [f for f in findings if f.kind == 'interference']
+
+    def test_deeply_nested_string(self):
+        # converting nested arrays recursed until the stack depth of the engine ran out
+        _, findings = fuzz_program(626)
+        assert not [f for f in findings if f.kind == 'engine']
+
+    def test_finds_interference(self):
+        secrets = (TBoolean(True), TBoolean(False))
+        _, findings = check_program('if (h) { a = 1; }', secrets, monitor=BaseMonitor)
+        assert [f.kind for f in findings] == ['interference']
+        # the monitor stops the run, so there is nothing to compare
+        _, findings = check_program('if (h) { a = 1; }', secrets)
+        assert findings == []
+
+    def test_labeled_elements_are_secret(self):
+        _, findings = check_program('c = [1, h];', (TNumber(1), TNumber(2)))
+        assert findings == []
+
+    def test_workers(self):
+        programs, executions, findings = fuzz(0.5, workers=2)
+        assert programs > 0
+        assert executions >= programs
@@ -0,0 +1,100 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import context
+import miniscript as ms
+
+CHALLENGES = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'challenges'))
+sys.path.insert(0, CHALLENGES)
+import grade
+from common import Challenge, _SecretReader
+
+NAME = '03 - Rule 1 + 3'
+
+
+def read(name):
+    with open(os.path.join(CHALLENGES, NAME, name)) as f:
+        return f.read()
+
+
+class TestChallenge:
+    def test_compile_and_run_once(self):
+        challenge = grade.load_challenges([NAME])[NAME]
+        code = challenge.compile(read('solution.ms'))
+        assert all(challenge.run_once(code) for _ in range(8))
+        assert not challenge.run_once(challenge.compile(read('rejected.ms')))
+        with pytest.raises(ms.MaximumStepsReached):
+            challenge.run_once(challenge.compile('while (true) { l = 1; }'), 100)
+
+
+class TestRunForked:
+    def results(self, source, forked):
+        # the same secrets in the same order for both ways of running
+        secrets = iter(range(10, 20))
+        seen = []
+
+        def check(scope):
+            seen.append((scope['l'], scope['l'].label, scope['h']))
+            return True
+
+        challenge = Challenge('test', [('h', 'l', lambda: ms.TNumber(next(secrets), {'high'}))], ms.BaseMonitor,
+                              check=check, nruns=4)
+        code = challenge.compile(source)
+        if forked:
+            assert challenge.run_forked(code) == [True] * 4
+        else:
+            assert [challenge.run_once(code) for _ in range(4)] == [True] * 4
+        return seen
+
+    @pytest.mark.parametrize('source, distinct', [
+        # the secret is read in a called function, the prefix ends at the call
+        ('x = 1; function f() { return h * 2; } l = f() + x;', 4),
+        ('x = 1; function f(y) { return y + h; } l = f(x);', 4),
+        # the script overwrites the secret before reading it
+        ('x = 2; h = 5; l = h + x;', 1),
+        ('var t; t = 0; i = 0; while (i < 3) { t = t + h; i = i + 1; } l = t;', 4),
+        ('l = 0;', 1),
+    ])
+    def test_same_as_run_once(self, source, distinct):
+        forked = self.results(source, True)
+        assert forked == self.results(source, False)
+        assert len({l.value for l, _, _ in forked}) == distinct
+
+    def test_secret_reader(self):
+        reads = _SecretReader(['h'])
+        code = ms.compile(ms.parse('function f() { return h; } x = 1; y = f(); h = 2; z = x;'))
+        assert [reads(c) for c in code] == [False, False, True, True, False]
+
+
+class TestGrade:
+    def test_report(self, tmp_path):
+        submissions = tmp_path / 'submissions'
+        submissions.mkdir()
+        (submissions / 'accepted.ms').write_text(read('solution.ms'))
+        (submissions / 'rejected.ms').write_text(read('rejected.ms'))
+        (submissions / 'syntax.ms').write_text('l = ;')
+        (submissions / 'steps.ms').write_text('while (true) { l = 1; }')
+        # few steps that take long: comparing strings of two megabytes
+        (submissions / 'slow.ms').write_text(
+            's = "x"; i = 0; while (i < 21) { s = s + s; i = i + 1; } while (true) { t = s + s; u = t == s; }')
+        report_path = tmp_path / 'report.json'
+        subprocess.run([sys.executable, os.path.join(CHALLENGES, 'grade.py'), str(submissions), '-c', '03',
+                        '-o', str(report_path), '--steps', '100000', '--timeout', '0.3'], check=True)
+        report = json.loads(report_path.read_text())
+        assert report['challenges'] == [NAME]
+        results = {name: r[NAME] for name, r in report['submissions'].items()}
+        assert sorted(results) == ['accepted.ms', 'rejected.ms', 'slow.ms', 'steps.ms', 'syntax.ms']
+
+        assert results['accepted.ms']['passed']
+        assert [r['passed'] for r in results['accepted.ms']['runs']] == [True] * 8
+        assert not results['rejected.ms']['passed']
+        assert not any(r['passed'] or 'error' in r for r in results['rejected.ms']['runs'])
+        assert not results['syntax.ms']['passed'] and results['syntax.ms']['runs'] == []
+        assert 'syntax' in results['syntax.ms']['error']
+        for name, error in [('steps.ms', 'MaximumStepsReached'), ('slow.ms', 'BudgetExceeded')]:
+            assert not results[name]['passed']
+            assert len(results[name]['runs']) == 8
+            assert all(r['error'].startswith(error) for r in results[name]['runs'])
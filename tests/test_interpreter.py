@@ -1,3 +1,5 @@
+import math
+
 import pytest
 import context
 from miniscript.interpreter import *
@@ -26,6 +28,27 @@ class TestCompiler:
             EndBlock()
         ]
 
+    def test_may_return(self):
+        code = compile(parse('while (a) { if (b) { if (c) return 1; } } if (d) x = 1;'))
+        jumps = [c for c in code if isinstance(c, ConditionalJump)]
+        assert [(j.is_loop, j.may_return) for j in jumps] == [(False, True), (False, True), (True, True), (False, False)]
+
+    def test_large_programs(self):
+        n = 100000
+        body = [If(Name('x'), [Assign(Name('y'), Number(i))]) for i in range(n // 2)]
+        code = compile([While(Name('c'), body)])
+        assert len(code) == 4 * (n // 2) + 4
+        assert code[0] == Jump(len(code) - 2)
+        assert code[-2] == ConditionalJump(Name('c'), 3 - len(code), True)
+
+        chain = Return(Number(0))
+        for i in range(n):
+            chain = If(Name('x'), [Assign(Name('y'), Number(i))], chain)
+        code = compile([chain])
+        assert len(code) == 4 * n + 1
+        assert code[0] == ConditionalJump(Name('x'), len(code) - 2, may_return=True)
+        assert code[n] == Return(Number(0))
+
 
 class TestExpressions:
     def test_expression(self):
@@ -103,6 +126,20 @@ class TestInterpreter:
         interpreter.run(100)
         assert s['x'] == TNumber(0)
 
+    def test_nested_loops(self):
+        # a loop in a function called from a loop body starts its own pc level
+        i = make_interpreter('function f(x) { while (false) { x = 1; } return 1; } '
+                             'i = 0; while (i < 3) { a = f(1); i = i + 1; }')
+        i.run()
+        assert i.scope['i'] == TNumber(3)
+        assert i.monitor.pc_levels == [set()]
+        # so does an inner loop, which must not reset the pc level of the outer one
+        i = make_interpreter('h = label(true, "high"); x = 0; k = label(0, "high"); '
+                             'while (h && k < 1) { j = 0; while (j < 1) { j = j + 1; } x = 1; k = 1; }')
+        with pytest.raises(FlowControlError):
+            i.run()
+        assert i.scope['x'] == TNumber(0)
+
     def test_declarations(self):
         code = 'var x;\nx=3;function foo() {var x; x = 4; }\nfoo();'
         i = make_interpreter(code)
@@ -158,3 +195,952 @@ class TestInterpreter:
             print("Handled expected error")
         assert s4['y'] == TNumber(0)
         assert s4['x'] == TNumber(1)
+
+
+class TestArrays:
+    def test_index(self):
+        s = Program.from_source('''
+            a = [1, 2];
+            n = push(a, 3, 4);
+            a[0] = a[3] + 10;
+            b = [[1], [2]];
+            b[1][0] = 7;
+            c = [];
+            c[2] = 1;
+            x = a[9];
+            y = a[-1];
+        ''').run()
+        assert s['a'] == TArray([TNumber(14), TNumber(2), TNumber(3), TNumber(4)])
+        assert s['n'] == TNumber(4)
+        assert s['b'] == TArray([TArray([TNumber(1)]), TArray([TNumber(7)])])
+        assert s['c'] == TArray([TUndefined(), TUndefined(), TNumber(1)])
+        assert s['x'] == TUndefined()
+        assert s['y'] == TUndefined()
+
+    def test_length(self):
+        s = Program.from_source('n = length([1, 2, 3]); m = length("abcd");').run()
+        assert s['n'] == TNumber(3)
+        assert s['m'] == TNumber(4)
+
+    def test_read_labels(self):
+        s = Program.from_source('''
+            h = label(1, "high");
+            a = [1, label(2, "other")];
+            x = a[h];
+            y = a[0];
+            z = [a][0][h];
+        ''').run()
+        assert s['x'].label == {'high', 'other'}
+        assert s['y'].label == set()
+        assert s['z'].label == {'high', 'other'}
+        # reading must not relabel the stored element
+        assert s['a'].values[1].label == {'other'}
+
+    def test_conversion_labels(self):
+        s = Program.from_source('''
+            h = label(1, "high");
+            a = [6, [h]];
+            o = object();
+            o.x = a;
+            s = a + 8;
+            n = -[[h]];
+            e = o == o;
+            p = [1, 2] + 3;
+        ''').run()
+        # conversions and comparisons read all elements
+        assert s['s'] == TString('[6, 1]8') and s['s'].label == {'high'}
+        assert s['n'] == TNumber(-1) and s['n'].label == {'high'}
+        assert s['e'].label == {'high'}
+        assert s['p'].label == set()
+
+    def test_nested_string(self):
+        s = Program.from_source('''
+            a = [1, 2];
+            push(a, a);
+            s = a + "";
+            o = object();
+            o.y = [o, 3];
+            t = o + "";
+            c = [1];
+            i = 0;
+            while (i < 5000) { c = [c, 1]; i = i + 1; }
+            n = length(c + "");
+        ''').run()
+        # containers within themselves are empty, deep nesting doesn't exhaust the stack
+        assert s['s'] == TString('[1, 2, ]')
+        assert s['t'] == TString('{y: [, 3]}')
+        assert s['n'] == TNumber(25001)
+
+    def test_write_labels(self):
+        s = Program.from_source('''
+            h = label(1, "high");
+            a = label([0, 0], "high");
+            a[h] = 5;
+            if (h) { push(a, 6); }
+        ''').run()
+        assert s['a'] == TArray([TNumber(0), TNumber(5), TNumber(6)])
+        assert s['a'].values[1].label == {'high'}
+        assert s['a'].values[2].label == {'high'}
+
+    @pytest.mark.parametrize('source', [
+        'a[h] = 1;',
+        'if (h) { a[0] = 1; }',
+        'if (h) { push(a, 1); }',
+        'b = [a, a]; b[h][0] = 1;',
+        'b = [a, a]; c = b[h]; c[0] = 1;',
+        'b = label([], "high"); if (h) { b = a; b[0] = 1; }',
+    ])
+    def test_write_leaks(self, source):
+        i = Program.from_source('h = label(1, "high"); a = [0, 0];' + source).interpreter()
+        with pytest.raises(FlowControlError):
+            i.run()
+
+    def test_references(self):
+        source = '''
+            h = label(true, "high");
+            a = [1, 2];
+            b = a;
+            b[0] = 9;
+            c = [a];
+            c[0][1] = 8;
+            d = label([], "high");
+            if (h) { d = a; }
+            push(a, 3);
+            n = length(d);
+        '''
+        results = [Program.from_source(source).run(monitor=m()) for m in (Monitor, BaseMonitor)]
+        for s in results:
+            assert s['a'] == s['b'] == s['c'].get(TNumber(0)) == s['d'] == TArray([TNumber(9), TNumber(8), TNumber(3)])
+            assert s['n'] == TNumber(3)
+        # the reference assigned in the branch is labeled, the array itself isn't
+        assert results[0]['d'].label == {'high'}
+        assert results[0]['a'].label == set()
+
+    def test_references_fork_and_snapshot(self):
+        p = Program.from_source('''
+            h = label(true, "high");
+            a = [1, label(2, "x")];
+            d = label([], "high");
+            if (h) { d = a; }
+            a[0] = 5;
+        ''')
+        i = p.interpreter()
+        i.run_until(lambda instruction: isinstance(instruction, Assign) and isinstance(instruction.target, Index))
+        for child in [i.fork()[0], Interpreter.restore(i.snapshot(), p.code)]:
+            child.run()
+            assert child.scope['d'] == TArray([TNumber(5), TNumber(2)])
+            assert child.scope['d'].label == {'high'}
+            assert [v.label for v in child.scope['d']] == [set(), {'x'}]
+        assert i.scope['d'] == TArray([TNumber(1), TNumber(2)])
+
+    def test_packed(self):
+        s = Program.from_source('''
+            a = [];
+            i = 0;
+            while (i < 5) { push(a, i); i = i + 1; }
+            b = [1 / 2, 3 / 2];
+            b[1] = label(5 / 2, "high");
+            c = [1, 2];
+            c[1] = "x";
+        ''').run()
+        assert s['a'].packed and s['b'].packed
+        assert s['a'] == TArray([TNumber(0), TNumber(1), TNumber(2), TNumber(3), TNumber(4)])
+        assert str(s['a']) == '[0, 1, 2, 3, 4]'
+        assert str(s['b']) == '[0.5, 2.5]'
+        assert [v.label for v in s['b']] == [set(), {'high'}]
+        assert not s['c'].packed
+        assert s['c'] == TArray([TNumber(1), TString('x')])
+
+    def test_packed_types(self):
+        a = TArray([TNumber(1), TNumber(2)])
+        a.append(TNumber(0.5))
+        assert not a.packed
+        assert str(a) == '[1, 2, 0.5]'
+        b = TArray([TNumber(1.0)])
+        assert b.packed and str(b.get(TNumber(0))) == '1.0'
+        assert not TArray([TBoolean(True)]).packed
+        assert not TArray([TNumber(2**70)]).packed
+
+    def test_resumable(self):
+        i = Program.from_source('function f() { return 1; } a = [0, 0]; a[f()] = a[f()] + 2;').interpreter()
+        for _ in i.run_iter():
+            pass
+        assert i.scope['a'] == TArray([TNumber(0), TNumber(2)])
+
+
+class TestNativeFunctions:
+    def test_conversion_and_labels(self):
+        @native(params=('number', 'number'), register=False)
+        def hypot(x, y):
+            return math.hypot(x, y)
+
+        @native(params=('string', ), label='pc', register=False)
+        def shout(s):
+            return s.upper()
+
+        p = Program.from_source('''
+            h = label(3, "high");
+            a = hypot(h, 4);
+            b = shout(label("x", "high"));
+            c = hypot([3, label(6, "other")], 4);
+        ''')
+        i = p.interpreter({'hypot': hypot, 'shout': shout})
+        i.run()
+        s = i.scope
+        assert s['a'] == TNumber(5.0) and s['a'].label == {'high'}
+        assert s['b'] == TString('X') and s['b'].label == set()
+        assert s['c'] == TArray([TNumber(5.0), TNumber(math.hypot(6, 4))])
+        assert s['c'].label == {'other'}
+        assert hypot.name == 'hypot'
+
+    def test_none_is_undefined(self):
+        for f in [BuiltinFunction(lambda: None), NativeFunction(lambda: None)]:
+            m = Monitor()
+            m.handle_call(f, [])
+            assert f.call([], m) == TUndefined()
+
+    def test_registry(self):
+        @native(params=('number', ))
+        def twice(x):
+            return 2 * x
+
+        try:
+            i = Program.from_source('y = twice(21);').interpreter()
+            i.run()
+            assert i.scope['y'] == TNumber(42)
+            restored = Interpreter.restore(i.snapshot(), i.code)
+            assert restored.scope['twice'] is twice
+        finally:
+            del GlobalScope.natives['twice']
+
+
+class TestArrayBuiltins:
+    def test_names(self):
+        for name, f in builtin_scope.names.items():
+            assert f.name == name
+
+    def test_numeric(self):
+        s = Program.from_source('''
+            a = [3, 1, 2];
+            s = sum(a);
+            lo = min(a);
+            hi = max(a);
+            e = max([]);
+            b = sort(a);
+            c = slice(a, 1);
+            d = concat(a, [4], c);
+        ''').run()
+        assert s['s'] == TNumber(6)
+        assert s['lo'] == TNumber(1) and s['hi'] == TNumber(3)
+        assert s['e'] == TNumber(-float('inf'))
+        assert s['b'] == TArray([TNumber(1), TNumber(2), TNumber(3)])
+        assert s['a'] == TArray([TNumber(3), TNumber(1), TNumber(2)])
+        assert s['c'] == TArray([TNumber(1), TNumber(2)])
+        assert s['d'] == TArray([TNumber(v) for v in [3, 1, 2, 4, 1, 2]])
+
+    def test_functions(self):
+        s = Program.from_source('''
+            function sq(x) { return x * x; }
+            function odd(x) { return x % 2; }
+            function add(x, y) { return x + y; }
+            a = [1, 2, 3, 4];
+            b = map(a, sq);
+            c = filter(a, odd);
+            d = reduce(a, add, 0);
+            e = sort(["b", "a", 10, 9]);
+        ''').run()
+        assert s['b'] == TArray([TNumber(1), TNumber(4), TNumber(9), TNumber(16)])
+        assert s['c'] == TArray([TNumber(1), TNumber(3)])
+        assert s['d'] == TNumber(10)
+        assert s['e'] == TArray([TNumber(10), TNumber(9), TString('a'), TString('b')])
+
+    def test_labels_match_loop(self):
+        p = Program.from_source('''
+            a = [1, 2, label(3, "secret"), 4];
+            s = 0;
+            i = 0;
+            while (i < length(a)) { s = s + a[i]; i = i + 1; }
+            t = sum(a);
+            u = sum(slice(a, 0, 2));
+            v = sort(a)[0];
+            w = filter(a, label);
+        ''').run()
+        assert p['t'] == p['s'] and p['t'].label == p['s'].label == {'secret'}
+        assert p['u'].label == set()
+        assert p['v'].label == {'secret'}
+        assert p['w'].label == {'secret'}
+
+
+class TestObjects:
+    def test_fields(self):
+        s = Program.from_source('''
+            p = object();
+            p.x = 1;
+            p.y = p.x + 1;
+            o = object();
+            o.inner = object();
+            o.inner.v = "a";
+            n = o.missing;
+        ''').run()
+        assert s['p'] == TObject({'x': TNumber(1), 'y': TNumber(2)})
+        assert s['o'].get_attr('inner') == TObject({'v': TString('a')})
+        assert s['n'] == TUndefined()
+        assert str(s['p']) == '{x: 1, y: 2}'
+
+    def test_shapes(self):
+        a = TObject({'x': TNumber(1), 'y': TNumber(2)})
+        b = TObject({'x': TNumber(3), 'y': TNumber(4)})
+        c = TObject({'y': TNumber(1), 'x': TNumber(2)})
+        assert a.shape is b.shape
+        assert a.shape is not c.shape
+        assert pickle.loads(pickle.dumps(a)).shape is a.shape
+
+    def test_references(self):
+        source = '''
+            o = object();
+            o.x = 1;
+            p = o;
+            p.x = 5;
+            r = o.x;
+            points = [];
+            push(points, object());
+            points[0].x = 1;
+            q = points[0];
+            q.x = q.x + 1;
+            m = dict();
+            n = m;
+            set(n, 1, 2);
+            g = get(m, 1);
+        '''
+        results = [Program.from_source(source).run(monitor=m()) for m in (Monitor, BaseMonitor)]
+        for s in results:
+            assert s['o'] is s['p']
+            assert s['r'] == TNumber(5)
+            assert s['points'].get(TNumber(0)).get_attr('x') == TNumber(2)
+            assert s['g'] == TNumber(2)
+
+    def test_write_through_labeled_reference(self):
+        i = Program.from_source('''
+            h = label(1, "high");
+            o = object();
+            p = label(object(), "high");
+            if (h) { p = o; p.x = 2; }
+        ''').interpreter()
+        with pytest.raises(FlowControlError):
+            i.run()
+
+    def test_inline_cache(self):
+        site = Attribute(Name('o'), 'y')
+        a = TObject({'x': TNumber(1), 'y': TNumber(2)})
+        assert a.get_attr('y', site) == TNumber(2)
+        assert site.cache == (a.shape, 1, None)
+        b = TObject({'y': TNumber(3)})
+        assert b.get_attr('y', site) == TNumber(3)
+        assert site.cache == (b.shape, 0, None)
+        assert a.get_attr('y', site) == TNumber(2)
+        # the cache is not part of the code
+        assert pickle.loads(pickle.dumps(site)).cache is None
+
+    def test_labels(self):
+        i = Program.from_source('''
+            h = label(1, "high");
+            o = object();
+            o.a = h;
+            o.b = 2;
+            x = o.a;
+            y = o.b;
+            if (h) { o.b = 3; }
+        ''').interpreter()
+        with pytest.raises(FlowControlError):
+            i.run()
+        assert i.scope['x'].label == {'high'}
+        assert i.scope['y'].label == set()
+        assert i.scope['o'].get_attr('b') == TNumber(2)
+
+    def test_fork(self):
+        parent = Program.from_source('o = object(); o.x = 1;').interpreter()
+        parent.run()
+        child, = parent.fork()
+        child.scope['o'].set_attr('x', TNumber(2))
+        assert parent.scope['o'].get_attr('x') == TNumber(1)
+
+
+class TestMaps:
+    def test_builtins(self):
+        s = Program.from_source('''
+            d = dict();
+            set(d, "a", 1);
+            set(d, 1, "one");
+            set(d, true, "yes");
+            set(d, "a", 2);
+            a = get(d, "a");
+            one = get(d, 1);
+            t = get(d, true);
+            x = get(d, "x");
+            h = has(d, "a");
+            removed = delete(d, "a");
+            gone = has(d, "a");
+            n = length(d);
+        ''').run()
+        assert s['a'] == TNumber(2)
+        assert s['one'] == TString('one')
+        assert s['t'] == TString('yes')
+        assert s['x'] == TUndefined()
+        assert s['h'] == TBoolean(True)
+        assert s['removed'] == TBoolean(True)
+        assert s['gone'] == TBoolean(False)
+        assert s['n'] == TNumber(2)
+
+    def test_labels(self):
+        s = Program.from_source('''
+            h = label("k", "high");
+            d = label(dict(), "high");
+            set(d, h, 1);
+            set(d, "b", label(2, "other"));
+            x = get(d, "b");
+            p = has(d, h);
+            e = dict();
+            set(e, "b", 2);
+            y = get(e, h);
+            z = get(e, "b");
+        ''').run()
+        assert s['x'].label == {'high', 'other'}
+        assert s['p'].label == {'high'}
+        assert s['y'].label == {'high'}
+        assert s['z'].label == set()
+
+    @pytest.mark.parametrize('source', [
+        'set(d, h, 1);',
+        'if (h) { set(d, "a", 1); }',
+        'if (h) { delete(d, "a"); }',
+    ])
+    def test_leaks(self, source):
+        i = Program.from_source('h = label(1, "high"); d = dict(); set(d, "a", 0);' + source).interpreter()
+        with pytest.raises(FlowControlError):
+            i.run()
+
+    def test_fork(self):
+        parent = Program.from_source('d = dict(); set(d, 1, 1);').interpreter()
+        parent.run()
+        child, = parent.fork()
+        child.scope['d'].set(TNumber(1), TNumber(2))
+        assert parent.scope['d'].get(TNumber(1)) == TNumber(1)
+
+
+class TestStrings:
+    def test_concat(self):
+        s = Program.from_source('''
+            s = "";
+            i = 0;
+            while (i < 3) { s = s + i; i = i + 1; }
+            a = s + "a";
+            b = s + "b";
+            c = a + "c";
+            h = label("h", "high");
+            d = s + h;
+        ''').run()
+        assert s['s'] == TString('012')
+        assert s['a'] == TString('012a')
+        assert s['b'] == TString('012b')
+        assert s['c'] == TString('012ac')
+        assert s['d'] == TString('012h')
+        assert s['d'].label == {'high'}
+        assert s['s'].label == set()
+
+    def test_shared_prefix_does_not_grow(self):
+        s = Program.from_source('s = "prefix"; i = 0; while (i < 1000) { t = s + i; i = i + 1; }').run()
+        assert s['t'] == TString('prefix999')
+        # only the first concatenation may extend the pieces of the prefix in place
+        assert len(s['s']._pieces) <= 2
+        assert s['s'] == TString('prefix')
+
+    def test_copies_and_pickle(self):
+        a = TString('x', {'l'}).concat(TString('y'), {'l'})
+        b = copy.deepcopy(a)
+        assert b == TString('xy') and b.label == {'l'}
+        c = pickle.loads(pickle.dumps(a.concat(TString('z'))))
+        assert c == TString('xyz')
+
+    def test_number(self):
+        s = Program.from_source('a = "3" - 1; b = "x" - 1; c = null - 1;').run()
+        assert s['a'] == TNumber(2)
+        assert math.isnan(s['b'].value)
+        assert s['c'] == TNumber(-1)
+
+
+class TestMonitorStats:
+    def test_counters(self):
+        i = make_interpreter('h = label(1, "high"); x = 0; while (x < 3) { x = x + 1; }')
+        i.run(1000)
+        stats = i.monitor.stats()
+        assert stats['block_entries'] == 4
+        assert stats['block_exits'] == 4
+        assert stats['deepcopies'] == 2 + 3
+        assert stats['max_pc_levels'] == 2
+        assert stats['max_loop_head'] == 1
+        assert stats['max_return_address'] == 1
+        assert stats['max_label_size'] == 1
+        assert stats['unions'] > 0 and stats['subset_checks'] > 0
+
+    def test_loop_fixed_point(self):
+        i = make_interpreter('h = label(50, "h"); n = label(0, "h"); while (n < h) { n = n + 1; }')
+        i.run()
+        stats = i.monitor.stats()
+        assert i.scope['n'].label == {'h'}
+        assert stats['loop_fixed_points'] == 50
+        assert stats['new_labels'] == 0
+
+        # the pc level of the loop only rises in the second iteration
+        i = make_interpreter('k = label(1, "k"); c = 0; y = 0; while (c < 3) { y = y + 1; c = c + k; }')
+        with pytest.raises(FlowControlError):
+            i.run()
+        assert i.scope['y'] == TNumber(1)
+        assert i.monitor.pc_levels[-1] == {'k'}
+
+    def test_snapshot(self):
+        i = make_interpreter('x = 1;')
+        stats = i.monitor.stats()
+        i.run()
+        assert stats['deepcopies'] == 0
+        assert i.monitor.stats()['deepcopies'] == 1
+
+
+class TestJit:
+    def run(self, source, jit, budget=None):
+        i = make_interpreter(source)
+        i.jit = jit
+        error = None
+        try:
+            i.run(budget)
+        except (InterpreterError, ArithmeticError) as e:
+            error = type(e)
+        return i, {k: (repr(v), v.label) for k, v in i.scope.names.items()}, i.monitor.stats(), error, i.pc
+
+    @pytest.mark.parametrize('source', [
+        'i = 0; s = 0; b = true; while (i < 1000) { b = !b; s = s + i * i % 7 - i / 3; i = i + 1; }',
+        'i = 10; x = 0; while (i > -500) { x = x + 1 / i; i = i - 1; }',
+        'i = 0; t = 0; while (i < 500) { t = i == 3; i = i + 1; }',
+        'h = label(1, "h"); i = 0; s = 0; while (i < 500) { s = s + h; i = i + 1; }',
+        'i = 0; while (i < 100) { j = 0; while (j < 100) { j = j + 1; } i = i + 1; }',
+    ])
+    @pytest.mark.parametrize('budget', [None, 1000, 4321])
+    def test_same_as_interpreter(self, source, budget):
+        jitted, *result = self.run(source, True, budget)
+        _, *expected = self.run(source, False, budget)
+        assert result == expected
+
+    def test_compiles_hot_loops(self):
+        i, *_ = self.run('i = 0; s = 0; while (i < 100000) { s = s + i % 3; i = i + 1; }', True)
+        assert i.scope['s'] == TNumber(99999)
+        trace, = i._traces.values()
+        assert trace.compiled[(TNumber, TNumber)] is not None
+
+    def test_labeled_loops_are_interpreted(self):
+        source = 'h = label(1, "h"); i = 0; while (i < 200) { i = i + h; } x = 0; if (i) { x = 1; }'
+        i, scope, *_ = self.run(source, True)
+        trace, = i._traces.values()
+        assert not trace.compiled
+        assert scope['x'][1] == set()
+        assert scope['i'][1] == {'h'}
+
+
+class TestEvents:
+    def record(self, source, *events):
+        from miniscript.events import Events
+        i = make_interpreter(source)
+        log = []
+        i.events = Events()
+        for event in events:
+            i.events.register(event, lambda *args, event=event: log.append((event, args[2:])))
+        return i, log
+
+    def test_no_listeners(self):
+        from miniscript.events import Events
+        i = make_interpreter('i = 0; while (i < 100) { i = i + 1; }')
+        i.events = Events()
+        i.run()
+        assert i._traces
+
+    def test_branch_and_assign(self):
+        i, log = self.record('x = 1; if (x > 2) { x = 3; } else { x = 4; }', 'branch', 'assign')
+        i.run()
+        assert log == [('assign', (TNumber(1), )), ('branch', (False, )), ('assign', (TNumber(4), ))]
+
+    def test_instruction_at_location(self):
+        from miniscript.events import Events
+        i = make_interpreter('i = 0; while (i < 3) { i = i + 1; }')
+        head = next(s for s in i.code if isinstance(s, ConditionalJump))
+        pcs = []
+        i.events = Events()
+        i.events.register(Events.INSTRUCTION, lambda interpreter, instruction: pcs.append(interpreter.pc), head)
+        i.run()
+        assert len(pcs) == 4
+        assert not i._traces
+
+    def test_calls(self):
+        i, log = self.record('function f(x) { y = x * 2; return y; } z = f(2);', 'call', 'return', 'assign')
+        i.run()
+        f = i.scope['f']
+        assert log == [('call', (f, [TNumber(2)])), ('assign', (TNumber(4), )), ('return', (f, TNumber(4))),
+                       ('assign', (TNumber(4), ))]
+
+    def test_function_bodies(self):
+        source = 'function f() { var x; x = 1; return x; } y = f();'
+        i, log = self.record(source, 'assign')
+        i.run()
+        assert log == [('assign', (TNumber(1), )), ('assign', (TNumber(1), ))]
+        from miniscript.events import Events
+        i = make_interpreter(source)
+        instructions = []
+        i.events = Events()
+        i.events.register(Events.INSTRUCTION, lambda interpreter, instruction: instructions.append(instruction))
+        i.run()
+        assert [type(s).__name__ for s in instructions] == ['FunctionDef', 'Assign', 'VarDecl', 'Assign', 'Return']
+
+    def test_callbacks(self):
+        # functions called by builtins report their events too
+        i, log = self.record('function f(x) { y = x + 1; return y; } a = map([1, 2], f);', 'assign')
+        i.run()
+        assert log == [('assign', (TNumber(2), )), ('assign', (TNumber(3), )),
+                       ('assign', (TArray([TNumber(2), TNumber(3)]), ))]
+
+    def test_flow_violation(self):
+        i, log = self.record('function f() { x = 1; } h = label(1, "h"); if (h) { f(); }', 'flow_violation')
+        with pytest.raises(FlowControlError) as e:
+            i.run()
+        assert log == [('flow_violation', (e.value, ))]
+
+    def test_budget(self):
+        i, log = self.record('while (true) { x = 1; }', 'instruction')
+        with pytest.raises(MaximumStepsReached):
+            i.run(10)
+        assert len(log) == 10
+
+    def test_budget_counts_called_functions(self):
+        i, log = self.record('function f() { while (true) { x = 1; } } f();', 'instruction')
+        with pytest.raises(MaximumStepsReached):
+            i.run(10)
+        assert len(log) == 10
+
+
+class TestOutput:
+    source = 'h = label(2, "h"); print("x", 1); if (h) { labelPrint(1); } print(h);'
+
+    def test_capture(self):
+        from miniscript.output import Output
+        output = Output()
+        Program.from_source(self.source).run(output=output)
+        assert [r.text for r in output.records] == ['x 1', "{'h'} 1:{h}", '2']
+        assert [(r.label, r.pc_level) for r in output.records] == [(set(), set()), ({'h'}, {'h'}), ({'h'}, set())]
+        assert output.getvalue() == "x 1\n{'h'} 1:{h}\n2\n"
+
+    def test_batches(self):
+        from miniscript.output import Output
+        import io
+
+        class Stream(io.StringIO):
+            writes = 0
+
+            def write(self, s):
+                self.writes += 1
+                return super().write(s)
+
+        stream = Stream()
+        output = Output(stream, buffer_size=100)
+        Program.from_source('i = 0; while (i < 250) { print(i); i = i + 1; }').run(output=output)
+        assert stream.getvalue() == ''.join(f'{i}\n' for i in range(250))
+        assert stream.writes == 3
+
+    @pytest.mark.parametrize('redact, texts', [(None, ['x 1']), ('***', ['x 1', '***', '***'])])
+    def test_clearance(self, redact, texts):
+        from miniscript.output import Output
+        output = Output(clearance=set(), redact=redact)
+        Program.from_source(self.source).run(output=output)
+        assert [r.text for r in output.records] == texts
+        assert output.dropped == 3 - len(texts)
+
+    def test_follow(self):
+        from miniscript.output import Output
+        i = make_interpreter('i = 0; while (i < 10) { print(i); i = i + 1; }')
+        texts = []
+        for record in Output().follow(i, steps=8):
+            texts.append((record.text, i.pc))
+        assert [t for t, _ in texts] == [str(n) for n in range(10)]
+        assert texts[0][1] < len(i.code)
+
+    def test_pooled_monitors_print_directly(self, capsys):
+        from miniscript.output import Output
+        p = Program.from_source('print(1);')
+        p.run(output=Output())
+        p.run()
+        assert capsys.readouterr().out == '1\n'
+
+
+class TestInputs:
+    def run(self, source, **bindings):
+        p = Program.from_source(source)
+        return p.run(bindings, inputs=self.inputs)
+
+    @pytest.fixture(autouse=True)
+    def inputs(self, tmp_path):
+        from miniscript.inputs import Inputs
+        path = tmp_path / 'data.csv'
+        path.write_text('ann,3\nbob,4\r\n\ncäro,5')
+        with Inputs() as self.inputs:
+            yield path
+
+    @pytest.mark.parametrize('use_mmap', [False, True])
+    def test_lines(self, inputs, use_mmap):
+        self.inputs.allow('data', str(inputs), {'pii'}, use_mmap=use_mmap)
+        # the loop condition depends on the input, so the variables written in the loop need its label
+        s = self.run('l = read("data"); while (l != undefined) { n = n + 1; last = l; l = read("data"); }',
+                     n=TNumber(0, {'pii'}), last=TString('', {'pii'}))
+        assert s['n'] == TNumber(4)
+        assert s['last'] == TString('cäro,5')
+        assert s['last'].label == {'pii'}
+
+    @pytest.mark.parametrize('use_mmap', [False, True])
+    def test_records_and_chunks(self, inputs, use_mmap):
+        self.inputs.allow('records', str(inputs), {'pii'}, kind='records', use_mmap=use_mmap)
+        self.inputs.allow('chunks', str(inputs), kind='chunks', chunk_size=3, use_mmap=use_mmap)
+        s = self.run('r = read("records"); r = read("records"); s = ""; c = read("chunks"); '
+                     'while (c != undefined) { s = s + c; c = read("chunks"); }')
+        assert s['r'] == TArray([TString('bob'), TString('4')])
+        assert s['r'].values[1].label == {'pii'}
+        assert s['s'] == TString(inputs.read_bytes().decode())
+
+    def test_not_allowed(self, inputs):
+        with pytest.raises(InputError):
+            self.run('x = read("data");')
+
+    def test_read_in_high_context(self, inputs):
+        self.inputs.allow('data', str(inputs), {'pii'})
+        s = self.run('h = label(true, "pii"); if (h) { x = read("data"); }', x=TUndefined({'pii'}))
+        assert s['x'].label == {'pii'}
+        with pytest.raises(FlowControlError):
+            self.run('h = label(true, "secret"); if (h) { x = read("data"); }', x=TUndefined({'pii'}))
+
+    def test_fork(self, inputs):
+        self.inputs.allow('data', str(inputs))
+        i = Program.from_source('a = read("data"); b = read("data");').interpreter(inputs=self.inputs)
+        i.step()
+        child, = i.fork()
+        i.run()
+        child.run()
+        assert child.scope['b'] == i.scope['b'] == TString('bob,4')
+        child.monitor.inputs.close()
+
+
+class TestProgram:
+    def test_run(self):
+        p = Program.from_source('var y; y = x * 2; z = label(y, "out");')
+        s = p.run({'x': TNumber(21, {'in'})})
+        assert s['y'] == TNumber(42)
+        assert s['y'].label == {'in'}
+        assert s['z'].label == {'in', 'out'}
+        s2 = p.run({'x': TNumber(1)})
+        assert s2['y'] == TNumber(2)
+        assert s2['y'].label == set()
+
+    def test_bindings_are_copied(self):
+        p = Program.from_source('function f() { var a; return 1; } x = f();')
+        x = TNumber(5)
+        p.run({'x': x})
+        assert x == TNumber(5)
+        assert x.label == set()
+
+    def test_budget(self):
+        p = Program.from_source('while (true) { x = 1; }')
+        with pytest.raises(MaximumStepsReached):
+            p.run(budget=100)
+
+    def test_budget_counts_called_functions(self):
+        p = Program.from_source('function f() { i = 0; while (i < 300000) { i = i + 1; } } f();')
+        monitor = Monitor()
+        with pytest.raises(MaximumStepsReached):
+            p.run(monitor=monitor, budget=100)
+        assert monitor.steps_left == math.inf
+        # the steps of the call are left for the rest of the program
+        p = Program.from_source('function f() { return 1; } x = f(); y = f();')
+        p.run(budget=6)
+        with pytest.raises(MaximumStepsReached):
+            p.run(budget=5)
+
+    def test_threads(self):
+        import concurrent.futures
+        p = Program.from_source('s = 0; i = 0; while (i < n) { s = s + i; i = i + 1; }')
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda n: p.run({'n': TNumber(n)})['s'], range(50)))
+        assert results == [TNumber(n * (n - 1) // 2) for n in range(50)]
+
+    def test_interpreters_are_reused(self):
+        p = Program.from_source('x = label(1, "a"); if (x) { y = 1; }')
+        with pytest.raises(FlowControlError):
+            p.run()
+        i = p.interpreter()
+        assert i.pc == 0
+        assert i.monitor.pc_levels == [set()]
+        assert 'y' not in i.scope.names
+        p.release(i)
+        monitor = BaseMonitor()
+        assert p.run(monitor=monitor)['y'] == TNumber(1)
+        assert p.interpreter().monitor is not monitor
+
+    def test_builtins_are_shared(self):
+        s1 = Program.from_source('print = 1; x = length([1]);').run()
+        s2 = Program.from_source('x = print;').run()
+        assert s1['print'] == TNumber(1)
+        assert s2['print'] is builtin_scope['print']
+        assert 'print' not in s2.names
+        with pytest.raises(IllegalStateError):
+            builtin_scope['print'] = TNumber(1)
+
+
+class TestSnapshot:
+    SOURCE = '''
+        var total;
+        total = 0;
+        function add(x) { total = total + x; return total; }
+        i = 0;
+        while (i < n) { add(label(i, "secret")); i = i + 1; }
+    '''
+
+    def run_with_snapshot(self, n, steps):
+        p = Program.from_source(self.SOURCE)
+        i = p.interpreter({'n': TNumber(n)})
+        for _ in range(steps):
+            i.step()
+        data = i.snapshot()
+        restored = Interpreter.restore(data, p.code)
+        restored.run()
+        return restored, data
+
+    def test_resume(self):
+        restored, data = self.run_with_snapshot(20, 50)
+        assert restored.scope['total'] == TNumber(190)
+        assert restored.scope['total'].label == {'secret'}
+        # the closure of add still refers to the restored global scope
+        assert restored.scope['add'].parent_scope is restored.scope
+        assert restored.monitor.pc_levels == [set()]
+
+    def test_size_independent_of_history(self):
+        _, early = self.run_with_snapshot(2000, 20)
+        _, late = self.run_with_snapshot(2000, 5000)
+        assert abs(len(late) - len(early)) < 64
+
+    def test_invalid(self):
+        p = Program.from_source(self.SOURCE)
+        data = p.interpreter({'n': TNumber(3)}).snapshot()
+        with pytest.raises(SnapshotError):
+            Interpreter.restore(data, Program.from_source('x = 1;').code)
+        with pytest.raises(SnapshotError):
+            Interpreter.restore(b'XXXX' + data[4:], p.code)
+        with pytest.raises(SnapshotError):
+            Interpreter.restore(data[:5], p.code)
+
+    def test_inside_call(self):
+        p = Program.from_source('function f() { x = 1; x = 2; } f();')
+        i = p.interpreter()
+        i.step_chunk(3)
+        with pytest.raises(SnapshotError, match='inside a function call'):
+            i.snapshot()
+        # once the call returned the program can be snapshotted again
+        i.step_chunk(2)
+        assert not i.monitor.return_address
+        restored = Interpreter.restore(i.snapshot(), p.code)
+        restored.run()
+        # also from a listener in the body of a function running to completion
+        from miniscript.events import Events
+        errors = []
+
+        def snapshot(interpreter, instruction, value):
+            with pytest.raises(SnapshotError):
+                i.snapshot()
+            errors.append(value)
+
+        i = p.interpreter()
+        i.events = Events()
+        i.events.register(Events.ASSIGN, snapshot)
+        i.run()
+        assert errors == [TNumber(1), TNumber(2)]
+
+    def test_monitor_stacks(self):
+        # a snapshot in a loop with a raised pc level keeps the level and the loop head
+        p = Program.from_source('h = label(3, "h"); n = label(0, "h"); while (n < h) { n = n + 1; } x = 1;')
+        i = p.interpreter()
+        i.run_until(lambda instruction: instruction == EndBlock(True))
+        assert i.monitor.pc_levels == [set(), {'h'}]
+        restored = Interpreter.restore(i.snapshot(), p.code)
+        assert restored.monitor.pc_levels == [set(), {'h'}]
+        assert restored.monitor.loop_head == i.monitor.loop_head
+        restored.run()
+        assert restored.scope['n'] == TNumber(3)
+        assert restored.monitor.pc_levels == [set()]
+
+    def test_after_call_without_return(self):
+        p = Program.from_source('function f() { x = 1; } y = f(); z = 2;')
+        i = p.interpreter()
+        i.step()
+        i.step()
+        assert i.scope['y'] == TUndefined()
+        restored = Interpreter.restore(i.snapshot(), p.code)
+        restored.run()
+        assert restored.scope['z'] == TNumber(2)
+
+
+class TestFork:
+    def test_fork(self):
+        p = Program.from_source('''
+            var count;
+            count = 0;
+            function inc(x) { count = count + x; return count; }
+            base = 10;
+            r = inc(base + k);
+        ''')
+        parent = p.interpreter({'k': TNumber(0)})
+        parent.run_until(lambda c: 'k' in repr(c))
+        children = parent.fork(3)
+        for n, child in enumerate(children):
+            child.scope.declare('k', TNumber(n, {'secret'}))
+            child.run()
+        assert [c.scope['r'] for c in children] == [TNumber(10), TNumber(11), TNumber(12)]
+        assert [c.scope['count'] for c in children] == [TNumber(10), TNumber(11), TNumber(12)]
+        assert children[1].scope['r'].label == {'secret'}
+        # the closure of inc refers to the forked scope, not the parent's
+        assert children[0].scope['inc'].parent_scope is children[0].scope
+        assert parent.scope['count'] == TNumber(0)
+        parent.run()
+        assert parent.scope['r'] == TNumber(10)
+        assert children[2].scope['r'] == TNumber(12)
+
+    def test_copy_on_write(self):
+        parent = Program.from_source('x = 1; y = "ab";').interpreter()
+        parent.run()
+        child, = parent.fork()
+        assert child.scope.names is parent.scope.names
+        assert child.scope['y'] is parent.scope['y']
+        child.scope['x'] = TNumber(2)
+        assert child.scope.names is not parent.scope.names
+        assert parent.scope['x'] == TNumber(1)
+
+    def test_arrays_are_copied(self):
+        parent = Program.from_source('a = [1, [2]]; var b; b = [a];').interpreter()
+        parent.run()
+        parent.scope['b'].values[0] = parent.scope['a']
+        child, = parent.fork()
+        child.scope['a'].values[1].values.append(TNumber(3))
+        assert parent.scope['a'] == TArray([TNumber(1), TArray([TNumber(2)])])
+        assert child.scope['b'].values[0] is child.scope['a']
+
+    def test_logical_op_does_not_relabel_variables(self):
+        s = Program.from_source('h = label(1, "high"); x = 5; y = h && x;').run()
+        assert s['y'].label == {'high'}
+        assert s['x'].label == set()
+
+    def test_call_does_not_relabel_arguments(self):
+        s = Program.from_source('''
+            function f(a) { return 1; }
+            h = label(true, "high"); x = 5;
+            if (h) { y = f(x); }
+        ''').run({'y': TNumber(0, {'high'})})
+        assert s['x'].label == set()
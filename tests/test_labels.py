@@ -0,0 +1,47 @@
+import pickle
+
+import context
+from miniscript.interpreter import *
+from miniscript.labels import PrincipalTable, mask_vector
+
+
+class TestPrincipalTable:
+    def test_roundtrip(self):
+        t = PrincipalTable()
+        a = t.mask({'alice'})
+        b = t.mask({'bob', 'alice'})
+        assert t.mask(set()) == 0
+        assert t.label(a) == {'alice'}
+        assert t.label(b) == {'alice', 'bob'}
+        assert t.label(a) is t.label(a)
+        assert t.label(t.join([a, b, a])) == {'alice', 'bob'}
+
+    def test_cache_size(self):
+        t = PrincipalTable()
+        t.cache_size = 8
+        labels = [t.label(t.mask({str(i), str(i + 1)})) for i in range(100)]
+        assert len(t._masks) <= 8 and len(t._labels) <= 8
+        assert labels[50] == {'50', '51'}
+        assert t.mask({'50', '51'}) == t.mask({'51', '50'})
+
+    def test_overflow(self):
+        t = PrincipalTable()
+        masks = [t.mask({str(i)}) for i in range(70)]
+        v = mask_vector(masks[:64])
+        assert len(v) == 64 and not isinstance(v, list)
+        assert mask_vector(masks) == masks
+
+
+class TestMaskedArrays:
+    def test_element_labels(self):
+        a = TArray([TNumber(i, {'secret'} if i % 3 == 0 else set()) for i in range(10)])
+        assert a.packed and a._masks is not None
+        assert a.element_labels() == [{'secret'}]
+        assert a.get(TNumber(3)).label == {'secret'}
+        assert a.get(TNumber(4)).label == set()
+        assert a.slice(1, 3).element_labels() == [set()]
+
+    def test_pickle(self):
+        a = TArray([TNumber(1, {'x'}), TNumber(2)])
+        b = pickle.loads(pickle.dumps(a))
+        assert [v.label for v in b] == [{'x'}, set()]
@@ -87,3 +87,39 @@ class TestExpressions:
 
     def test_assign(self):
         assert(parse('x = 5; x')) == [Assign(Name('x'), Number(5)), Name('x')]
+
+
+class TestVisitor:
+    def test_visits_nested_blocks_in_order(self):
+        class Names(NodeVisitor):
+            def __init__(self):
+                self.names = []
+
+            def visit_Name(self, tree):
+                self.names.append(tree.name)
+
+        visitor = Names()
+        visitor.visit(parse('if (a) { while (b) { f(c, [d]); } } else e = g;'))
+        assert visitor.names == ['a', 'b', 'f', 'c', 'd', 'e', 'g']
+
+    def test_dispatch_is_per_class(self):
+        class A(NodeVisitor):
+            def visit_Number(self, tree):
+                return 'a'
+
+        class B(A):
+            def visit_Number(self, tree):
+                return 'b'
+
+        assert A().visit(Number(1)) == 'a'
+        assert B().visit(Number(1)) == 'b'
+        assert NodeVisitor().visit(Number(1)) == Number(1)
+
+    def test_deep_else_if_chain(self):
+        from miniscript.interpreter import collect_locals
+        chain = [VarDecl(Name('last'))]
+        for i in range(20000):
+            chain = If(Name('x'), [VarDecl(Name(f'v{i}'))], chain)
+        found = collect_locals([chain])
+        assert len(found) == 20001
+        assert found[0] == 'v19999' and found[-1] == 'last'
@@ -0,0 +1,194 @@
+import asyncio
+import io
+import math
+
+import pytest
+import context
+from miniscript import *
+
+FIB = '''
+function fib(n) {
+    if (n <= 1) return 1;
+    else return fib(n-1) + fib(n-2);
+}
+x = fib(k);
+'''
+
+
+class TestResumable:
+    def test_run_iter(self):
+        p = Program.from_source(FIB)
+        i = p.interpreter({'k': TNumber(10)})
+        steps = sum(1 for _ in i.run_iter())
+        assert i.scope['x'] == TNumber(89)
+        assert steps > 100
+
+    def test_step_chunk(self):
+        p = Program.from_source(FIB)
+        i = p.interpreter({'k': TNumber(8)})
+        chunks = 1
+        while not i.step_chunk(3):
+            chunks += 1
+            # the only top level statement is still running while we are inside fib
+            assert 'x' not in i.scope.names or i.scope['x'] == TUndefined()
+        assert i.scope['x'] == TNumber(34)
+        assert chunks > 10
+
+    def test_flow_control(self):
+        p = Program.from_source('x = 0; if (h) { x = 1; }')
+        i = p.interpreter({'h': TBoolean(True, {'high'})})
+        with pytest.raises(FlowControlError):
+            while not i.step_chunk(1):
+                pass
+
+    def test_assign_hooks(self):
+        assigned = []
+
+        class Recording(Monitor):
+            def handle_secure_assign(self, a, scope, evaluator):
+                value = super().handle_secure_assign(a, scope, evaluator)
+                assigned.append((a.target.name, value))
+                return value
+
+        class Counting(Interpreter):
+            runs = 0
+
+            def run_Assign(self, a):
+                Counting.runs += 1
+                super().run_Assign(a)
+
+        p = Program.from_source('function f(n) { return n + 1; } x = 1; y = f(x); z = [x, y];')
+        i = Counting(p.code, p.scope(), Recording())
+        for _ in i.run_iter():
+            pass
+        assert i.scope['y'] == TNumber(2)
+        # the assignment with a call is evaluated step by step
+        assert assigned == [('x', TNumber(1)), ('z', TArray([TNumber(1), TNumber(2)]))]
+        assert Counting.runs == 2
+
+    def test_assign_checked_before_call(self):
+        # y can't be created in the secret branch, which is checked before f prints
+        p = Program.from_source('function f() { print(1); return 1; } if (h) { y = f(); }')
+        for run in (Interpreter.run, lambda i: i.step_chunk(1000)):
+            output = io.StringIO()
+            i = p.interpreter({'h': TBoolean(True, {'high'})}, output=Output(output))
+            with pytest.raises(FlowControlError):
+                run(i)
+            i.monitor.output.flush()
+            assert output.getvalue() == ''
+
+
+class TestScheduler:
+    def test_many(self):
+        p = Program.from_source('s = 0; i = 0; while (i < n) { s = s + i; i = i + 1; }')
+        interpreters = [p.interpreter({'n': TNumber(n)}) for n in range(100)]
+        scopes = asyncio.run(Scheduler(chunk=10).run_all(interpreters))
+        assert [s['s'] for s in scopes] == [TNumber(n * (n - 1) // 2) for n in range(100)]
+
+    def test_fairness(self):
+        order = []
+
+        def log(n):
+            order.append(n.value)
+
+        async def main():
+            scheduler = Scheduler(chunk=1)
+            p = Program.from_source('i = 0; while (i < 3) { log(id); i = i + 1; }')
+            interpreters = []
+            for n in range(2):
+                i = p.interpreter({'id': TNumber(n)})
+                i.scope.declare('log', BuiltinFunction(log))
+                interpreters.append(i)
+            await scheduler.run_all(interpreters)
+
+        asyncio.run(main())
+        assert order == [0, 1, 0, 1, 0, 1]
+
+    def test_budget(self):
+        p = Program.from_source('function f() { while (true) { x = 1; } } f();')
+        results = asyncio.run(Scheduler().run_all([p.interpreter()], budget=1000))
+        assert isinstance(results[0], MaximumStepsReached)
+
+    @pytest.mark.parametrize('source', [
+        'function f(x) { while (true) { x = 1; } return x; } y = map([1], f);',
+        'function f(x) { while (true) { x = 1; } return x; } y = filter([1], f);',
+        'function f(a, x) { i = 0; while (i < 200000) { i = i + 1; } return x; } y = reduce([1], f, 0);',
+    ])
+    def test_budget_counts_callbacks(self, source):
+        i = Program.from_source(source).interpreter()
+        with pytest.raises(MaximumStepsReached):
+            asyncio.run(Scheduler(chunk=10).run(i, budget=100))
+        assert i.monitor.steps_left == math.inf
+
+    def test_budget_counts_nested_runs(self):
+        # a host function calling back synchronously runs the callback with the remaining budget
+        def apply(f, x):
+            return f.call([x], monitor)
+
+        p = Program.from_source('function f(x) { while (true) { x = 1; } return x; } y = apply(f, 1);')
+        i = p.interpreter()
+        monitor = i.monitor
+        i.scope.declare('apply', BuiltinFunction(apply))
+        with pytest.raises(MaximumStepsReached):
+            asyncio.run(Scheduler(chunk=10).run(i, budget=100))
+
+    def test_cancel_callback(self):
+        async def main():
+            p = Program.from_source('function f(x) { while (true) { x = 1; } return x; } y = map([1], f);')
+            task = Scheduler().submit(p.interpreter())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+
+    def test_callbacks_step_by_step(self):
+        p = Program.from_source('function f(x) { y = x * 2; return y; } function g(x) { return x > 2; } '
+                                'function add(s, x) { return s + x; } '
+                                'a = map([1, 2, 3], f); b = filter(a, g); c = reduce(b, add, 0);')
+        i = p.interpreter()
+        steps = sum(1 for _ in i.run_iter())
+        assert i.scope['a'] == TArray([TNumber(2), TNumber(4), TNumber(6)])
+        assert i.scope['b'] == TArray([TNumber(4), TNumber(6)])
+        assert i.scope['c'] == TNumber(10)
+        # six top level steps and the steps of f before it returns
+        assert steps == 6 + 3
+
+    def test_cancel(self):
+        async def main():
+            p = Program.from_source('while (true) { x = 1; }')
+            task = Scheduler().submit(p.interpreter())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+
+    def test_async_builtin(self):
+        async def fetch(x):
+            await asyncio.sleep(0.01)
+            return TNumber(x.value * 2, x.label)
+
+        async def main():
+            p = Program.from_source('function g(v) { return fetch(v) + 1; } y = g(x);')
+            interpreters = []
+            for n in range(100):
+                i = p.interpreter({'x': TNumber(n, {'in'})})
+                i.scope.declare('fetch', BuiltinFunction(fetch))
+                interpreters.append(i)
+            return await Scheduler().run_all(interpreters)
+
+        scopes = asyncio.run(main())
+        assert [s['y'] for s in scopes] == [TNumber(2 * n + 1) for n in range(100)]
+        assert scopes[0]['y'].label == {'in'}
+
+    def test_async_builtin_needs_scheduler(self):
+        async def fetch():
+            return TNumber(1)
+
+        i = Program.from_source('y = fetch();').interpreter()
+        i.scope.declare('fetch', BuiltinFunction(fetch))
+        with pytest.raises(UnsupportedOperationError):
+            i.run()